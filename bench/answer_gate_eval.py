@@ -0,0 +1,77 @@
+"""Answer gate evaluation.
+
+Classifies the labeled question, answer and retrieved context triples of
+fixtures/answer_gate.jsonl with the local answer gate and reports its
+accuracy, the share of answers it is confident about (the others are sent to
+the LLM by the hybrid gate) and its latency. The latency saved per question
+is estimated from --llm-latency, the latency of the former classification
+call made on every question.
+
+With --llm the hybrid and LLM gates are also evaluated against the OpenAI API
+configured in OPENAI_API_KEY, measuring their accuracy and latency.
+
+    python bench/answer_gate_eval.py
+    python bench/answer_gate_eval.py --llm
+"""
+import argparse
+import json
+import os
+import time
+
+from common import BENCH_DIR, percentile, prepare_source
+
+
+def evaluate(gate, cases):
+    correct, latencies = 0, []
+    for case in cases:
+        start = time.perf_counter()
+        verdict = gate.classify(case["question"], case["answer"], case["context"])
+        latencies.append(time.perf_counter() - start)
+        correct += verdict == case["label"]
+    return correct / len(cases), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default=os.path.join(BENCH_DIR, "fixtures", "answer_gate.jsonl"))
+    parser.add_argument("--llm-latency", type=float, default=0.6, help="seconds of the LLM classification call")
+    parser.add_argument("--llm", action="store_true", help="also evaluate the hybrid and LLM gates with OpenAI")
+    parser.add_argument("--verbose", action="store_true", help="print the misclassified answers")
+    args = parser.parse_args()
+
+    with open(args.fixtures) as f:
+        cases = [json.loads(line) for line in f if line.strip()]
+
+    prepare_source()
+    from answer_gate import hybrid_gate, llm_gate, local_gate
+
+    local = local_gate()
+    accuracy, latencies = evaluate(local, cases)
+    assessed = [(case, local.assess(case["question"], case["answer"], case["context"])) for case in cases]
+    confident = [(case, verdict) for case, (verdict, confidence) in assessed if confidence >= local.confidence]
+    confident_accuracy = sum(verdict == case["label"] for case, verdict in confident) / max(1, len(confident))
+    fallback_rate = 1 - len(confident) / len(cases)
+
+    print(f"{len(cases)} labeled answers, {sum(case['label'] == 'positive' for case in cases)} positive")
+    print(f"  local gate accuracy {accuracy:.1%}, p50 {percentile(latencies, 0.5) * 1e6:.0f} us, "
+          f"p99 {percentile(latencies, 0.99) * 1e6:.0f} us")
+    print(f"  confident on {len(confident)} answers ({1 - fallback_rate:.1%}), accuracy {confident_accuracy:.1%}, "
+          f"{fallback_rate:.1%} sent to the LLM by the hybrid gate")
+    print(f"  LLM calls saved {1 - fallback_rate:.1%}, about {(1 - fallback_rate) * args.llm_latency * 1000:.0f} ms "
+          f"saved per question with a {args.llm_latency}s classification call")
+
+    if args.verbose:
+        for case, (verdict, confidence) in assessed:
+            if verdict != case["label"]:
+                print(f"  wrong {verdict} ({confidence:.2f}): {case['question']} -> {case['answer']}")
+
+    if args.llm:
+        llm = llm_gate(os.environ["OPENAI_API_KEY"])
+        for name, gate in (("llm", llm), ("hybrid", hybrid_gate(local, llm))):
+            accuracy, latencies = evaluate(gate, cases)
+            print(f"  {name} gate accuracy {accuracy:.1%}, mean {sum(latencies) / len(latencies) * 1000:.0f} ms, "
+                  f"p95 {percentile(latencies, 0.95) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
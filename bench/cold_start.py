@@ -0,0 +1,97 @@
+"""Cold start benchmark.
+
+Starts the chatbot server (--server asgi or flask) --runs times in a child
+process for each STARTUP_MODE, pointed at fake OpenAI and StarlingX servers,
+and reports the seconds from the process start until /healthz answers, until
+/readyz reports the server ready and until the first /session is created.
+In lazy mode the server listens before LangChain and Chroma are imported, in
+eager mode only after the chatbot is loaded.
+
+    python bench/cold_start.py
+    python bench/cold_start.py --server flask --modes lazy --runs 10 --target 1
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from common import percentile, prepare_source, start_asgi, start_flask
+
+
+def serve(server, port):
+    prepare_source()
+    if server == "asgi":
+        start_asgi(port)
+    else:
+        start_flask(port)
+    threading.Event().wait()
+
+
+def wait_for(url, deadline, accept=lambda response: response.status_code == 200):
+    while time.monotonic() < deadline:
+        try:
+            if accept(httpx.get(url, headers={"model": "gpt-3.5-turbo", "temperature": "0"}, timeout=60)):
+                return time.monotonic()
+        except httpx.TransportError:
+            pass
+        time.sleep(0.01)
+    raise Exception(f"{url} did not answer in time")
+
+
+def measure(server, port, mode):
+    env = dict(os.environ, STARTUP_MODE=mode)
+    start = time.monotonic()
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", server, "--port", str(port)],
+                               env=env)
+    url = f"http://127.0.0.1:{port}"
+    deadline = start + 120
+    try:
+        health = wait_for(f"{url}/healthz", deadline)
+        ready = wait_for(f"{url}/readyz", deadline)
+        session = wait_for(f"{url}/session", deadline)
+        return health - start, ready - start, session - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["asgi", "flask"], default="asgi")
+    parser.add_argument("--port", type=int, default=2200)
+    parser.add_argument("--modes", default="lazy,eager", help="comma separated STARTUP_MODE values")
+    parser.add_argument("--runs", type=int, default=5, help="server starts per mode")
+    parser.add_argument("--target", type=float, help="fail when the median seconds until /healthz exceed it")
+    parser.add_argument("--serve", choices=["asgi", "flask"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=0, token_delay=0)
+    openai.configure_environment()
+    configure_instance_environment(fake_instance("System Controller", latency=0))
+
+    print(f"{args.server} server, {args.runs} starts per mode, median / max seconds since the process started")
+    print(f"{'mode':>6} {'healthz':>13} {'readyz':>13} {'first session':>14}")
+    failed = False
+    for mode in args.modes.split(","):
+        results = [measure(args.server, args.port, mode) for _ in range(args.runs)]
+        columns = [[result[i] for result in results] for i in range(3)]
+        print(f"{mode:>6} " + " ".join(f"{f'{percentile(c, 0.5):.2f} / {max(c):.2f}':>13}" for c in columns[:2]) +
+              f" {f'{percentile(columns[2], 0.5):.2f} / {max(columns[2]):.2f}':>14}")
+        if args.target is not None and percentile(columns[0], 0.5) > args.target:
+            print(f"    {mode}: /healthz took longer than the {args.target}s target")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+
+def prepare_source():
+    # The chatbot loads its data files relative to the source directory
+    sys.path.insert(0, BENCH_DIR)
+    sys.path.insert(0, SRC_DIR)
+    os.chdir(SRC_DIR)
+    os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
+
+    from offline import patch_tiktoken
+    patch_tiktoken()
+
+
+def start_asgi(port):
+    import uvicorn
+    import asgi
+
+    config = uvicorn.Config(asgi.app, host="127.0.0.1", port=port, log_level="warning", backlog=4096)
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def start_flask(port):
+    from werkzeug.serving import make_server
+    import main
+
+    server = make_server("127.0.0.1", port, main.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def rss_bytes(pid="self"):
+    # Current resident set size, Linux only
+    with open(f"/proc/{pid}/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss_bytes(pid="self"):
+    # Highest resident set size of the process so far, Linux only
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
@@ -0,0 +1,36 @@
+"""API response compaction benchmark.
+
+Builds pod lists of increasing size, like the ones returned by a large
+cluster, and compares the text embedded and given to the LLM before and after
+compaction, in characters and estimated tokens.
+
+    python bench/compaction_size.py --pods 100 1000 5000
+"""
+import argparse
+import json
+
+from common import prepare_source
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pods", type=int, nargs="+", default=[100, 1000, 5000], help="pods in each list")
+    args = parser.parse_args()
+
+    prepare_source()
+    from compaction import compact_response
+    from fakes import fake_pod
+
+    print(f"{'pods':>6} {'raw chars':>11} {'compact chars':>14} {'raw tokens':>11} {'compact tokens':>15} {'ratio':>6}")
+    for count in args.pods:
+        data = {"kind": "PodList", "items": [fake_pod(i) for i in range(count)]}
+        # Former text of the response, the filtered items formatted by Python
+        raw = str(data["items"])
+        compact = compact_response(json.loads(json.dumps(data)))
+        # Roughly 4 characters per token for JSON and tabular text
+        print(f"{count:>6} {len(raw):>11} {len(compact):>14} {len(raw) // 4:>11} {len(compact) // 4:>15} "
+              f"{len(raw) / len(compact):>6.1f}")
+
+
+if __name__ == "__main__":
+    main()
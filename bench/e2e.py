@@ -0,0 +1,194 @@
+"""End-to-end benchmark against local stand-in OpenAI, Kubernetes and Keystone servers.
+
+Starts the chatbot server (--server asgi or flask) in a child process, pointed
+at fake OpenAI, Keystone, Wind River and Kubernetes servers run by this one,
+and drives /session and /chat over HTTP with scripted workloads:
+
+    cache-hit   questions answered from the context already in the session
+    negative    new sessions, so the first answer fails and the API is asked
+    large-pods  new sessions listing the pods of a cluster with --pods pods
+
+Each workload reports p50/p95/p99 latency, throughput, OpenAI and cluster
+requests per chat and the RSS of the server process. No OpenAI key or
+StarlingX lab is needed.
+
+    python bench/e2e.py
+    python bench/e2e.py --server flask --scenarios negative --requests 100
+    python bench/e2e.py --llm-latency 0.5 --pods 20000 --json results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from common import peak_rss_bytes, percentile, prepare_source, rss_bytes, start_asgi, start_flask
+
+SCENARIOS = {
+    # Question asked, and whether each worker keeps asking on the same warmed up session
+    "cache-hit": {"questions": ["Which alarms are active?"], "reuse_session": True},
+    "negative": {"questions": ["Which alarms are active?", "Are there critical alarms?", "Which alarm is major?"],
+                 "reuse_session": False},
+    "large-pods": {"questions": ["List the pods running in the cluster"], "reuse_session": False},
+}
+HEADERS = {"model": "gpt-3.5-turbo", "temperature": "0.2"}
+
+
+async def new_session(client):
+    response = await client.get("/session", headers=HEADERS)
+    response.raise_for_status()
+    return response.text
+
+
+async def chat(client, session_id, question):
+    response = await client.post("/chat", json={"message": question, "session_id": session_id})
+    response.raise_for_status()
+    return response.text
+
+
+async def run_scenario(url, scenario, concurrency, requests, on_start):
+    questions = scenario["questions"]
+    latencies, errors = [], []
+    pending = iter(range(requests))
+    warm = []
+    ready = asyncio.Event()
+
+    async def worker(client):
+        session_id = None
+        try:
+            if scenario["reuse_session"]:
+                session_id = await new_session(client)
+                await chat(client, session_id, questions[0])
+        except Exception as e:
+            errors.append(e)
+            return
+        finally:
+            # Sessions are warmed up before the clock starts
+            warm.append(True)
+            if len(warm) == concurrency:
+                ready.set()
+
+        await ready.wait()
+        for i in pending:
+            try:
+                if not scenario["reuse_session"]:
+                    session_id = await new_session(client)
+                start = time.perf_counter()
+                await chat(client, session_id, questions[i % len(questions)])
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors.append(e)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=600) as client:
+        workers = [asyncio.ensure_future(worker(client)) for _ in range(concurrency)]
+        await ready.wait()
+        start = time.perf_counter()
+        started = on_start()
+        await asyncio.gather(*workers)
+    return latencies, errors, time.perf_counter() - start, started
+
+
+def serve(server, port):
+    prepare_source()
+    if server == "asgi":
+        start_asgi(port)
+    else:
+        start_flask(port)
+    threading.Event().wait()
+
+
+def start_server(server, port):
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", server, "--port", str(port)])
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception(f"The {server} server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{url}/readyz", timeout=5).status_code == 200:
+                return process, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    process.kill()
+    raise Exception(f"The {server} server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", choices=["asgi", "flask"], default="asgi")
+    parser.add_argument("--port", type=int, default=2100)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated workloads")
+    parser.add_argument("--concurrency", type=int, default=20, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=60, help="chats measured per workload")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds taken by each fake OpenAI call")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="seconds between streamed tokens")
+    parser.add_argument("--answer-words", type=int, default=50, help="words added to each generated answer")
+    parser.add_argument("--dimensions", type=int, default=1536, help="dimensions of the fake embeddings")
+    parser.add_argument("--cluster-latency", type=float, default=0.05, help="seconds taken by each cluster request")
+    parser.add_argument("--pods", type=int, default=5000, help="pods of the fake cluster")
+    parser.add_argument("--alarms", type=int, default=20, help="active alarms of the fake cluster")
+    parser.add_argument("--json", help="file where the results are written")
+    parser.add_argument("--serve", choices=["asgi", "flask"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, args.port)
+
+    # The working directory changes to the sources
+    output = os.path.abspath(args.json) if args.json else None
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=args.llm_latency, token_delay=args.token_delay, dimensions=args.dimensions,
+                         answer_words=args.answer_words)
+    openai.configure_environment()
+    controller = fake_instance("System Controller", latency=args.cluster_latency, pods=args.pods, alarms=args.alarms)
+    configure_instance_environment(controller)
+
+    process, url = start_server(args.server, args.port)
+    results = []
+    try:
+        print(f"{args.server} server, {args.concurrency} clients, {args.requests} chats per workload, "
+              f"fake OpenAI latency {args.llm_latency}s, {args.pods} pods")
+        print(f"{'workload':>10} {'ok':>4} {'err':>4} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'chats/s':>8} "
+              f"{'LLM/chat':>9} {'API/chat':>9} {'rss MiB':>8} {'peak MiB':>9}")
+        for name in args.scenarios.split(","):
+            # Calls made after the sessions are warmed up
+            latencies, errors, elapsed, (calls, requests) = asyncio.run(run_scenario(
+                url, SCENARIOS[name], args.concurrency, args.requests,
+                lambda: (openai.stats["completions"], controller.stats["requests"])))
+            chats = max(1, len(latencies))
+            result = {
+                "workload": name, "chats": len(latencies), "errors": len(errors),
+                "p50": percentile(latencies, 0.50), "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99), "throughput": len(latencies) / elapsed,
+                "llm_calls_per_chat": (openai.stats["completions"] - calls) / chats,
+                "api_requests_per_chat": (controller.stats["requests"] - requests) / chats,
+                "rss_bytes": rss_bytes(process.pid), "peak_rss_bytes": peak_rss_bytes(process.pid),
+            }
+            results.append(result)
+            print(f"{name:>10} {result['chats']:>4} {result['errors']:>4} {result['p50']:>7.3f} "
+                  f"{result['p95']:>7.3f} {result['p99']:>7.3f} {result['throughput']:>8.2f} "
+                  f"{result['llm_calls_per_chat']:>9.2f} {result['api_requests_per_chat']:>9.2f} "
+                  f"{result['rss_bytes'] / 2**20:>8.1f} {result['peak_rss_bytes'] / 2**20:>9.1f}")
+            for error in errors[:3]:
+                print(f"    {type(error).__name__}: {error}")
+    finally:
+        process.terminate()
+        process.wait()
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"arguments": {k: v for k, v in vars(args).items() if k not in ("json", "serve")},
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
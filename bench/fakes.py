@@ -0,0 +1,367 @@
+import datetime
+import hashlib
+import json
+import math
+import os
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from offline import normalize_word
+
+# Ports of the Wind River APIs listed in wr_apis.json
+WR_PORTS = [18002, 6385, 8119, 15491, 7777]
+KEYSTONE_PORT = 5000
+K8S_PORT = 6443
+
+
+class fake_server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def server_bind(self):
+        # HTTPServer resolves the fully qualified name of the host, which is
+        # slow for the many 127.0.0.x addresses of the fake subclouds
+        socketserver.TCPServer.server_bind(self)
+        self.server_name, self.server_port = self.server_address[:2]
+
+
+class json_handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_chunk(self, text):
+        data = text.encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_server(handler, host="127.0.0.1", port=0, context=None):
+    server = fake_server((host, port), handler)
+    if context is not None:
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# OpenAI
+
+def fake_completion(messages):
+    # Answer each prompt of the chatbot pipeline with a plausible completion
+    text = "\n".join(m["content"] for m in messages if isinstance(m.get("content"), str))
+    if "answer only the words 'positive'" in text:
+        answer = text.split("Response:")[-1]
+        return "negative" if "I don't know" in answer else "positive"
+    if "Available instances:" in text:
+        return fake_route(text)
+    if "Progressively summarize" in text:
+        # Previous summary followed by the questions of the new lines
+        previous = text.split("Current summary:")[-1].split("New lines of conversation:")[0].strip()
+        lines = text.split("New lines of conversation:")[-1].split("New summary:")[0]
+        questions = [line[len("Human: "):].split(". If an API response")[0]
+                     for line in lines.splitlines() if line.startswith("Human: ")]
+        return " ".join([previous, "The user asked: " + "; ".join(questions) + "."]).strip()
+    if "Follow Up Input:" in text:
+        return text.split("Follow Up Input:")[-1].split("Standalone question:")[0].strip()
+    if "pieces of context" in text:
+        system = next(m["content"] for m in messages if "pieces of context" in str(m.get("content")))
+        context = system.split("----------------")[-1]
+        # Answered, citing the context, when a word of the question is in it
+        question = messages[-1]["content"].split(". If an API response")[0].lower()
+        words = [word.rstrip("s?") for word in question.split() if len(word) > 3]
+        rows = [line for line in context.strip().splitlines() if line.strip()]
+        if rows and any(word in context.lower() for word in words):
+            return f"According to the API response, {rows[-1]}"
+    return "I don't know."
+
+
+def fake_route(text):
+    # Alarms are asked to the Wind River APIs, anything else to Kubernetes,
+    # about the central cloud unless it is not one of the instances given
+    instances = json.loads(text.split("Available instances: ")[1].split("\n")[0])
+    instance = next((i for i in instances if i["type"] == "central cloud"), instances[0])
+    if "alarm" in text.split("User query:")[-1].split("\n")[0].lower():
+        return json.dumps({"instance": instance["name"], "pool": "Wind River", "endpoint": "18002/v1/alarms"})
+    return json.dumps({"instance": instance["name"], "pool": "Kubernetes", "endpoint": "/api/v1/pods"})
+
+
+def fake_embedding(text, dimensions):
+    digest = hashlib.sha256(text.encode()).digest()
+    values = [b / 255 for b in digest]
+    return (values * (dimensions // len(values) + 1))[:dimensions]
+
+
+def fake_word_embedding(text, dimensions, words=24):
+    # Set of the first words, texts sharing them are close. The first words of
+    # an API response name the API and the resource. Token lists of the offline
+    # tiktoken encoding are already one normalized word per token.
+    if isinstance(text, str):
+        text = [int(hashlib.sha256(normalize_word(word).encode()).hexdigest(), 16) for word in text.split()]
+    vector = [0.01] * dimensions
+    for token in set(text[:words]):
+        vector[token % dimensions] += 1
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector]
+
+
+def make_openai_handler(latency, token_delay, dimensions, answer_words, embedding, stats):
+
+    class openai_handler(json_handler):
+
+        def do_GET(self):
+            # The key is validated by listing the models
+            if self.path.endswith("/models"):
+                return self.send_json({"object": "list", "data": [
+                    {"id": "gpt-3.5-turbo", "object": "model", "created": 0, "owned_by": "openai"}]})
+            self.send_json({"error": {"message": "Not found"}}, status=404)
+
+
+        def do_POST(self):
+            body = self.read_json()
+            time.sleep(latency)
+            if self.path.endswith("/embeddings"):
+                stats["embeddings"] += 1
+                return self.embeddings(body)
+            stats["completions"] += 1
+            return self.completions(body)
+
+
+        def embeddings(self, body):
+            texts = body["input"]
+            if isinstance(texts, str) or (texts and isinstance(texts[0], int)):
+                texts = [texts]
+            if embedding == "words":
+                vectors = [fake_word_embedding(text, dimensions) for text in texts]
+            else:
+                vectors = [fake_embedding(str(text), dimensions) for text in texts]
+            data = [{"object": "embedding", "index": i, "embedding": vector} for i, vector in enumerate(vectors)]
+            self.send_json({"object": "list", "data": data, "model": body.get("model"),
+                            "usage": {"prompt_tokens": len(texts), "total_tokens": len(texts)}})
+
+
+        def completions(self, body):
+            content = fake_completion(body["messages"])
+            if body.get("max_tokens"):
+                content = " ".join(content.split()[:body["max_tokens"]])
+            # Only answers are streamed, they are made longer to stream more tokens
+            if body.get("stream") and answer_words:
+                content = " ".join([content] + ["lorem"] * answer_words)
+            prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body["messages"])
+            stats["prompt_tokens"] += prompt_tokens
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content.split()),
+                     "total_tokens": prompt_tokens + len(content.split())}
+            if not body.get("stream"):
+                return self.send_json({
+                    "id": "chatcmpl-fake", "object": "chat.completion", "created": int(time.time()),
+                    "model": body.get("model"), "usage": usage,
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}]})
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for word in content.split(" "):
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()),
+                         "model": body.get("model"),
+                         "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                self.send_chunk(f"data: {json.dumps(chunk)}\n\n")
+                time.sleep(token_delay)
+            self.send_chunk("data: [DONE]\n\n")
+            self.send_chunk("")
+
+    return openai_handler
+
+
+class fake_openai():
+
+    def __init__(self, latency=0.2, token_delay=0.01, dimensions=64, answer_words=0, embedding="hash"):
+        # embedding is hash, unrelated vectors, or words, close for texts sharing words
+        self.stats = {"completions": 0, "embeddings": 0, "prompt_tokens": 0}
+        self.server = start_server(make_openai_handler(latency, token_delay, dimensions, answer_words, embedding,
+                                                       self.stats))
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v1"
+
+
+    def configure_environment(self):
+        os.environ["OPENAI_API_KEY"] = "sk-fake"
+        os.environ["OPENAI_BASE_URL"] = self.url
+        os.environ["OPENAI_API_BASE"] = self.url
+
+
+    def close(self):
+        self.server.shutdown()
+
+
+# StarlingX instance
+
+def fake_pod(index, namespace="default"):
+    name = f"app-{index:05d}"
+    return {
+        "metadata": {
+            "name": name, "namespace": namespace, "uid": hashlib.md5(name.encode()).hexdigest(),
+            "resourceVersion": str(1000 + index), "creationTimestamp": "2024-03-14T12:00:00Z",
+            "labels": {"app": name, "pod-template-hash": "5d9c7b8f6"},
+            "annotations": {"kubectl.kubernetes.io/restartedAt": "2024-03-14T12:00:00Z"},
+            "managedFields": [{"manager": "kube-controller-manager", "operation": "Update", "apiVersion": "v1",
+                               "time": "2024-03-14T12:00:00Z", "fieldsType": "FieldsV1",
+                               "fieldsV1": {"f:metadata": {"f:labels": {".": {}, "f:app": {}}}}}],
+        },
+        "spec": {
+            "nodeName": "controller-0",
+            "containers": [{"name": "main", "image": "busybox:1.36", "resources": {},
+                            "terminationMessagePath": "/dev/termination-log"}],
+        },
+        "status": {
+            "phase": "Running" if index % 10 else "Pending",
+            "conditions": [{"type": "Ready", "status": "True", "lastTransitionTime": "2024-03-14T12:00:00Z"}],
+            "containerStatuses": [{"name": "main", "ready": bool(index % 10), "restartCount": index % 3,
+                                   "state": {"running": {"startedAt": "2024-03-14T12:00:00Z"}}}],
+        },
+    }
+
+
+def fake_alarms(name, count=3):
+    return {"alarms": [{"uuid": hashlib.md5(f"{name}{i}".encode()).hexdigest(), "alarm_id": f"100.{100 + i}",
+                        "severity": "critical" if i == 0 else "major", "entity_instance_id": f"host={name}",
+                        "reason_text": f"Alarm {i} raised on {name}", "timestamp": "2024-03-14T12:00:00Z"}
+                       for i in range(count)]}
+
+
+def make_instance_handler(instance):
+
+    class instance_handler(json_handler):
+
+        def do_POST(self):
+            self.read_json()
+            time.sleep(instance.latency)
+            instance.stats["requests"] += 1
+            if self.path == "/v3/auth/tokens":
+                instance.stats["logins"] += 1
+                expires_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+                # Every login gets a new token, as in Keystone
+                token = f"token-{instance.name}-{instance.stats['logins']}"
+                return self.send_json({"token": {"expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}},
+                                      status=201, headers={"X-Subject-Token": token})
+            self.send_json({"message": "not found"}, status=404)
+
+
+        def do_GET(self):
+            time.sleep(instance.latency)
+            instance.stats["requests"] += 1
+            port = self.server.server_port
+            path = self.path.split("?")[0]
+            if port == K8S_PORT:
+                if path == "/version":
+                    return self.send_json({"major": "1", "minor": "24", "gitVersion": "v1.24.4"})
+                if path.endswith("/pods"):
+                    # limit/continue pagination, the continue token is the offset
+                    query = dict(parse_qsl(urlsplit(self.path).query))
+                    start = int(query.get("continue", 0))
+                    end = min(instance.pods, start + int(query["limit"])) if "limit" in query else instance.pods
+                    metadata = {"resourceVersion": "5000"}
+                    if end < instance.pods:
+                        metadata.update({"continue": str(end), "remainingItemCount": instance.pods - end})
+                    items = [fake_pod(i) for i in range(start, end)]
+                    return self.send_json({"kind": "PodList", "apiVersion": "v1", "metadata": metadata, "items": items})
+                return self.send_json({"kind": "List", "items": []})
+            if path.endswith("/alarms"):
+                return self.send_json(fake_alarms(instance.name, instance.alarms))
+            if path.endswith("/isystems"):
+                return self.send_json({"isystems": [{"name": instance.name, "software_version": "22.12"}]})
+            self.send_json({"items": []})
+
+    return instance_handler
+
+
+class fake_instance():
+
+    def __init__(self, name, host="127.0.0.1", latency=0.05, pods=20, alarms=3, certificate=None):
+        self.name = name
+        self.host = host
+        self.latency = latency
+        self.pods = pods
+        self.alarms = alarms
+        self.stats = {"requests": 0, "logins": 0}
+
+        handler = make_instance_handler(self)
+        self.servers = [start_server(handler, host, port) for port in [KEYSTONE_PORT] + WR_PORTS]
+        self.servers.append(start_server(handler, host, K8S_PORT, context=tls_context(certificate)))
+        self.url = f"http://{host}:{KEYSTONE_PORT}"
+
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+
+def tls_context(certificate=None):
+    certificate = certificate or self_signed_certificate()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    return context
+
+
+_certificate = None
+
+
+def self_signed_certificate():
+    # Kubernetes API is only reached through HTTPS, the chatbot does not verify it by default
+    global _certificate
+    if _certificate is not None:
+        return _certificate
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "fake-kubernetes")])
+    now = datetime.datetime.utcnow()
+    certificate = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                   .public_key(key.public_key()).serial_number(x509.random_serial_number())
+                   .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+                   .sign(key, hashes.SHA256()))
+
+    directory = tempfile.mkdtemp(prefix="fake-k8s-")
+    cert_path = os.path.join(directory, "tls.crt")
+    key_path = os.path.join(directory, "tls.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    _certificate = (cert_path, key_path)
+    return _certificate
+
+
+def configure_instance_environment(controller):
+    os.environ["OAM_IP"] = controller.url
+    os.environ["TOKEN"] = "fake-k8s-token"
+    os.environ["WR_USER"] = "admin"
+    os.environ["WR_PASSWORD"] = "fake-password"
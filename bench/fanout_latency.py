@@ -0,0 +1,84 @@
+"""Fan-out benchmark against many stub subclouds.
+
+Starts a fake System Controller and --subclouds fake subclouds listening on
+127.0.0.2, 127.0.0.3, ... each answering after a random latency, plus one
+subcloud slower than FANOUT_TIMEOUT and one that is not running. Asks a
+question about every subcloud and reports the wall time of the fan-out, the
+sum of the latencies of the subclouds, how many of them answered and the
+documents and characters of context the fan-out adds to the session.
+
+    python bench/fanout_latency.py --subclouds 120
+    python bench/fanout_latency.py --subclouds 120 --mode async
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+from common import prepare_source
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subclouds", type=int, default=120, help="fake subclouds")
+    parser.add_argument("--min-latency", type=float, default=0.05, help="minimum seconds per subcloud request")
+    parser.add_argument("--max-latency", type=float, default=0.5, help="maximum seconds per subcloud request")
+    parser.add_argument("--timeout", type=float, default=3, help="FANOUT_TIMEOUT")
+    parser.add_argument("--workers", type=int, default=32, help="FANOUT_WORKERS")
+    parser.add_argument("--mode", choices=["sync", "async"], default="sync")
+    parser.add_argument("--pods", type=int, default=20, help="pods of each fake subcloud")
+    args = parser.parse_args()
+
+    os.environ["FANOUT_TIMEOUT"] = str(args.timeout)
+    os.environ["FANOUT_WORKERS"] = str(args.workers)
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai, self_signed_certificate
+
+    openai = fake_openai(latency=0, token_delay=0)
+    openai.configure_environment()
+    certificate = self_signed_certificate()
+    configure_instance_environment(fake_instance("System Controller", latency=0, certificate=certificate))
+
+    random.seed(0)
+    latencies = [random.uniform(args.min_latency, args.max_latency) for _ in range(args.subclouds)]
+    instances = [fake_instance(f"subcloud{i + 1}", host=f"127.0.0.{i + 2}", latency=latency, pods=args.pods,
+                               certificate=certificate) for i, latency in enumerate(latencies)]
+    # One subcloud slower than the fan-out timeout, one unreachable
+    instances.append(fake_instance("subcloud-slow", host=f"127.0.0.{args.subclouds + 2}",
+                                   latency=args.timeout * 2, certificate=certificate))
+    subclouds = [{"name": instance.name, "URL": instance.url, "k8s_token": "fake-k8s-token"} for instance in instances]
+    subclouds.append({"name": "subcloud-down", "URL": f"http://127.0.0.{args.subclouds + 3}:5000",
+                      "k8s_token": "fake-k8s-token"})
+
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(subclouds, f)
+    os.environ["SUBCLOUDS_FILE"] = f.name
+
+    import app as chat
+    chat.set_openai_key()
+    chat.initiate_sessions()
+    session = chat.new_session("gpt-3.5-turbo", "0.2")
+
+    query = "Which subclouds have critical alarms?"
+    start = time.perf_counter()
+    if args.mode == "async":
+        contexts = asyncio.run(chat.aapi_response(query, session))
+    else:
+        contexts = chat.api_response(query, session)
+    elapsed = time.perf_counter() - start
+    os.remove(f.name)
+
+    # Each subcloud is asked for a token and for its alarms
+    print(f"{args.mode} fan-out over {len(subclouds)} subclouds, {args.workers} workers, timeout {args.timeout}s")
+    print(f"  wall time {elapsed:.2f}s, sum of subcloud latencies {2 * sum(latencies):.2f}s, "
+          f"slowest answering subcloud {2 * max(latencies):.2f}s")
+    print(f"  {contexts[0]['response']}")
+    print(f"  {len(contexts)} documents, {sum(len(context['response']) for context in contexts)} characters, "
+          f"largest {max(len(context['response']) for context in contexts)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Kubernetes list pagination benchmark.
+
+Lists the pods of a fake cluster through k8s_request and reports the time,
+the requests made and the peak memory allocated while fetching, parsing and
+compacting them. --page-size 0 fetches the list in a single request, as
+before pagination, and --limit lists the pods of /api/v1/pods?limit=N.
+
+    python bench/k8s_pagination.py --pods 20000
+    python bench/k8s_pagination.py --pods 20000 --page-size 0
+    python bench/k8s_pagination.py --pods 20000 --limit 50
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+from common import prepare_source
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pods", type=int, default=20000, help="pods in the cluster")
+    parser.add_argument("--page-size", type=int, default=500, help="K8S_PAGE_SIZE, 0 disables pagination")
+    parser.add_argument("--max-items", type=int, default=2000, help="MAX_LIST_ITEMS")
+    parser.add_argument("--limit", type=int, help="limit of the endpoint")
+    args = parser.parse_args()
+
+    os.environ["K8S_PAGE_SIZE"] = str(args.page_size)
+    os.environ["MAX_LIST_ITEMS"] = str(args.max_items)
+    # Every page is fetched from the fake cluster
+    os.environ["RESPONSE_CACHE_TTLS"] = '{"/pods": 0}'
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance
+
+    instance = fake_instance("System Controller", latency=0, pods=args.pods)
+    configure_instance_environment(instance)
+
+    import app as chat
+    from api_request import k8s_request
+    chat.node_list = chat.create_instance_list()
+    bot = k8s_request()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    endpoint = f"/api/v1/pods?limit={args.limit}" if args.limit else "/api/v1/pods"
+    response = bot.get_API_response("List the pods", chat.node_list[0], endpoint)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"pods {args.pods}, page size {args.page_size or 'unlimited'}, max items {args.max_items}, "
+          f"limit {args.limit or 'none'}")
+    print(f"  requests {instance.stats['requests']}, {elapsed:.2f}s, peak allocated {peak / 2**20:.1f} MiB, "
+          f"response {len(response)} characters")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Concurrent sessions load test against local stand-in backends.
+
+Starts a fake OpenAI API and a fake StarlingX instance, serves the chatbot
+with the async server (or the Flask server for comparison) and drives many
+sessions concurrently, reporting throughput and latency percentiles.
+
+    python bench/load_test.py --sessions 60 --questions 3
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+from common import percentile, prepare_source, start_asgi, start_flask
+
+QUESTIONS = [
+    "Which alarms are active?",
+    "List the pods running in the cluster",
+    "What is the kubernetes version?",
+]
+
+
+async def run_user(client, questions, latencies, errors):
+    response = await client.get("/session", headers={"model": "gpt-3.5-turbo", "temperature": "0.2"})
+    if response.status_code != 200:
+        errors.append(response.status_code)
+        return
+    session_id = response.text
+
+    for i in range(questions):
+        start = time.perf_counter()
+        response = await client.post("/chat", json={"message": QUESTIONS[i % len(QUESTIONS)], "session_id": session_id})
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors.append(response.status_code)
+
+
+async def run_load(url, sessions, questions):
+    latencies, errors = [], []
+    limits = httpx.Limits(max_connections=sessions, max_keepalive_connections=sessions)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=600) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[run_user(client, questions, latencies, errors) for _ in range(sessions)])
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=60, help="concurrent sessions")
+    parser.add_argument("--questions", type=int, default=3, help="questions per session")
+    parser.add_argument("--server", choices=["asgi", "flask"], default="asgi")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per fake OpenAI call")
+    parser.add_argument("--cluster-latency", type=float, default=0.05, help="seconds per fake cluster call")
+    parser.add_argument("--port", type=int, default=2100)
+    args = parser.parse_args()
+
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=args.llm_latency)
+    openai.configure_environment()
+    controller = fake_instance("System Controller", latency=args.cluster_latency)
+    configure_instance_environment(controller)
+
+    if args.server == "asgi":
+        start_asgi(args.port)
+    else:
+        start_flask(args.port)
+
+    latencies, errors, elapsed = asyncio.run(run_load(f"http://127.0.0.1:{args.port}", args.sessions, args.questions))
+
+    print(f"server:      {args.server}")
+    print(f"sessions:    {args.sessions} x {args.questions} questions")
+    print(f"completed:   {len(latencies)} chats in {elapsed:.2f}s, {len(errors)} errors")
+    print(f"throughput:  {len(latencies) / elapsed:.2f} chats/s")
+    print(f"latency p50: {percentile(latencies, 0.50):.3f}s")
+    print(f"latency p95: {percentile(latencies, 0.95):.3f}s")
+    print(f"LLM calls:   {openai.stats['completions']} completions, {openai.stats['embeddings']} embeddings")
+
+
+if __name__ == "__main__":
+    main()
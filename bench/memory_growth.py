@@ -0,0 +1,60 @@
+"""Chat history growth benchmark.
+
+Holds a --turns long conversation on one session for each memory policy,
+against fake OpenAI and StarlingX servers, and reports the tokens of the chat
+history and of the prompts sent to the LLM per turn. With the buffer policy
+both grow linearly with the conversation, the other policies keep them flat
+once the history is full.
+
+    python bench/memory_growth.py --turns 100
+    python bench/memory_growth.py --turns 100 --policies summary --max-tokens 500
+"""
+import argparse
+import os
+
+from common import prepare_source
+
+QUESTIONS = ["List the pods running in the cluster", "Which alarms are active?",
+             "Which pods are pending?", "Are there major alarms?", "On which node does app-00003 run?"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=100, help="questions asked on each session")
+    parser.add_argument("--policies", default="buffer,window,tokens,summary", help="comma separated memory policies")
+    parser.add_argument("--window", type=int, default=10, help="MEMORY_WINDOW turns")
+    parser.add_argument("--max-tokens", type=int, default=1000, help="MEMORY_MAX_TOKENS of the history")
+    parser.add_argument("--pods", type=int, default=20, help="pods of the fake cluster")
+    args = parser.parse_args()
+
+    os.environ["MEMORY_WINDOW"] = str(args.window)
+    os.environ["MEMORY_MAX_TOKENS"] = str(args.max_tokens)
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=0, token_delay=0)
+    openai.configure_environment()
+    configure_instance_environment(fake_instance("System Controller", pods=args.pods, latency=0))
+
+    import app as chat
+    chat.set_openai_key()
+    chat.initiate_sessions()
+
+    marks = sorted({1, 10, 25, 50, args.turns} & set(range(1, args.turns + 1)))
+    print(f"{args.turns} turns, tokens of the chat history / of the prompts of the turn")
+    print(f"{'policy':>8} " + " ".join(f"{f'turn {turn}':>15}" for turn in marks) + f" {'LLM calls':>10}")
+    for policy in args.policies.split(","):
+        session = chat.new_session("gpt-3.5-turbo", "0", policy)
+        calls = openai.stats["completions"]
+        sizes = {}
+        for turn in range(1, args.turns + 1):
+            prompt_tokens = openai.stats["prompt_tokens"]
+            chat.ask(QUESTIONS[turn % len(QUESTIONS)], session)
+            sizes[turn] = (session["history_tokens"], openai.stats["prompt_tokens"] - prompt_tokens)
+
+        print(f"{policy:>8} " + " ".join(f"{f'{sizes[turn][0]} / {sizes[turn][1]}':>15}" for turn in marks) +
+              f" {(openai.stats['completions'] - calls) / args.turns:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+import string
+
+import tiktoken
+
+
+class whitespace_encoding():
+    # Rough stand-in for the tiktoken encodings, one token per word
+    name = "whitespace"
+
+    def encode(self, text, **kwargs):
+        # Words are compared without case, punctuation or plural, so the fake
+        # word embeddings match texts sharing them
+        return [hash(normalize_word(word)) % 100000 for word in text.split()]
+
+
+    def encode_ordinary(self, text):
+        return self.encode(text)
+
+
+    def decode(self, tokens):
+        return " ".join("token" for _ in tokens)
+
+
+def normalize_word(word):
+    return word.strip(string.punctuation).lower().rstrip("s")
+
+
+def patch_tiktoken():
+    # tiktoken downloads its encodings on first use, which is not possible offline
+    try:
+        tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        tiktoken.get_encoding = lambda name: whitespace_encoding()
+        tiktoken.encoding_for_model = lambda model: whitespace_encoding()
+        return True
+    return False
@@ -0,0 +1,144 @@
+"""Prefetcher benchmark against fake OpenAI and StarlingX servers.
+
+Starts a fake System Controller, --subclouds fake subclouds listening on
+127.0.0.2, 127.0.0.3, ... and one subcloud that is not running, then asks
+common questions about them, each on a new session, with the prefetcher off
+and on. Each mode runs in its own process and reports the latency of the
+questions, how many of them had to route and request an API, and the
+requests made to the clusters and the LLM calls per question. With the
+prefetcher on, the seconds until the sessions are initiated include its
+first round over the instances answering, and the subcloud down is backing
+off at the end. The fake embeddings are close for texts sharing words, so
+the prefetched responses are retrieved by meaning.
+
+    python bench/prefetch.py
+    python bench/prefetch.py --subclouds 10 --cluster-latency 0.3 --rounds 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import percentile, prepare_source
+
+# Endpoints prefetched in the "on" mode
+ENDPOINTS = [
+    {"pool": "Wind River", "endpoint": "18002/v1/alarms"},
+    {"pool": "Wind River", "endpoint": "8119/v1.0/alarms", "instance_type": "central cloud"},
+    {"pool": "Wind River", "endpoint": "6385/v1/isystems"},
+    {"pool": "Kubernetes", "endpoint": "/api/v1/pods"},
+]
+QUESTIONS = [
+    "Which alarms are active?",
+    "Which pods are pending?",
+    "What is the software version of the system?",
+    "Which alarms are active on {subcloud}?",
+    "Which pods are pending on {subcloud}?",
+]
+
+
+def run_mode(args):
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=args.llm_latency, token_delay=0, dimensions=1536, embedding="words")
+    openai.configure_environment()
+    instances = [fake_instance("System Controller", latency=args.cluster_latency, pods=args.pods)]
+    configure_instance_environment(instances[0])
+    instances += [fake_instance(f"subcloud{i + 1}", host=f"127.0.0.{i + 2}", latency=args.cluster_latency,
+                                pods=args.pods) for i in range(args.subclouds)]
+    subclouds = [{"name": instance.name, "URL": instance.url, "k8s_token": "fake-k8s-token"}
+                 for instance in instances[1:]]
+    subclouds.append({"name": "subcloud-down", "URL": f"http://127.0.0.{args.subclouds + 2}:5000",
+                      "k8s_token": "fake-k8s-token"})
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(subclouds, f)
+    os.environ["SUBCLOUDS_FILE"] = f.name
+
+    def cluster_requests():
+        return sum(instance.stats["requests"] for instance in instances)
+
+    import app as chat
+    from metrics import STAGE_SECONDS
+    from prefetcher import PREFETCHER
+
+    start = time.perf_counter()
+    chat.set_openai_key()
+    chat.initiate_sessions()
+    os.remove(f.name)
+    # Until the instances answering are prefetched, the one down is retried
+    # with back-off in the background
+    while not all(PREFETCHER.jobs[instance.name]["refreshed_at"] for instance in instances if PREFETCHER.jobs):
+        time.sleep(0.05)
+    warm_up = time.perf_counter() - start
+    prefetch_requests = cluster_requests()
+
+    def routes():
+        # Questions that had to choose and request an API
+        counts, _ = STAGE_SECONDS.values.get(("route", ), ([], 0))
+        return sum(counts)
+
+    latencies = []
+    requests, calls, routed = cluster_requests(), openai.stats["completions"], routes()
+    for round in range(args.rounds):
+        for i, question in enumerate(QUESTIONS):
+            question = question.format(subcloud=f"subcloud{(round + i) % max(1, args.subclouds) + 1}")
+            session = chat.new_session("gpt-3.5-turbo", "0")
+            question_start = time.perf_counter()
+            chat.ask(question, session)
+            latencies.append(time.perf_counter() - question_start)
+
+    questions = len(latencies)
+    deadline = time.monotonic() + 60
+    while PREFETCHER.is_enabled() and PREFETCHER.stats()["refreshed_instances"] < len(subclouds) + 1:
+        if time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+    stats = PREFETCHER.stats()
+    return {
+        "questions": questions, "p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95),
+        "routed": routes() - routed, "cluster_requests": (cluster_requests() - requests) / questions,
+        "llm_calls": (openai.stats["completions"] - calls) / questions,
+        "warm_up": warm_up, "prefetch_requests": prefetch_requests,
+        "backing_off": stats.get("backing_off_instances", 0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subclouds", type=int, default=3, help="fake subclouds answering")
+    parser.add_argument("--rounds", type=int, default=2, help="times the questions are asked")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds taken by each fake OpenAI call")
+    parser.add_argument("--cluster-latency", type=float, default=0.1, help="seconds taken by each cluster request")
+    parser.add_argument("--pods", type=int, default=200, help="pods of each fake cluster")
+    parser.add_argument("--mode", choices=["off", "on"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        print(json.dumps(run_mode(args)))
+        return
+
+    print(f"{args.rounds} rounds of {len(QUESTIONS)} questions, 1 + {args.subclouds} instances and one down, "
+          f"fake OpenAI latency {args.llm_latency}s, cluster latency {args.cluster_latency}s")
+    print(f"{'prefetch':>8} {'p50 s':>7} {'p95 s':>7} {'routed':>7} {'API req/q':>10} {'LLM/q':>6} "
+          f"{'start s':>10} {'prefetch req':>13} {'backing off':>12}")
+    for mode in ("off", "on"):
+        # Responses prefetched by an earlier run are not reused
+        directory = tempfile.mkdtemp()
+        env = dict(os.environ, PREFETCH_ENDPOINTS=json.dumps(ENDPOINTS if mode == "on" else []),
+                   PREFETCH_LOCK_PATH=os.path.join(directory, "prefetch.lock"),
+                   PREFETCH_DB_PATH=os.path.join(directory, "prefetch.db"))
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--mode", mode] + sys.argv[1:],
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        result = json.loads(output.decode().strip().splitlines()[-1])
+        routed = f"{result['routed']}/{result['questions']}"
+        print(f"{mode:>8} {result['p50']:>7.3f} {result['p95']:>7.3f} {routed:>7} {result['cluster_requests']:>10.2f} "
+              f"{result['llm_calls']:>6.2f} {result['warm_up']:>10.2f} {result['prefetch_requests']:>13} "
+              f"{result['backing_off']:>12}")
+
+
+if __name__ == "__main__":
+    main()
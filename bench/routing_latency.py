@@ -0,0 +1,64 @@
+"""Routing latency benchmark.
+
+Routes --questions distinct questions about the System Controller, each one
+asked --repeats times with different spacing and case, against a fake OpenAI
+API answering after --latency seconds. Reports the routing latency of the
+first time a question is asked and of its repetitions, and the OpenAI calls
+made per question. The former pipeline made three sequential LLM calls,
+instance, API pool and endpoint, when the instance was not found locally.
+
+    python bench/routing_latency.py --questions 50 --latency 0.3
+"""
+import argparse
+import time
+
+from common import percentile, prepare_source
+
+QUESTIONS = ["List the pods of {}", "Which alarms are active on {}", "Show the deployments of {}",
+             "Are there critical alarms in {}", "How many services does {} have"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=50, help="distinct questions routed")
+    parser.add_argument("--repeats", type=int, default=3, help="times each question is asked again")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds taken by each fake OpenAI call")
+    args = parser.parse_args()
+
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=args.latency, token_delay=0)
+    openai.configure_environment()
+    configure_instance_environment(fake_instance("System Controller", latency=0))
+
+    import app as chat
+    chat.set_openai_key()
+    chat.initiate_sessions()
+    candidates = [chat.resolver.controller]
+    calls = dict(openai.stats)
+
+    first, repeated = [], []
+    for i in range(args.questions):
+        question = QUESTIONS[i % len(QUESTIONS)].format(f"cluster {i}")
+        start = time.perf_counter()
+        route = chat.router.route(question, candidates)
+        first.append(time.perf_counter() - start)
+        assert route is not None
+
+        for repeat in range(args.repeats):
+            variant = question.upper() if repeat % 2 else f"  {question.lower()} ?"
+            start = time.perf_counter()
+            chat.router.route(variant, candidates)
+            repeated.append(time.perf_counter() - start)
+
+    print(f"{args.questions} questions, {args.repeats} repeats each, fake OpenAI latency {args.latency}s")
+    print(f"  first time p50 {percentile(first, 0.5) * 1000:.1f} ms, p95 {percentile(first, 0.95) * 1000:.1f} ms")
+    print(f"  repeated   p50 {percentile(repeated, 0.5) * 1000:.3f} ms, p95 {percentile(repeated, 0.95) * 1000:.3f} ms")
+    print("  OpenAI calls per question: " + ", ".join(
+        f"{name} {(openai.stats[name] - calls[name]) / args.questions:.2f}" for name in ("completions", "embeddings")))
+    print(f"  route cache {chat.router.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Session creation latency benchmark.
+
+Creates sessions against a fake OpenAI API answering after --latency seconds
+and reports the latency of new_session. --legacy also performs the work the
+former new_session did on each session, embedding the characters of
+"start vectorstore" into a new Chroma instance and asking the LLM to use the
+current datetime, to compare both versions on the same machine.
+
+    python bench/session_create.py --sessions 200 --latency 0.3
+    python bench/session_create.py --sessions 200 --latency 0.3 --legacy
+"""
+import argparse
+import datetime
+import time
+
+from common import percentile, prepare_source
+
+
+def legacy_setup(chat, session):
+    from langchain.schema.document import Document
+    from langchain_community.vectorstores import Chroma
+    from langchain_openai import OpenAIEmbeddings
+
+    docs = [Document(page_content=x) for x in "start vectorstore"]
+    vectorstore = Chroma.from_documents(documents=docs, embedding=OpenAIEmbeddings(openai_api_key=chat.OPENAI_API_KEY))
+    session["vectorstore"] = vectorstore
+    session["generator"].retriever = vectorstore.as_retriever(search_kwargs={"k": 1})
+    session["generator"].invoke(f"From now on you will use {datetime.datetime.now()} as current datetime for any datetime related user query")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200, help="sessions created")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds taken by each fake OpenAI call")
+    parser.add_argument("--legacy", action="store_true", help="also do the work of the former new_session")
+    args = parser.parse_args()
+
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=args.latency, token_delay=0)
+    openai.configure_environment()
+    configure_instance_environment(fake_instance("System Controller", latency=0))
+
+    import app as chat
+    chat.set_openai_key()
+    chat.initiate_sessions()
+    calls = dict(openai.stats)
+
+    latencies = []
+    for _ in range(args.sessions):
+        start = time.perf_counter()
+        session = chat.new_session("gpt-3.5-turbo", "0.2")
+        if args.legacy:
+            legacy_setup(chat, session)
+        latencies.append(time.perf_counter() - start)
+
+    mode = "legacy" if args.legacy else "current"
+    print(f"{mode} new_session, {args.sessions} sessions, fake OpenAI latency {args.latency}s")
+    print(f"  mean {sum(latencies) / len(latencies) * 1000:.2f} ms, p50 {percentile(latencies, 0.5) * 1000:.2f} ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.2f} ms, max {max(latencies) * 1000:.2f} ms")
+    print("  OpenAI calls per session: " + ", ".join(
+        f"{name} {(openai.stats[name] - calls[name]) / args.sessions:.2f}" for name in ("completions", "embeddings")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Session store soak test.
+
+Creates thousands of sessions against a fake OpenAI API and samples the
+process RSS, showing that memory stays flat once the session store is full.
+
+    python bench/session_soak.py --sessions 3000 --max-sessions 200
+"""
+import argparse
+import gc
+import os
+import time
+
+from common import prepare_source, rss_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=3000, help="sessions created")
+    parser.add_argument("--max-sessions", type=int, default=200, help="MAX_SESSIONS of the store")
+    parser.add_argument("--ask", action="store_true", help="ask one question on each session")
+    parser.add_argument("--samples", type=int, default=15, help="RSS samples taken")
+    args = parser.parse_args()
+
+    os.environ["MAX_SESSIONS"] = str(args.max_sessions)
+    prepare_source()
+    from fakes import configure_instance_environment, fake_instance, fake_openai
+
+    openai = fake_openai(latency=0, token_delay=0)
+    openai.configure_environment()
+    configure_instance_environment(fake_instance("System Controller", latency=0))
+
+    import app as chat
+    chat.set_openai_key()
+    chat.initiate_sessions()
+
+    interval = max(1, args.sessions // args.samples)
+    start = time.perf_counter()
+    print(f"{'sessions':>9} {'stored':>7} {'rss MiB':>8} {'estimated MiB':>14} {'elapsed s':>10}")
+    for i in range(1, args.sessions + 1):
+        session = chat.new_session("gpt-3.5-turbo", "0.2")
+        if args.ask:
+            chat.ask("List the pods running in the cluster", session)
+
+        if i % interval == 0 or i == args.sessions:
+            gc.collect()
+            stats = chat.get_sessions_stats()
+            print(f"{i:>9} {stats['sessions']:>7} {rss_bytes() / 2**20:>8.1f} "
+                  f"{stats['estimated_bytes'] / 2**20:>14.2f} {time.perf_counter() - start:>10.1f}")
+
+    stats = chat.get_sessions_stats()
+    print(f"evictions: {stats['evictions']}, expirations: {stats['expirations']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import re
+
+from constants import ANSWER_GATE, ANSWER_GATE_CONFIDENCE, ANSWER_GATE_MODEL, LOG
+from openai_clients import get_async_client, get_client
+
+POSITIVE = "positive"
+NEGATIVE = "negative"
+
+# Answers given when the context does not have the information
+NEGATIVE_PHRASES = [
+    "i don't know", "i do not know", "i'm sorry", "i am sorry", "no information", "no context",
+    "not enough information", "no api response", "does not provide", "doesn't provide", "does not contain",
+    "doesn't contain", "does not include", "doesn't include", "does not mention", "doesn't mention",
+    "not have access", "don't have access", "do not have access", "i'm unable to", "i am unable to",
+    "cannot provide", "can't provide", "cannot determine", "can't determine", "no details",
+]
+# Commands offered although the user did not ask for them
+DIRECTIVE = re.compile(r"\b(you can|you could|you may|try|run|use)\b.{0,40}\b(command|kubectl|system |curl|`)", re.I)
+COMMAND_WORDS = {"command", "commands", "kubectl", "cli", "how"}
+
+WORD = re.compile(r"[a-z0-9][a-z0-9_.:/-]*[a-z0-9]|[a-z0-9]")
+# Words that say nothing about the information found
+STOPWORDS = {
+    "the", "and", "are", "for", "from", "with", "that", "this", "these", "those", "there", "their", "what",
+    "which", "who", "when", "where", "how", "many", "much", "any", "all", "each", "every", "some", "has",
+    "have", "had", "was", "were", "been", "being", "does", "did", "not", "can", "could", "will", "would",
+    "should", "about", "into", "than", "then", "them", "they", "its", "it's", "also", "only", "currently",
+    "according", "response", "api", "provided", "context", "information", "based", "show", "list", "tell",
+    "give", "please", "running", "cluster", "system", "instance", "following", "total",
+}
+
+
+class local_gate():
+    # Decides from the answer, the question and the documents the answer was
+    # generated from, without network calls
+
+    def __init__(self, confidence=ANSWER_GATE_CONFIDENCE):
+        self.confidence = confidence
+
+
+    def classify(self, query, answer, documents, score=None):
+        return self.assess(query, answer, documents, score)[0]
+
+
+    async def aclassify(self, query, answer, documents, score=None):
+        return self.classify(query, answer, documents, score)
+
+
+    def assess(self, query, answer, documents, score=None):
+        # Returns the verdict and its confidence, from 0.5 to 1
+        text = answer.lower()
+        if any(phrase in text for phrase in NEGATIVE_PHRASES):
+            return NEGATIVE, 0.95
+        if DIRECTIVE.search(answer) and not COMMAND_WORDS.intersection(get_words(query)):
+            return NEGATIVE, 0.8
+        if not documents:
+            # Only the chat history could have answered it
+            return NEGATIVE, 0.6
+
+        context = "\n".join(documents).lower()
+        signals = [get_grounding(answer, context), get_coverage(query, context)]
+        if score is not None:
+            signals.append(min(1.0, max(0.0, score)))
+        evidence = sum(signals) / len(signals)
+        return (POSITIVE if evidence >= 0.5 else NEGATIVE), 0.5 + abs(evidence - 0.5)
+
+
+class llm_gate():
+    # Asks the LLM whether the answer has the information
+
+    def __init__(self, api_key, model=ANSWER_GATE_MODEL):
+        self.api_key = api_key
+        self.model = model
+
+
+    def classify(self, query, answer, documents=None, score=None):
+        completion = get_client(self.api_key).chat.completions.create(
+            model=self.model, messages=get_status_messages(query, answer))
+        return parse_status(completion.choices[0].message.content)
+
+
+    async def aclassify(self, query, answer, documents=None, score=None):
+        completion = await get_async_client(self.api_key).chat.completions.create(
+            model=self.model, messages=get_status_messages(query, answer))
+        return parse_status(completion.choices[0].message.content)
+
+
+class hybrid_gate():
+    # Local decision, the LLM is only asked when the local gate is not confident
+
+    def __init__(self, local, llm):
+        self.local = local
+        self.llm = llm
+
+
+    def classify(self, query, answer, documents, score=None):
+        verdict, confidence = self.local.assess(query, answer, documents, score)
+        if confidence >= self.local.confidence:
+            return verdict
+        LOG.info(f"Local answer gate not confident ({confidence:.2f}), asking the LLM")
+        return self.llm.classify(query, answer, documents, score)
+
+
+    async def aclassify(self, query, answer, documents, score=None):
+        verdict, confidence = self.local.assess(query, answer, documents, score)
+        if confidence >= self.local.confidence:
+            return verdict
+        LOG.info(f"Local answer gate not confident ({confidence:.2f}), asking the LLM")
+        return await self.llm.aclassify(query, answer, documents, score)
+
+
+def get_words(text):
+    return [word for word in WORD.findall(text.lower()) if len(word) > 2 and word not in STOPWORDS]
+
+
+def is_specific(word):
+    # Names, quantities and identifiers, e.g. app-00001, 3 or controller-0
+    return any(character.isdigit() or character in "_.:/-" for character in word)
+
+
+def get_grounding(answer, context):
+    # Share of the words of the answer found in the documents, names and
+    # quantities count when the answer has any
+    words = get_words(answer)
+    specific = [word for word in words if is_specific(word)]
+    words = specific or words
+    if not words:
+        return 0.0
+    return sum(1 for word in words if word in context) / len(words)
+
+
+def get_coverage(query, context):
+    # Share of the words of the question found in the documents, plurals match their singular
+    words = get_words(query)
+    if not words:
+        return 0.0
+    return sum(1 for word in words if word.rstrip("s") in context) / len(words)
+
+
+def get_status_messages(query, answer):
+    return [{"role": "system",
+             "content": "Your task is to understand the context of a text. Look for clues indicating whether the text provides information about a subject. If you come across phrases such as 'I'm sorry', 'no context', 'no information', or 'I don't know', it likely means there isn't enough information available. Similarly, if the text mentions not having access to the information, or if it offers directives without the user requesting them explicitly, the context is negative."},
+            {"role": "user",
+             "content": f"Based on the following text, check if the general context indicates that there is information about what is being asked or not. Make sure to answer only the words 'positive' if there is information, or 'negative' if there isn't. Don't answer nothing besides it.\nUser query {query}\nResponse: {answer}"}]
+
+
+def parse_status(content):
+    return NEGATIVE if "negative" in (content or "").lower() else POSITIVE
+
+
+def create_answer_gate(api_key, name=ANSWER_GATE):
+    if name == "local":
+        return local_gate()
+    if name == "llm":
+        return llm_gate(api_key)
+    if name == "hybrid":
+        return hybrid_gate(local_gate(), llm_gate(api_key))
+    raise Exception(f"Unknown answer gate {name}, available gates: local, llm, hybrid")
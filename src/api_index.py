@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from constants import (API_INDEX_CONFIDENCE, API_INDEX_DIR, API_INDEX_MARGIN,
+                       API_INDEX_TOP_K, LOG)
+
+
+class api_index():
+
+    def __init__(self, embeddings, catalog_path="wr_apis.json", index_dir=API_INDEX_DIR,
+                 top_k=API_INDEX_TOP_K, confidence=API_INDEX_CONFIDENCE, margin=API_INDEX_MARGIN):
+        self.embeddings = embeddings
+        self.catalog_path = catalog_path
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.confidence = confidence
+        self.margin = margin
+
+        self.apis, self.vectors = self.load_or_build()
+
+
+    def get_index_name(self):
+        # The index is rebuilt whenever the catalog or the embedding model changes
+        with open(self.catalog_path, "rb") as f:
+            digest = hashlib.sha256(f.read())
+        digest.update(getattr(self.embeddings, "model", "").encode())
+        return digest.hexdigest()[:16]
+
+
+    def load_or_build(self):
+        name = self.get_index_name()
+        vectors_path = os.path.join(self.index_dir, f"{name}.npy")
+        apis_path = os.path.join(self.index_dir, f"{name}.json")
+
+        if os.path.exists(vectors_path) and os.path.exists(apis_path):
+            with open(apis_path, "r") as f:
+                apis = json.load(f)
+            LOG.info(f"Wind River API index {name} loaded from {self.index_dir}")
+            # Vectors are memory mapped instead of read at startup
+            return apis, np.load(vectors_path, mmap_mode="r")
+
+        with open(self.catalog_path, "r") as f:
+            apis = json.load(f)["APIs"]
+
+        vectors = np.array(self.embeddings.embed_documents([api["action"] for api in apis]), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        # Write to temporary files first so other workers never read a partial index
+        os.makedirs(self.index_dir, exist_ok=True)
+        pid = os.getpid()
+        np.save(f"{vectors_path}.{pid}.npy", vectors)
+        os.replace(f"{vectors_path}.{pid}.npy", vectors_path)
+        with open(f"{apis_path}.{pid}", "w") as f:
+            json.dump(apis, f)
+        os.replace(f"{apis_path}.{pid}", apis_path)
+
+        LOG.info(f"Wind River API index {name} built with {len(apis)} APIs")
+        return apis, np.load(vectors_path, mmap_mode="r")
+
+
+    def search(self, query_vector, instance_type=None):
+        # APIs ranked by cosine similarity with the query
+        query_vector = np.asarray(query_vector, dtype=np.float32)
+        scores = self.vectors @ (query_vector / np.linalg.norm(query_vector))
+
+        ranking = []
+        for position in np.argsort(-scores):
+            api = self.apis[position]
+            if instance_type == "subcloud" and "only be used in the central cloud" in api["action"]:
+                continue
+            ranking.append((float(scores[position]), api))
+            if len(ranking) == self.top_k:
+                break
+        return ranking
+
+
+    def select(self, ranking):
+        # Returns the API when the best match is confident enough to skip the LLM
+        if not ranking:
+            return None
+        best_score, best_api = ranking[0]
+        second_score = ranking[1][0] if len(ranking) > 1 else 0.0
+
+        # APIs with parameters still need the LLM to fill them
+        if "<" in best_api["url"]:
+            return None
+        if best_score >= self.confidence and best_score - second_score >= self.margin:
+            return best_api
+        return None
+
+
+    def get_candidates(self, query, instance_type=None):
+        return self.search(self.embeddings.embed_query(query), instance_type)
+
+
+    async def aget_candidates(self, query, instance_type=None):
+        return self.search(await self.embeddings.aembed_query(query), instance_type)
@@ -1,25 +1,31 @@
 import sys
-
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from constants import CLIENT_ERROR_MSG, LOG
-import requests
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from compaction import compact_response, list_compactor
+from constants import CLIENT_ERROR_MSG, EXCLUDED_NAMESPACES, K8S_PAGE_SIZE, LOG, MAX_LIST_ITEMS
+from http_pool import ASYNC_POOLS, POOLS
+from metrics import span
+from response_cache import RESPONSES
+from streaming import emit_stage
+from token_cache import TOKENS
 import re
 import os
 
+def is_error_response(response):
+    # Texts returned instead of an API response when it could not be retrieved
+    return response == CLIENT_ERROR_MSG or response.startswith(("An error ocurred", "Error trying"))
+
+
 class k8s_request():
 
-    def __init__(self, key):
+    def __init__(self, max_items=MAX_LIST_ITEMS):
         # Namespaces to be ignored
-        self.excluded_namespaces = ["armada", "cert-manager", "flux-helm", "kube-system"]
+        self.excluded_namespaces = EXCLUDED_NAMESPACES
+        # Items kept from a list response
+        self.max_items = max_items
 
-        # API key
-        self.api_key = key
 
-
-    def get_endpoint(self):
-        completion = self.get_api_completion()
+    def build_endpoint(self, completion):
         if completion[0] == "/":
             api_endpoint = f'{self.api_server_url}{completion}'
         elif completion == "-1":
@@ -34,49 +40,26 @@ class k8s_request():
         return api_endpoint
 
 
-    def get_api_completion(self):
-        # Initiate OpenAI
-        llm = ChatOpenAI(openai_api_key = self.api_key)
-
-        # Expected llm response format
-        format_response = "api: <api_completion>"
-
-        # Create prompt
-        prompt = ChatPromptTemplate.from_messages([
-        ("system", f"You are an API generator, based on the user input you will suggest the best API endpoint to retrieve the information from a kubernetes cluster.\n\nYou will only provide the API information that comes after the IP:PORT.\n\nMake sure the provided endpoint is a valid one.\n\nAlso make sure to only provide the API endpoint following the format: {format_response}. Guarantee that the format is followed."),
-        ("user", "{input}")
-        ])
-
-        output_parser = StrOutputParser()
-        chain = prompt | llm | output_parser
-
-        # Get completion
-        completion = chain.invoke({"input": self.query})
-        if len(completion.split(":")) > 1:
-            clean_completion = completion.split(":")[1].strip()
-        else:
-            clean_completion = "-1"
-
-        return clean_completion
-
-
-    def filter_response(self, response):
-        if response.json().get('items', []) != []:
-            pods = response.json().get('items', [])
+    def filter_response(self, data):
+        if isinstance(data, dict) and data.get('items', []) != []:
+            items = data.get('items', [])
             try:
-                filtered_pods = [
-                    pod for pod in pods if pod['metadata']['namespace'] not in self.excluded_namespaces]
-                return filtered_pods
+                filtered_items = [
+                    item for item in items if item['metadata'].get('namespace') not in self.excluded_namespaces]
+                return {**data, 'items': filtered_items}
             except:
-                return response.json()
+                return data
         else:
-            return response.json()
+            return data
 
 
     def save_query_and_instance(self, user_query, instance):
         self.query = user_query
         self.name = instance['name']
+        # Endpoint of the last response, used to tag it in the session vectorstore
+        self.endpoint = None
         self.k8s_token = instance['token']
+        self.ca_cert = instance.get('k8s_ca_cert')
         self.oam_ip = re.search(r"(https?)://(?:\d{1,3}\.){3}\d{1,3}:", instance['URL']).group(0)
         if "https" in self.oam_ip:
             self.api_server_url = f"{self.oam_ip}6443"
@@ -85,12 +68,13 @@ class k8s_request():
             self.api_server_url = f"{secure_oam}6443"
 
 
-    def get_API_response(self, user_query, instance):
+    def get_API_response(self, user_query, instance, completion):
         # Save class variables
         self.save_query_and_instance(user_query, instance)
 
-        # Define Kubernetes API endpoint
-        api_endpoint = self.get_endpoint()
+        # Define Kubernetes API endpoint, the completion is the endpoint chosen by the router
+        api_endpoint = self.build_endpoint(completion)
+        self.endpoint = api_endpoint
         if api_endpoint == "-1":
             return CLIENT_ERROR_MSG
 
@@ -101,151 +85,300 @@ class k8s_request():
         try:
             print(f'API address: {api_endpoint}', file=sys.stderr)
             LOG.info(f'API address: {api_endpoint}')
-            response = requests.get(api_endpoint, headers=headers, verify=False)
+            emit_stage(f'Calling {api_endpoint}')
+            compactor = self.create_compactor(api_endpoint)
+            for response, data in self.get_pages(api_endpoint, headers):
+                if response.status_code != 200:
+                    error = self.get_error(response)
+                    if compactor.kind is None:
+                        return error
+                    # Continue tokens expire, the pages already fetched are still used
+                    compactor.add_note(f"The list is incomplete, the next page failed with status {response.status_code}.")
+                    break
+                # Filter response for undesired namespaces
+                if not compactor.add(self.filter_response(data)):
+                    break
         except Exception as e:
             error = f"An error ocurred while trying to retrieve the information, please rewrite the question and try again.\n Error: {e}"
             LOG.warning(error)
             return error
 
-        if response.status_code == 200:
-            # Filter response for undesired namespaces
-            filtered_response = self.filter_response(response)
-            buit_text_response = f"API {api_endpoint} response from {self.name} = {filtered_response}"
-            return buit_text_response
-        else:
-            error = f"Error trying to make API request:\n {response.status_code}, {response.text}"
-            LOG.warning(error)
-            return error
+        return self.build_response(api_endpoint, compactor)
 
 
-class wr_request():
+    async def aget_API_response(self, user_query, instance, completion):
+        self.save_query_and_instance(user_query, instance)
 
-    def __init__(self, key):
-        # API key
-        self.api_key = key
+        api_endpoint = self.build_endpoint(completion)
+        self.endpoint = api_endpoint
+        if api_endpoint == "-1":
+            return CLIENT_ERROR_MSG
 
-        # Embedded list of Wind River APIs
-        self.apis = self.load_embedded_apis()
+        headers = {'Authorization': f'Bearer {self.k8s_token}'}
 
+        try:
+            print(f'API address: {api_endpoint}', file=sys.stderr)
+            LOG.info(f'API address: {api_endpoint}')
+            emit_stage(f'Calling {api_endpoint}')
+            compactor = self.create_compactor(api_endpoint)
+            pages = self.aget_pages(api_endpoint, headers)
+            try:
+                async for response, data in pages:
+                    if response.status_code != 200:
+                        error = self.get_error(response)
+                        if compactor.kind is None:
+                            return error
+                        # Continue tokens expire, the pages already fetched are still used
+                        compactor.add_note(f"The list is incomplete, the next page failed with status {response.status_code}.")
+                        break
+                    # Filter response for undesired namespaces
+                    if not compactor.add(self.filter_response(data)):
+                        break
+            finally:
+                await pages.aclose()
+        except Exception as e:
+            error = f"An error ocurred while trying to retrieve the information, please rewrite the question and try again.\n Error: {e}"
+            LOG.warning(error)
+            return error
 
-    def load_embedded_apis(self):
-        with open ("wr_apis.json", "r") as f:
-            api_list = f.read()
+        return self.build_response(api_endpoint, compactor)
+
+
+    def get_pages(self, api_endpoint, headers):
+        # Lists are fetched in pages, the body of each page is parsed once
+        continue_token = None
+        while True:
+            url = self.get_page_url(api_endpoint, continue_token)
+            response = RESPONSES.get(
+                self.name, url,
+                lambda validators: POOLS.get(url, ca_cert=self.ca_cert, headers={**headers, **validators}))
+            data = response.json() if response.status_code == 200 else None
+            yield response, data
+
+            continue_token = self.get_continue_token(url, data)
+            if not continue_token:
+                return
+
+
+    async def aget_pages(self, api_endpoint, headers):
+        continue_token = None
+        while True:
+            url = self.get_page_url(api_endpoint, continue_token)
+            response = await RESPONSES.aget(
+                self.name, url,
+                lambda validators: ASYNC_POOLS.get(url, ca_cert=self.ca_cert, headers={**headers, **validators}))
+            data = response.json() if response.status_code == 200 else None
+            yield response, data
+
+            continue_token = self.get_continue_token(url, data)
+            if not continue_token:
+                return
+
+
+    def get_page_url(self, api_endpoint, continue_token):
+        if K8S_PAGE_SIZE <= 0 or not self.is_list_endpoint(api_endpoint):
+            return api_endpoint
+
+        parts = urlsplit(api_endpoint)
+        query = [(key, value) for key, value in parse_qsl(parts.query) if key not in ("limit", "continue")]
+        # The limit of the endpoint caps the whole list, not each page
+        limit = self.get_limit(api_endpoint)
+        query.append(("limit", str(min(limit, K8S_PAGE_SIZE) if limit else K8S_PAGE_SIZE)))
+        if continue_token:
+            query.append(("continue", continue_token))
+        return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+    def get_limit(self, api_endpoint):
+        # Items asked for by the endpoint itself, e.g. ?limit=10
+        for key, value in parse_qsl(urlsplit(api_endpoint).query):
+            if key == "limit" and value.isdigit() and int(value) > 0:
+                return int(value)
+        return None
+
+
+    def create_compactor(self, api_endpoint):
+        # Pages stop being fetched once the limit of the endpoint is reached
+        limit = self.get_limit(api_endpoint)
+        return list_compactor(max_items=min(limit, self.max_items) if limit else self.max_items)
+
+
+    def is_list_endpoint(self, api_endpoint):
+        # /api/v1/<resource>, /api/v1/namespaces/<namespace>/<resource> and the
+        # same under /apis/<group>/<version> are lists, one more segment is an object
+        path = urlsplit(api_endpoint).path.strip("/").split("/")
+        if path[0] == "api":
+            resource = path[2:]
+        elif path[0] == "apis":
+            resource = path[3:]
+        else:
+            return False
+        return len(resource) % 2 == 1
 
-        return api_list
 
+    def get_continue_token(self, url, data):
+        if "limit=" not in url or not isinstance(data, dict):
+            return None
+        return (data.get("metadata") or {}).get("continue")
 
-    def get_endpoint(self):
-        completion = self.get_api_completion()
-        api = self.api_server_url + completion
 
-        return api
+    def get_error(self, response):
+        error = f"Error trying to make API request:\n {response.status_code}, {response.text}"
+        LOG.warning(error)
+        return error
 
 
-    def get_api_completion(self):
-        # Initiate OpenAI
-        llm = ChatOpenAI(openai_api_key = self.api_key,
-                         temperature=0.4)
+    def build_response(self, api_endpoint, compactor):
+        # Only the fields relevant to answer questions are kept
+        buit_text_response = f"API {api_endpoint} response from {self.name} = {compactor.render()}"
+        return buit_text_response
 
-        # Expected llm response format
-        format_response = "api: <api_url>"
 
-        # Create prompt
-        prompt = ChatPromptTemplate.from_messages([
-        ("system", f"You are an API generator, based on the user question you will suggest the best API endpoint to retrieve the information from a Wind River cluster.\n\nYou will look in the context for the available APIs in a Wind River cluster.\n\nMake sure the provided endpoint is present on the provided context and check the action of the APIs to provide the ideal url for the user question. This user question is being made to a {self.type}.\n\nAlso make sure to only provide the API endpoint following the format: {format_response}. Guarantee that the format is followed. Read the entire context before providing an answer."),
-        ("user", "Context:{context} \n\n\n Question:{question}")
-        ])
+class wr_request():
 
-        output_parser = StrOutputParser()
-        chain = prompt | llm | output_parser
+    def __init__(self, max_items=MAX_LIST_ITEMS):
+        # Items kept from a list response
+        self.max_items = max_items
 
-        #Get completion
-        completion = chain.invoke({"context":self.apis, "question": self.query})
 
-        #completion = response.choices[0].message.content
-        clean_completion = completion.split(":")[1].strip()
+    def get_endpoint(self, completion):
+        api = self.api_server_url + completion
 
-        return clean_completion
+        return api
 
 
     def save_query_and_instance(self, user_query, instance):
+        self.save_instance(user_query, instance)
+        with span("token"):
+            self.token = self.get_token()
+
+
+    async def asave_query_and_instance(self, user_query, instance):
+        self.save_instance(user_query, instance)
+        with span("token"):
+            self.token = await self.aget_token()
+
+
+    def save_instance(self, user_query, instance):
         self.auth_url = instance['URL']
         self.user = os.environ['WR_USER']
         self.password = os.environ['WR_PASSWORD']
         self.name = instance['name']
         self.type = instance['type']
+        self.ca_cert = instance.get('ca_cert')
         self.api_server_url = re.search(r"(https?)://(?:\d{1,3}\.){3}\d{1,3}:", self.auth_url).group(0)
         self.query = user_query
-        self.token = self.get_token()
+        self.endpoint = None
 
 
-    def get_API_response(self, user_query, instance):
+    def get_API_response(self, user_query, instance, completion):
         # Save class variables
         self.save_query_and_instance(user_query, instance)
 
-        url = self.get_endpoint()
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "X-Auth-Token": self.token
-        }
+        url = self.get_endpoint(completion)
+        self.endpoint = url
 
         try:
             print(f'API address: {url}', file=sys.stderr)
             LOG.info(f'API address: {url}')
-            response = requests.get(url, headers=headers, verify=False)
+            emit_stage(f'Calling {url}')
+            response = RESPONSES.get(self.name, url, lambda validators: self.fetch(url, validators))
         except Exception as e:
             error = f"An error ocurred while trying to retrieve the information, please rewrite the question and try again.\n Error: {e}"
             LOG.warning(error)
             return error
 
+        return self.build_response(response)
+
+
+    async def aget_API_response(self, user_query, instance, completion):
+        await self.asave_query_and_instance(user_query, instance)
+
+        url = self.get_endpoint(completion)
+        self.endpoint = url
+
+        try:
+            print(f'API address: {url}', file=sys.stderr)
+            LOG.info(f'API address: {url}')
+            emit_stage(f'Calling {url}')
+            response = await RESPONSES.aget(self.name, url, lambda validators: self.afetch(url, validators))
+        except Exception as e:
+            error = f"An error ocurred while trying to retrieve the information, please rewrite the question and try again.\n Error: {e}"
+            LOG.warning(error)
+            return error
+
+        return self.build_response(response)
+
+
+    def build_response(self, response):
         if response.status_code == 200:
-            str_response = f"Wind River API response from {self.name} = {response.text}"
+            try:
+                text = compact_response(response.json(), max_items=self.max_items)
+            except ValueError:
+                text = response.text
+            str_response = f"Wind River API response from {self.name} = {text}"
             return str_response
         else:
             error = f"Error trying to make API request:\n {response.status_code}, {response.text}"
             LOG.warning(error)
             return error
 
-    def get_token(self):
-        url = f"{self.auth_url}/v3/auth/tokens"
-        headers = {
-            "Content-Type": "application/json"
-        }
-        data = {
-            "auth": {
-                "identity": {
-                    "methods": ["password"],
-                    "password": {
-                        "user": {
-                            "name": self.user,
-                            "domain": {"id": "default"},
-                            "password": self.password
-                        }
-                    }
-                },
-                "scope": {
-                    "project": {
-                        "name": "admin",
-                        "domain": {"id": "default"}
-                    }
-                }
-            }
+
+    def fetch(self, url, validators):
+        response = POOLS.get(url, ca_cert=self.ca_cert, headers={**self.get_headers(), **validators})
+
+        # Token may have been revoked before its expiration, login again and retry once
+        if response.status_code == 401:
+            LOG.info(f'Unauthorized response from {self.name}, renewing token')
+            self.invalidate_token()
+            response = POOLS.get(url, ca_cert=self.ca_cert, headers={**self.get_headers(), **validators})
+
+        return response
+
+
+    async def afetch(self, url, validators):
+        response = await ASYNC_POOLS.get(url, ca_cert=self.ca_cert, headers={**self.get_headers(), **validators})
+
+        if response.status_code == 401:
+            LOG.info(f'Unauthorized response from {self.name}, renewing token')
+            await self.ainvalidate_token()
+            response = await ASYNC_POOLS.get(url, ca_cert=self.ca_cert, headers={**self.get_headers(), **validators})
+
+        return response
+
+
+    def get_headers(self):
+        return {
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "X-Auth-Token": self.token
         }
 
+
+    def get_token(self):
+        # Tokens are shared between sessions and only requested again when expired
         try:
-            response = requests.post(url, headers=headers, json=data, verify=False)
+            return TOKENS.get_token(self.auth_url, self.user, self.password, self.ca_cert)
         except Exception as e:
-            error = f"An error ocurred while trying to retrieve the authentication for the Wind River APIs. Error:{e}"
-            LOG.error(error)
+            error = str(e)
+            LOG.warning(error)
             return error
 
-        if response.status_code == 201:
-            # Get token from response
-            x_auth_token = response.headers["x-subject-token"]
 
-            return x_auth_token
-        else:
-            error = f"Error trying to retrieve authentication token:\n {response.status_code}, {response.text}"
+    def invalidate_token(self):
+        TOKENS.invalidate(self.auth_url, self.user, self.token)
+        self.token = self.get_token()
+
+
+    async def aget_token(self):
+        try:
+            return await TOKENS.aget_token(self.auth_url, self.user, self.password, self.ca_cert)
+        except Exception as e:
+            error = str(e)
             LOG.warning(error)
             return error
+
+
+    async def ainvalidate_token(self):
+        await TOKENS.ainvalidate(self.auth_url, self.user, self.token)
+        self.token = await self.aget_token()
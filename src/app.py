@@ -1,60 +1,262 @@
+import asyncio
 import datetime
+import hashlib
 import json
 import logging
 import os
 import re
 import sys
+import time
 import uuid
+from typing import Any
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.chains import ConversationalRetrievalChain
 from langchain_community.vectorstores import Chroma
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+from langchain_core.retrievers import BaseRetriever
 from langchain.schema.document import Document
-from langchain.memory.buffer import ConversationBufferMemory
+from langchain_core.messages import messages_from_dict, messages_to_dict
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from api_request import k8s_request, wr_request
-from openai import OpenAI
-from constants import CLIENT_ERROR_MSG, LOG
+from api_index import api_index
+from answer_gate import NEGATIVE, create_answer_gate
+from api_request import is_error_response, k8s_request, wr_request
+from openai import AuthenticationError
+import openai_clients
+from constants import CLIENT_ERROR_MSG, FANOUT_MAX_ITEMS, LOG, MAX_LIST_ITEMS, SUBCLOUDS_FILE
+from conversation_memory import create_memory
+from embedding_cache import EMBEDDINGS, cached_embeddings
+from fanout import FANOUT, FANOUT_SOURCE, merge_results
+from instance_resolver import AMBIGUOUS_PATH, FANOUT_PATH, instance_resolver
+from metrics import REGISTRY, format_metric, span
+from prefetcher import PREFETCH_LEADER, PREFETCHER, prefetch_store
+from query_router import KUBERNETES_POOL, query_router
+from response_cache import RESPONSES
+from session_backend import create_session_backend
+from session_store import session_store
+from streaming import EVENT_SINK, emit_discard, emit_stage, usage_handler
+
+# Prompt of the answer step, the current datetime is filled in on every query
+ANSWER_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "Use the following pieces of context to answer the user's question. \n"
+               "If you don't know the answer, just say that you don't know, don't try to make up an answer.\n"
+               "Use {current_datetime} as current datetime for any datetime related user query.\n"
+               "----------------\n{context}"),
+    ("human", "{question}"),
+]).partial(current_datetime=lambda: str(datetime.datetime.now()))
 
 
 def initiate_sessions():
+    # Sessions of this process, rebuilt from the backend state when missing
     global sessions
-    sessions = {}
+    sessions = session_store()
+    global session_backend
+    session_backend = create_session_backend()
     global node_list
     node_list = create_instance_list()
+    global router
+    router = query_router(OPENAI_API_KEY, create_api_index())
+    global answer_gate
+    answer_gate = create_answer_gate(OPENAI_API_KEY)
+    global prefetched
+    prefetched = start_prefetcher()
+    REGISTRY.add_collector(collect_metrics)
 
 
 def get_session(session_id):
-    return sessions.get(session_id)
-
-
-def new_session(model, temperature):
+    # The session is pinned in memory until its question is answered
+    session = sessions.get(session_id, pin=True)
+    if session is not None:
+        # Another worker may have answered in the session since
+        version = session_backend.get_version(session_id)
+        if version is None or version <= session["version"]:
+            return session
+        sessions.unpin(session)
+
+    # Session created by another worker, evicted from this one or outdated
+    state = session_backend.get(session_id)
+    if state is None:
+        return None
+    LOG.info(f"Session with ID: {session_id} rebuilt from its stored state, version {state['version']}")
+    return build_session(state, pin=True)
+
+
+def unpin_session(session):
+    sessions.unpin(session)
+
+
+def new_session(model, temperature, memory=None):
+    state = {"id": str(uuid.uuid4()), "model": model, "temperature": temperature, "memory": memory,
+             "chat_history": [], "api_context": []}
+    # No network calls, the retriever stays empty until the first API response
+    session = build_session(state)
+    save_session(session)
+    LOG.info(f"New session with ID: {session['id']} initiated. Model: {model}, Temperature: {temperature}, "
+             f"Memory: {session['memory']}")
+    return session
+
+
+def build_session(state, pin=False):
     # Create vectorstore
     llm = ChatOpenAI(
-        model_name=model,
-        temperature=float(temperature),
-        openai_api_key=OPENAI_API_KEY)
-    session_id = str(uuid.uuid4())
-    memory, retriever = create_vectorstore(llm)
-    # Create chat response generator
-    generator = ConversationalRetrievalChain.from_llm(
-                llm=llm,
-                retriever=retriever,
-                memory=memory)
+        model_name=state["model"],
+        temperature=float(state["temperature"]),
+        openai_api_key=OPENAI_API_KEY,
+        client=get_client().chat.completions,
+        async_client=get_async_client().chat.completions)
+    # Answers are generated by a streaming LLM so its tokens can be forwarded
+    streaming_llm = ChatOpenAI(
+        model_name=state["model"],
+        temperature=float(state["temperature"]),
+        openai_api_key=OPENAI_API_KEY,
+        client=get_client().chat.completions,
+        async_client=get_async_client().chat.completions,
+        streaming=True)
+    streaming_llm.callbacks = [usage_handler(streaming_llm)]
+    # Sessions saved before memory policies use the default one
+    memory = create_memory(llm, state.get("memory"), state.get("summary", ""))
+    memory.chat_memory.messages = messages_from_dict(state["chat_history"])
+    # Create chat response generator, its retriever only has the prefetched
+    # responses until the session stores its own API context
+    generator = create_generator(llm, streaming_llm, context_retriever(shared=prefetched), memory)
 
-    # Give the LLM date time context
-    query = f"From now on you will use {datetime.datetime.now()} as current datetime for any datetime related user query"
-    generator.invoke(query)
-    
     # Create API connections
-    k8s_bot = k8s_request(OPENAI_API_KEY)
-    wr_bot = wr_request(OPENAI_API_KEY)
+    k8s_bot = k8s_request()
+    wr_bot = wr_request()
+
+    session = {"generator": generator, "llm": llm, "streaming_llm": streaming_llm, "vectorstore": None,
+               "id": state["id"], "version": state.get("version", 0), "model": state["model"],
+               "temperature": state["temperature"],
+               "memory": memory.policy, "history_tokens": memory.count_tokens(), "api_context": [], "k8s_bot": k8s_bot, "wr_bot": wr_bot}
+    for context in state["api_context"]:
+        if isinstance(context, str):
+            # State saved before responses were tagged with their source
+            context = {"instance": "", "endpoint": "", "response": context}
+        store_api_response(session, context["response"], context)
 
     # Add session to sessions map
-    sessions[session_id] = {"generator": generator, "llm": llm, "id": session_id, "k8s_bot": k8s_bot, "wr_bot": wr_bot}
-    LOG.info(f"New session with ID: {session_id} initiated. Model: {model}, Temperature: {temperature}")
-    return sessions[session_id]
+    return sessions.add(session, pin)
+
+
+def save_session(session):
+    # Everything needed to rebuild the session in any worker
+    version = session_backend.put(session["id"], {
+        "id": session["id"],
+        "model": session["model"],
+        "temperature": session["temperature"],
+        "memory": session["memory"],
+        "chat_history": messages_to_dict(session["generator"].memory.chat_memory.messages),
+        "summary": session["generator"].memory.summary,
+        "api_context": session["api_context"],
+    }, session["version"])
+    if version is None:
+        # The stored state is newer, the next question rebuilds the session from it
+        LOG.warning(f"Session {session['id']} was saved by another worker meanwhile, this answer is not kept")
+        return
+    session["version"] = version
+
+
+def create_generator(llm, streaming_llm, retriever, memory):
+    # The question condensing step uses the non streaming LLM, so only the
+    # tokens of the answer are forwarded to streaming clients
+    return ConversationalRetrievalChain.from_llm(
+                llm=streaming_llm,
+                condense_question_llm=llm,
+                retriever=retriever,
+                memory=memory,
+                combine_docs_chain_kwargs={"prompt": ANSWER_PROMPT},
+                # Used by the answer gate
+                return_source_documents=True,
+                return_generated_question=True)
+
+
+class context_retriever(BaseRetriever):
+    # Closest chunks among the API responses of the session and the responses
+    # prefetched from the instance the question is about
+    vectorstore: Any = None
+    shared: Any = None
+    k: int = 1
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        results, shared_results = self.search(query)
+        if self.shared is not None:
+            self.shared.record(any(result in shared_results for result in results))
+        return [document for document, _ in results]
+
+
+    def search(self, query):
+        # Documents with their relevance scores, best first, and the ones of
+        # them that were prefetched. The closest chunks of the session are
+        # always kept, the prefetched ones could be closer but older.
+        results = []
+        if self.vectorstore is not None:
+            results += self.expand_fanouts(self.vectorstore.similarity_search_with_relevance_scores(query, k=self.k))
+        contents = {document.page_content for document, _ in results}
+        shared_results = [result for result in self.search_shared(query) if result[0].page_content not in contents]
+        return sorted(results + shared_results, key=lambda result: result[1], reverse=True), shared_results
+
+
+    def expand_fanouts(self, results):
+        # A document of a fan-out comes with the documents of every other
+        # instance, the whole fan-out fits in the context
+        expanded = []
+        fanouts = set()
+        for document, score in results:
+            fanout = document.metadata.get("fanout")
+            if fanout is None:
+                expanded.append((document, score))
+            elif fanout not in fanouts:
+                fanouts.add(fanout)
+                expanded += [(group_document, score) for group_document in self.get_fanout(fanout)]
+        return expanded
+
+
+    def get_fanout(self, fanout):
+        stored = self.vectorstore._collection.get(where={"fanout": fanout}, include=["documents", "metadatas"])
+        documents = [Document(page_content=content, metadata=metadata)
+                     for content, metadata in zip(stored["documents"], stored["metadatas"])]
+        return sorted(documents, key=lambda document: document.metadata.get("position", 0))
+
+
+    def search_shared(self, query):
+        if self.shared is None:
+            return []
+        _, path, candidates = resolver.resolve(query)
+        # Questions about several instances are asked to all of them
+        if path in (FANOUT_PATH, AMBIGUOUS_PATH):
+            return []
+        try:
+            return self.shared.search(query, candidates, self.k)
+        except Exception as e:
+            LOG.warning(f"Could not search the prefetched responses: {e}")
+            return []
+
+
+def get_sessions_stats():
+    return sessions.stats()
+
+
+def get_cache_stats():
+    stats = {"responses": RESPONSES.stats(), "embeddings": EMBEDDINGS.stats(), "routes": router.stats()}
+    if prefetched is not None:
+        stats["prefetched"] = {**prefetched.stats(), **PREFETCHER.stats(), **PREFETCH_LEADER.stats()}
+    return stats
+
+
+def collect_metrics():
+    # Cache and session statistics, read from their stores on every scrape
+    caches = get_cache_stats()
+    sessions_stats = get_sessions_stats()
+    lines = []
+    for field in ("hits", "misses"):
+        lines += format_metric(f"chatbot_cache_{field}_total", "counter", f"Cache {field} by cache", ["cache"],
+                               {(name, ): stats[field] for name, stats in caches.items()})
+    lines += format_metric("chatbot_cache_hit_ratio", "gauge", "Hit rate of each cache", ["cache"],
+                           {(name, ): stats["hit_rate"] for name, stats in caches.items()})
+    lines += format_metric("chatbot_sessions", "gauge", "Sessions kept in memory", [],
+                           {(): sessions_stats["sessions"]})
+    lines += format_metric("chatbot_history_tokens", "gauge", "Chat history tokens of the sessions in memory", [],
+                           {(): sessions_stats["history_tokens"]})
+    return lines
 
 
 def create_logger():
@@ -74,79 +276,293 @@ def create_logger():
     LOG.info("Chatbot logger initiated.")
 
 
-def create_vectorstore(llm):
-    # Create Chroma vector store
-    data_start = "start vectorstore"
-    docs = [Document(page_content=x) for x in data_start]
-    vectorstore = Chroma.from_documents(documents=docs, embedding=OpenAIEmbeddings(openai_api_key = OPENAI_API_KEY))
+def create_context_vectorstore():
+    # Collection of the API responses retrieved by a session
+    vectorstore = Chroma(embedding_function=create_embeddings())
+    create_index_folder()
+    return vectorstore
+
 
-    memory = ConversationBufferMemory(
-    llm=llm, memory_key="chat_history", return_messages=True)
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 1})
+def create_index_folder():
+    # chromadb 0.3 creates the folder of its HNSW indexes with the first
+    # embedding of any collection, and fails when two sessions race to do it.
+    # Imported here, chromadb is only loaded with the first vectorstore.
+    import chromadb.config
+    os.makedirs(os.path.join(chromadb.config.Settings().persist_directory, "index"), exist_ok=True)
 
-    return memory, retriever
 
+def create_embeddings():
+    # Chunks embedded by any session are reused by the others
+    return cached_embeddings(OpenAIEmbeddings(
+        openai_api_key=OPENAI_API_KEY,
+        client=get_client().embeddings,
+        async_client=get_async_client().embeddings))
 
-def ask(query, session):
-    query_completion = query + ". If an API response is provided as context and in the provided API response doesn't have this information or no context is provided, make sure that your response is 'I don't know'. Unless the user explicitly ask for commands you will not provide any. Make sure to read the entire given context before giving your response."
+
+def ask(query, session, callbacks=None):
+    try:
+        return answer(query, session, callbacks)
+    finally:
+        unpin_session(session)
+
+
+async def aask(query, session, callbacks=None):
+    try:
+        return await aanswer(query, session, callbacks)
+    finally:
+        unpin_session(session)
+
+
+def answer(query, session, callbacks=None):
+    query_completion = get_query_completion(query)
     LOG.info(f"User query: {query}")
-    response = session['generator'].invoke(query_completion)
+    with span("chain"):
+        response = session['generator'].invoke(query_completion, config={"callbacks": callbacks})
 
     print(f'######{response}', file=sys.stderr)
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    prompt_status = client.chat.completions.create(model='gpt-3.5-turbo',
-                                                   messages=[{"role": "system",
-                                                              "content": "Your task is to understand the context of a text. Look for clues indicating whether the text provides information about a subject. If you come across phrases such as 'I'm sorry', 'no context', 'no information', or 'I don't know', it likely means there isn't enough information available. Similarly, if the text mentions not having access to the information, or if it offers directives without the user requesting them explicitly, the context is negative."},
-                                                             {"role": "user",
-                                                              "content": f"Based on the following text, check if the general context indicates that there is information about what is being asked or not. Make sure to answer only the words 'positive' if there is information, or 'negative' if there isn't. Don't answer nothing besides it.\nUser query {query}\nResponse: {response['answer']}"}])
-    print(f'prompt status: {prompt_status.choices[0].message.content}', file=sys.stderr)
-    if 'negative' in prompt_status.choices[0].message.content.lower():
+    with span("answer_gate"):
+        status = answer_gate.classify(query, response['answer'], get_documents(response),
+                                      get_retrieval_score(session, response))
+    print(f'prompt status: {status}', file=sys.stderr)
+    if status == NEGATIVE:
         LOG.info("Negative response from LLM")
+        # The tokens already streamed are replaced by the next answer
+        emit_discard("Answer not found in the current context, retrieving it from the cluster")
         feed_vectorstore(query, session)
-        response = session['generator'].invoke(query)
+        # The unanswered exchange is replaced by the answer from the retrieved data
+        forget_last_exchange(session)
+        emit_stage("Generating answer from the retrieved data")
+        with span("chain"):
+            response = session['generator'].invoke(query, config={"callbacks": callbacks})
 
     # if "I'm sorry" in response['answer'] or "there is no information" in response['answer'] or "I don't know" in response['answer']:
     #     feed_vectorstore(query, session)
     #     response = session['generator'].invoke(query_completion)
+    with span("memory"):
+        session['generator'].memory.prune()
+    log_history_tokens(session)
+    with span("save_session"):
+        save_session(session)
     LOG.info(f"Chatbot response: {response['answer']}")
     return response['answer']
 
 
+async def aanswer(query, session, callbacks=None):
+    query_completion = get_query_completion(query)
+    LOG.info(f"User query: {query}")
+    with span("chain"):
+        response = await session['generator'].ainvoke(query_completion, config={"callbacks": callbacks})
+
+    loop = asyncio.get_running_loop()
+    with span("answer_gate"):
+        score = await loop.run_in_executor(None, get_retrieval_score, session, response)
+        status = await answer_gate.aclassify(query, response['answer'], get_documents(response), score)
+    if status == NEGATIVE:
+        LOG.info("Negative response from LLM")
+        emit_discard("Answer not found in the current context, retrieving it from the cluster")
+        await afeed_vectorstore(query, session)
+        # The unanswered exchange is replaced by the answer from the retrieved data
+        forget_last_exchange(session)
+        emit_stage("Generating answer from the retrieved data")
+        with span("chain"):
+            response = await session['generator'].ainvoke(query, config={"callbacks": callbacks})
+
+    with span("memory"):
+        await session['generator'].memory.aprune()
+    log_history_tokens(session)
+    with span("save_session"):
+        # The session backend may write to disk
+        await loop.run_in_executor(None, save_session, session)
+    LOG.info(f"Chatbot response: {response['answer']}")
+    return response['answer']
+
+
+def log_history_tokens(session):
+    # Tokens of the chat history sent with the next question
+    session["history_tokens"] = session['generator'].memory.count_tokens()
+    LOG.info(f"Chat history of session {session['id']}: {session['history_tokens']} tokens")
+
+
+def get_client():
+    return openai_clients.get_client(OPENAI_API_KEY)
+
+
+def get_async_client():
+    return openai_clients.get_async_client(OPENAI_API_KEY)
+
+
+def get_query_completion(query):
+    return query + ". If an API response is provided as context and in the provided API response doesn't have this information or no context is provided, make sure that your response is 'I don't know'. Unless the user explicitly ask for commands you will not provide any. Make sure to read the entire given context before giving your response."
+
+
+def get_documents(response):
+    return [document.page_content for document in response.get('source_documents', [])]
+
+
+def get_retrieval_score(session, response):
+    # Relevance of the closest chunk to the question the retriever searched,
+    # whose embedding is already cached
+    if not response.get('generated_question'):
+        return None
+    try:
+        results, _ = session['generator'].retriever.search(response['generated_question'])
+    except Exception as e:
+        LOG.warning(f"Could not score the retrieved context: {e}")
+        return None
+    return results[0][1] if results else None
+
+
 def feed_vectorstore(query, session):
-    response = api_response(query, session)
+    contexts = api_response(query, session)
 
-    if response is None:
+    if any(context["response"] is None for context in contexts):
         raise Exception('API response is null')
 
-    print(f'API response: {response}', file=sys.stderr)
+    for context in contexts:
+        print(f'API response: {context["response"]}', file=sys.stderr)
 
     # regex = r"(?=.*\binternal\b)(?=.*\bserver\b)(?=.*\berror\b).+"
     # if re.search(regex, response.lower()):
     #     response = CLIENT_ERROR_MSG
 
+    with span("embed"):
+        store_api_contexts(session, contexts)
+
+
+async def afeed_vectorstore(query, session):
+    contexts = await aapi_response(query, session)
+
+    if any(context["response"] is None for context in contexts):
+        raise Exception('API response is null')
+
+    # Chroma embeds the documents in the default executor
+    loop = asyncio.get_running_loop()
+    with span("embed"):
+        await loop.run_in_executor(None, store_api_contexts, session, contexts)
+
+
+def split_response(response):
     text_splitter = CharacterTextSplitter(chunk_size=500, chunk_overlap=0)
     all_splits = text_splitter.split_text(response)
-    docs = [Document(page_content=x) for x in all_splits]
-    vectorstore = Chroma.from_documents(documents=docs, embedding=OpenAIEmbeddings(openai_api_key = OPENAI_API_KEY))
+    return [Document(page_content=x) for x in all_splits]
 
-    llm = session['llm']
 
-    memory = ConversationBufferMemory(
-    llm=llm, memory_key="chat_history", return_messages=True)
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 1})
+def store_api_contexts(session, contexts):
+    # A new fan-out replaces the whole previous one of the same endpoint,
+    # including the instances that do not answer anymore
+    for fanout in {context["fanout"] for context in contexts if context.get("fanout")}:
+        forget_fanout(session, fanout)
+    for context in contexts:
+        store_api_response(session, context["response"], context)
 
-    sessions[session['id']]['generator'] = ConversationalRetrievalChain.from_llm(
-                llm=llm,
-                retriever=retriever,
-                memory=memory)
+
+def forget_fanout(session, fanout):
+    session['api_context'] = [context for context in session['api_context'] if context.get("fanout") != fanout]
+    if session['vectorstore'] is not None:
+        session['vectorstore']._collection.delete(where={"fanout": fanout})
+
+
+def store_api_response(session, response, source):
+    # Every API response of the session is kept in one collection, created
+    # with the first one
+    if session['vectorstore'] is None:
+        session['vectorstore'] = create_context_vectorstore()
+        session['generator'].retriever = context_retriever(vectorstore=session['vectorstore'], shared=prefetched)
+
+    fetched_at = source.get("fetched_at") or time.time()
+    metadata = {"instance": source["instance"], "endpoint": source["endpoint"], "fetched_at": fetched_at}
+    if source.get("fanout"):
+        # The response of each instance is one document, already cut to fit
+        metadata.update(fanout=source["fanout"], position=source["position"])
+        docs = [Document(page_content=response)]
+    else:
+        docs = split_response(response)
+    added, evicted = upsert_chunks(session['vectorstore'], docs, metadata)
+    LOG.info(f"Session {session['id']} context from {source['instance']} {source['endpoint']}: "
+             f"{added} chunks embedded, {evicted} stale chunks evicted")
+
+    # Only the latest response of each endpoint is kept to rebuild the session
+    session['api_context'] = [context for context in session['api_context']
+                              if (context["instance"], context["endpoint"]) != (source["instance"], source["endpoint"])]
+    session['api_context'].append({**metadata, "response": response})
+
+
+def upsert_chunks(vectorstore, docs, metadata):
+    # Chunks are identified by their content hash, so only new ones are embedded
+    chunks = {}
+    for doc in docs:
+        key = f"{metadata['instance']}\n{metadata['endpoint']}\n{doc.page_content}"
+        chunks[hashlib.sha256(key.encode()).hexdigest()] = doc.page_content
+
+    collection = vectorstore._collection
+    where = {"$and": [{"instance": metadata["instance"]}, {"endpoint": metadata["endpoint"]}]}
+    stored = set(collection.get(where=where, include=[])["ids"])
+
+    # Chunks of an older response of the same endpoint are stale
+    stale = [chunk_id for chunk_id in stored if chunk_id not in chunks]
+    if stale:
+        collection.delete(ids=stale)
+
+    kept = [chunk_id for chunk_id in chunks if chunk_id in stored]
+    if kept:
+        collection.update(ids=kept, metadatas=[metadata] * len(kept))
+
+    new = [chunk_id for chunk_id in chunks if chunk_id not in stored]
+    if new:
+        vectorstore.add_texts([chunks[chunk_id] for chunk_id in new], metadatas=[metadata] * len(new), ids=new)
+    return len(new), len(stale)
+
+
+def start_prefetcher():
+    # Store of the prefetched responses, None when the prefetcher is disabled
+    if not PREFETCHER.is_enabled():
+        return None
+    store = prefetch_store(create_context_vectorstore())
+
+    def publish(response, source):
+        publish_prefetched(store, response, source)
+
+    def publish_and_save(response, source):
+        # The leader shares what it prefetched with the other processes
+        publish(response, source)
+        PREFETCH_LEADER.save(response, source)
+
+    PREFETCH_LEADER.start(lambda: PREFETCHER.start(node_list, prefetch_response, publish_and_save), publish)
+    return store
 
 
-def set_openai_key():
+def prefetch_response(instance, pool, endpoint):
+    # Same request as the one of a question routed to this endpoint, compacted
+    bot = create_bot(pool)
+    response = bot.get_API_response(user_query="", instance=instance, completion=endpoint)
+    if is_error_response(response):
+        raise Exception(response)
+    return response, {"instance": instance["name"], "endpoint": bot.endpoint or endpoint, "fetched_at": time.time()}
+
+
+def publish_prefetched(store, response, source):
+    metadata = {"instance": source["instance"], "endpoint": source["endpoint"], "fetched_at": source["fetched_at"]}
+    docs = split_response(response)
+    # Embedded before the store is locked, the upsert finds them in the embedding cache
+    store.vectorstore.embeddings.embed_documents([doc.page_content for doc in docs])
+    added, evicted = store.publish(upsert_chunks, docs, metadata)
+    LOG.info(f"Prefetched {source['endpoint']} from {source['instance']}: "
+             f"{added} chunks added, {evicted} stale chunks evicted")
+
+
+def forget_last_exchange(session):
+    messages = session['generator'].memory.chat_memory.messages
+    session['generator'].memory.chat_memory.messages = messages[:-2]
+
+
+def set_openai_key(validate=True):
+    # The servers validate the key in the background, see startup.py
     create_logger()
     try:
         global OPENAI_API_KEY
         OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
-        is_api_key_valid(OPENAI_API_KEY)
+        if validate and not is_api_key_valid(OPENAI_API_KEY):
+            raise Exception("The provided key is not valid.")
     except Exception:
         raise Exception("Error while trying to set OpenAI API Key variable")
     LOG.info("API key configured")
@@ -154,90 +570,144 @@ def set_openai_key():
 
 
 def is_api_key_valid(key):
+    # Listing the models costs no tokens, errors other than a rejected key
+    # are raised, the key could not be checked
     try:
-        client = OpenAI(api_key=key)
-        _ = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "system", "content": "This is a test."}],
-            max_tokens=5
-        )
-    except Exception:
-        raise Exception("The provided key is not valid.")
+        openai_clients.get_client(key).models.list()
+    except AuthenticationError:
+        return False
     return True
 
 
-def define_api_pool(query, session):
-    # Use LLM to decide if Kubernetes or Wind River API pool should be used.
-    complete_query = f"Based on the following query you will choose between Wind River APIs and Kubernetes APIs. You will not provide that specific API, only inform if it is a Wind River or a Kubernetes API. Make sure that your response only contains the name Wind River or the name Kubernetes and nothing else.\n\nUser query: {query}"
-
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "You are an AI connected to a Wind River system and based on the user query you will define which set of APIs is best to retrieve the necessary information to answer the question."),
-        ("user", "{input}")
-    ])
-
-    output_parser = StrOutputParser()
-    chain = prompt | session["llm"] | output_parser
-    response = chain.invoke({"input": complete_query})
-
-    print(f"###########{response}")
-    if response.lower() == "kubernetes":
-        return "Kubernetes"
-    elif response.lower() == "wind river":
-        return "Wind River"
-    else:
-        return "Undefined"
-
-
 def api_response(query, session):
-    instance = define_system(query)
-    print(f'Query being made to {instance["name"]}', file=sys.stderr)
-    LOG.info(f'Query being made to {instance["name"]}')
-
-    print('Defining API pool', file=sys.stderr)
-    LOG.info('Defining API pool')
-    pool = define_api_pool(query, session)
-    print(f'LLM defined {pool} as the API subject', file=sys.stderr)
+    emit_stage("Defining the instance being asked about")
+    with span("resolve"):
+        instance, path, candidates = resolver.resolve(query)
+    if path == FANOUT_PATH:
+        return fanout_response(query, candidates)
+
+    # Names are matched locally, the LLM chooses the instance only when the
+    # match is ambiguous, together with the API pool and endpoint
+    with span("route"):
+        route = router.route(query, candidates)
+    if route is None:
+        return [{"instance": instance["name"] if instance else "", "endpoint": "Undefined",
+                 "response": CLIENT_ERROR_MSG}]
+    log_route(route, path)
+
+    bot = get_bot(session, route["pool"])
+    with span("api_request"):
+        response = bot.get_API_response(user_query=query, instance=route["instance"], completion=route["endpoint"])
+
+    # Tags of the response in the session vectorstore
+    return [{"instance": route["instance"]["name"], "endpoint": bot.endpoint or route["endpoint"],
+             "response": response}]
+
+
+async def aapi_response(query, session):
+    emit_stage("Defining the instance being asked about")
+    with span("resolve"):
+        instance, path, candidates = resolver.resolve(query)
+    if path == FANOUT_PATH:
+        return await afanout_response(query, candidates)
+
+    with span("route"):
+        route = await router.aroute(query, candidates)
+    if route is None:
+        return [{"instance": instance["name"] if instance else "", "endpoint": "Undefined",
+                 "response": CLIENT_ERROR_MSG}]
+    log_route(route, path)
+
+    bot = get_bot(session, route["pool"])
+    with span("api_request"):
+        response = await bot.aget_API_response(user_query=query, instance=route["instance"],
+                                               completion=route["endpoint"])
+
+    # Tags of the response in the session vectorstore
+    return [{"instance": route["instance"]["name"], "endpoint": bot.endpoint or route["endpoint"],
+             "response": response}]
+
+
+def log_route(route, path):
+    name = route["instance"]["name"]
+    print(f'Query being made to {name}', file=sys.stderr)
+    LOG.info(f'Query being made to {name}, resolved by {"llm" if path == AMBIGUOUS_PATH else path}')
+    emit_stage(f'Routing to {name}')
+    LOG.info(f'LLM defined {route["pool"]} as the API subject')
+    emit_stage(f'Using {route["pool"]} APIs')
+
+
+def get_bot(session, pool):
+    if pool == KUBERNETES_POOL:
+        return session["k8s_bot"]
+    return session["wr_bot"]
+
+
+def fanout_response(query, instances):
+    LOG.info(f'Query being made to {len(instances)} instances')
+    emit_stage(f'Routing to {len(instances)} instances')
+    # The API is chosen once and requested from every instance
+    with span("route"):
+        route = router.route(query, [get_fanout_model(instances)])
+    if route is None:
+        return [{"instance": FANOUT_SOURCE, "endpoint": "Undefined", "response": CLIENT_ERROR_MSG}]
+    pool, completion = route["pool"], route["endpoint"]
     LOG.info(f'LLM defined {pool} as the API subject')
-    if pool == "Kubernetes":
-        response = session["k8s_bot"].get_API_response(user_query=query, instance=instance)
-    elif pool == "Wind River":
-        response = session["wr_bot"].get_API_response(user_query=query, instance=instance)
-    else:
-        response = CLIENT_ERROR_MSG
-
-    return response
+    emit_stage(f'Calling {completion} on {len(instances)} instances')
+
+    def fetch(instance):
+        response = create_bot(pool, FANOUT_MAX_ITEMS).get_API_response(query, instance, completion)
+        if is_error_response(response):
+            raise Exception(response)
+        return response
+
+    # One context per instance, within a budget of characters
+    with span("fanout"):
+        return merge_results(FANOUT.run(instances, fetch), completion)
+
+
+async def afanout_response(query, instances):
+    LOG.info(f'Query being made to {len(instances)} instances')
+    emit_stage(f'Routing to {len(instances)} instances')
+    with span("route"):
+        route = await router.aroute(query, [get_fanout_model(instances)])
+    if route is None:
+        return [{"instance": FANOUT_SOURCE, "endpoint": "Undefined", "response": CLIENT_ERROR_MSG}]
+    pool, completion = route["pool"], route["endpoint"]
+    LOG.info(f'LLM defined {pool} as the API subject')
+    emit_stage(f'Calling {completion} on {len(instances)} instances')
 
+    async def afetch(instance):
+        # The stages of each instance are not streamed, like in the worker threads
+        EVENT_SINK.set(None)
+        response = await create_bot(pool, FANOUT_MAX_ITEMS).aget_API_response(query, instance, completion)
+        if is_error_response(response):
+            raise Exception(response)
+        return response
 
-def define_system(query):
-    # Initiate OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    # One context per instance, within a budget of characters
+    with span("fanout"):
+        return merge_results(await FANOUT.arun(instances, afetch), completion)
 
-    # Expected llm response format
-    format_response = "name: <name>"
 
-    # Create prompt
-    system_prompt = f"You are a system that choses a node in a Distributed Cloud environment. Your job is to define which of the instances given in the context, the user is asking about."
-    user_prompt = f"Make sure that only 1 is given in your response, the answer will never be more than 1 instance. If the user did not specified which instance he wants the information, you will provide the information of the instance that contains central cloud as type.\nYour answer will follow the format: {format_response}. Make sure this format is followed and nothing else is given in the your response."
+def create_bot(pool, max_items=MAX_LIST_ITEMS):
+    # Request objects keep the state of one request, so each instance gets its own
+    if pool == KUBERNETES_POOL:
+        return k8s_request(max_items)
+    return wr_request(max_items)
 
 
-    #Get completion
-    completion = client.chat.completions.create(
-            model="gpt-4-turbo-preview",
-            temperature=0.5,
-            messages=[{"role": "system", "content": system_prompt},
-                      {"role": "user", "content": f"List of available instances: {node_list}\nUser query: {query}\n\n{user_prompt}"}]
-        )
+def get_fanout_model(instances):
+    # Wind River APIs of the central cloud only must not be chosen for subclouds
+    return next((instance for instance in instances if instance["type"] == "subcloud"), instances[0])
 
-    print(f'Completion: {completion.choices[0].message.content}', file=sys.stderr)
-    name = completion.choices[0].message.content.split(":")[1].strip().replace(".", "")
-    print(f'Result after normalization: {name}', file=sys.stderr)
-    node_dict = {}
 
-    # Iterate over each key-value pair
-    for node in node_list:
-        if node['name'] == name:
-            node_dict = node
-    return node_dict
+def create_api_index():
+    try:
+        return api_index(create_embeddings())
+    except Exception as e:
+        LOG.warning(f"Could not build the Wind River API index, the whole catalog will be used: {e}")
+        return None
 
 
 def create_instance_list():
@@ -248,12 +718,14 @@ def create_instance_list():
     controller = {"name":"System Controller",
                   "URL":os.environ['OAM_IP'],
                   "type":"central cloud",
-                  "token":os.environ['TOKEN']}
+                  "token":os.environ['TOKEN'],
+                  "ca_cert":os.environ.get('OAM_CA_CERT'),
+                  "k8s_ca_cert":os.environ.get('K8S_CA_CERT')}
     instance_list.append(controller)
 
     try:
         # Load subclouds information
-        with open("src/subclouds.json", "r") as f:
+        with open(SUBCLOUDS_FILE, "r") as f:
             data = json.load(f)
 
         for item in data:
@@ -261,11 +733,18 @@ def create_instance_list():
             "name": item["name"],
             "URL": item["URL"],
             "type": "subcloud",
-            "token": item["k8s_token"]
+            "token": item["k8s_token"],
+            "aliases": item.get("aliases", []),
+            "ca_cert": item.get("ca_cert"),
+            "k8s_ca_cert": item.get("k8s_ca_cert")
             }
 
             instance_list.append(new_subcloud)
     except:
         LOG.warning("No subcloud information was added to the list of instances")
 
+    # Index of names and aliases used to resolve the instance of each query
+    global resolver
+    resolver = instance_resolver(instance_list)
+
     return instance_list
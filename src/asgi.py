@@ -0,0 +1,201 @@
+import asyncio
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from constants import INFLIGHT_QUEUE_TIMEOUT, LOG, MAX_INFLIGHT_REQUESTS
+from http_pool import ASYNC_POOLS, POOLS
+from metrics import CONTENT_TYPE, REGISTRY, format_timings, span, start_timings
+from startup import LOADER
+from token_cache import TOKENS
+
+
+class inflight_limiter():
+
+    def __init__(self, limit=MAX_INFLIGHT_REQUESTS, timeout=INFLIGHT_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self.semaphore = None
+
+
+    def start(self):
+        # The semaphore must be created inside the running event loop
+        self.semaphore = asyncio.Semaphore(self.limit)
+
+
+    async def acquire(self):
+        # Requests wait for a free slot up to the timeout before being rejected
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            LOG.warning(f"Request rejected, {self.limit} requests already in flight")
+            return False
+        return True
+
+
+    def release(self):
+        self.semaphore.release()
+
+
+    def releaser(self, callback):
+        # Releases the slot once, whichever of the stream and the response
+        # ends first: the stream is never started when the client leaves early
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                self.release()
+                callback()
+        return release
+
+
+LIMITER = inflight_limiter()
+
+
+async def get_chat():
+    # Requests received while the chatbot loads wait for it
+    if LOADER.chat is not None:
+        return LOADER.chat
+    return await run_in_threadpool(LOADER.get)
+
+
+def starting_response():
+    return PlainTextResponse("The chatbot is starting, try again later", status_code=503, headers={'Retry-After': '5'})
+
+
+async def chat_endpoint(request):
+    chat = await get_chat()
+    if chat is None:
+        return starting_response()
+    # Loaded with the chatbot, it imports LangChain
+    from streaming import astream_answer, get_content_type, get_stream_mode
+
+    body = await request.json()
+    question = body['message']
+    session_id = body['session_id']
+    # Sessions from other workers are rebuilt, which may embed their context
+    session = await run_in_threadpool(chat.get_session, session_id)
+    if session is None:
+        return PlainTextResponse("Session not found", status_code=404)
+
+    if not await LIMITER.acquire():
+        chat.unpin_session(session)
+        return PlainTextResponse("Server busy, try again later", status_code=503)
+
+    # Clients may ask for the answer to be streamed while it is generated
+    mode = get_stream_mode(request.headers)
+    if mode is not None:
+        asked = []
+
+        async def aask(query, session, callbacks=None):
+            asked.append(True)
+            return await chat.aask(query, session, callbacks)
+
+        def unpin():
+            # aask unpins the session once answered, unless it was never called
+            if not asked:
+                chat.unpin_session(session)
+
+        release = LIMITER.releaser(unpin)
+
+        async def stream():
+            try:
+                async for chunk in astream_answer(aask, question, session, mode):
+                    yield chunk
+            finally:
+                release()
+
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        return StreamingResponse(stream(), media_type=get_content_type(mode), headers=headers,
+                                 background=BackgroundTask(release))
+
+    # Stages of the answer are returned in a Server-Timing header when asked for
+    timings = start_timings(request.headers)
+    try:
+        with span("chat"):
+            answer = await chat.aask(question, session)
+    finally:
+        LIMITER.release()
+    headers = {'Server-Timing': format_timings(timings)} if timings is not None else None
+    return PlainTextResponse(answer, headers=headers)
+
+
+async def session_endpoint(request):
+    chat = await get_chat()
+    if chat is None:
+        return starting_response()
+    session_temp = request.headers['temperature']
+    session_model = request.headers['model']
+    # Optional memory policy of the chat history: buffer, window, tokens or summary
+    session_memory = request.headers.get('memory')
+    try:
+        session = await run_in_threadpool(chat.new_session, session_model, session_temp, session_memory)
+    except ValueError as e:
+        return PlainTextResponse(str(e), status_code=400)
+    return PlainTextResponse(session['id'])
+
+
+async def sessions_stats_endpoint(request):
+    chat = await get_chat()
+    if chat is None:
+        return starting_response()
+    return JSONResponse(await run_in_threadpool(chat.get_sessions_stats))
+
+
+async def caches_stats_endpoint(request):
+    chat = await get_chat()
+    if chat is None:
+        return starting_response()
+    return JSONResponse(chat.get_cache_stats())
+
+
+async def metrics_endpoint(request):
+    # Rendered in a thread, the session statistics walk every session
+    return Response(await run_in_threadpool(REGISTRY.render), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def health_endpoint(request):
+    # Liveness, the process only needs a restart when the chatbot failed to load
+    if not LOADER.is_alive():
+        return PlainTextResponse(f"Chatbot failed to load: {LOADER.error}", status_code=500)
+    return PlainTextResponse("ok")
+
+
+async def ready_endpoint(request):
+    # The backends are checked in the background, reading the status does not block
+    status = LOADER.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+def startup():
+    LIMITER.start()
+    LOADER.start()
+
+
+async def shutdown():
+    TOKENS.close()
+    # Logins and requests made in worker threads use the blocking pools
+    POOLS.close()
+    await ASYNC_POOLS.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/chat', chat_endpoint, methods=['POST']),
+        Route('/session', session_endpoint, methods=['GET']),
+        Route('/sessions/stats', sessions_stats_endpoint, methods=['GET']),
+        Route('/caches/stats', caches_stats_endpoint, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+        Route('/healthz', health_endpoint, methods=['GET']),
+        Route('/readyz', ready_endpoint, methods=['GET']),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown])
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="0.0.0.0", port=2000)
@@ -0,0 +1,177 @@
+import json
+import re
+
+from constants import COMPACTION_RULES, MAX_LIST_ITEMS, NOISY_FIELDS
+
+# sum(path), count(path)
+FUNCTION = re.compile(r"^(\w+)\((.*)\)$")
+# name, name[] or name[?key=value]
+SEGMENT = re.compile(r"^(.*?)(?:\[(.*)\])?$")
+
+FUNCTIONS = {
+    "sum": lambda values: sum(value for value in values if isinstance(value, (int, float))),
+    "count": len,
+}
+
+
+def compact_response(data, rules=COMPACTION_RULES, max_items=MAX_LIST_ITEMS):
+    # Text given to the LLM for a parsed API response
+    compactor = list_compactor(max_items=max_items, rules=rules)
+    compactor.add(data)
+    return compactor.render()
+
+
+class list_compactor():
+    # Builds the text of a list fetched in pages, keeping at most max_items
+
+    def __init__(self, max_items=MAX_LIST_ITEMS, rules=COMPACTION_RULES):
+        self.max_items = max_items
+        self.rules = rules
+
+        self.kind = None
+        self.columns = None
+        self.rows = []
+        # Text of a response that is not a list
+        self.text = None
+        self.truncated = False
+        self.remaining = None
+        self.notes = []
+
+
+    def add(self, data):
+        # Returns False once no more pages are needed
+        kind, items = get_items(data, self.rules)
+        if kind is None:
+            self.text = json.dumps(drop_noisy_fields(data), separators=(",", ":"))
+            return False
+
+        if self.kind is None:
+            self.kind = kind
+            self.columns = self.rules.get(kind)
+
+        for position, item in enumerate(items):
+            if len(self.rows) == self.max_items:
+                self.truncated = True
+                self.remaining = len(items) - position + get_remaining_items(data)
+                return False
+            self.rows.append(self.render_row(item))
+
+        # Full on a page boundary, the next pages are not fetched
+        if len(self.rows) == self.max_items and has_next_page(data):
+            self.truncated = True
+            self.remaining = get_remaining_items(data)
+            return False
+        return True
+
+
+    def add_note(self, note):
+        self.notes.append(note)
+
+
+    def render_row(self, item):
+        if self.columns is None:
+            return json.dumps(drop_noisy_fields(item), separators=(",", ":"))
+        return " | ".join(format_value(extract(item, path)) for path in self.columns.values())
+
+
+    def render(self):
+        if self.text is not None:
+            return self.text
+
+        lines = [f"{self.kind} ({len(self.rows)} items)"]
+        if self.columns is not None:
+            lines.append(" | ".join(self.columns))
+        lines += self.rows
+        if self.truncated:
+            more = f", {self.remaining} more were not retrieved" if self.remaining else ""
+            lines.append(f"The list was truncated to its first {self.max_items} items{more}.")
+        lines += self.notes
+        return "\n".join(lines)
+
+
+def get_items(data, rules):
+    if not isinstance(data, dict):
+        return None, None
+
+    # Kubernetes lists, e.g. PodList. A single object, e.g. a Pod, keeps all
+    # its details and only loses the noisy fields.
+    kind = data.get("kind", "")
+    if isinstance(data.get("items"), list):
+        return (kind[:-4] if kind.endswith("List") else kind) or "items", data["items"]
+
+    # Wind River collections with a rule, e.g. {"alarms": [...]}
+    for key, value in data.items():
+        if key in rules and isinstance(value, list):
+            return key, value
+    return None, None
+
+
+def has_next_page(data):
+    metadata = data.get("metadata") if isinstance(data, dict) else None
+    return isinstance(metadata, dict) and bool(metadata.get("continue"))
+
+
+def get_remaining_items(data):
+    # The Kubernetes API server counts the items left in the next pages
+    metadata = data.get("metadata") if isinstance(data, dict) else None
+    remaining = metadata.get("remainingItemCount") if isinstance(metadata, dict) else None
+    return remaining if isinstance(remaining, int) else 0
+
+
+def extract(item, path):
+    match = FUNCTION.match(path)
+    if match:
+        values = extract(item, match.group(2))
+        return FUNCTIONS[match.group(1)](values if isinstance(values, list) else [values])
+
+    values = [item]
+    iterated = False
+    for segment in path.split("."):
+        name, selector = SEGMENT.match(segment).groups()
+        found = []
+        for value in values:
+            if not isinstance(value, dict):
+                continue
+            if name == "*":
+                iterated = True
+                found += list(value.values())
+                continue
+
+            value = value.get(name)
+            if selector is None:
+                found.append(value)
+            elif isinstance(value, list):
+                iterated = True
+                found += filter_list(value, selector)
+        values = found
+
+    values = [value for value in values if value is not None]
+    if iterated:
+        return values
+    return values[0] if values else None
+
+
+def filter_list(values, selector):
+    if not selector.startswith("?"):
+        return values
+    key, expected = selector[1:].split("=", 1)
+    return [value for value in values if isinstance(value, dict) and str(value.get(key)) == expected]
+
+
+def format_value(value):
+    if isinstance(value, list):
+        # Repeated values, e.g. the state of each container, are shown once
+        value = ",".join(dict.fromkeys(format_value(item) for item in value if item not in (None, "")))
+    if value is None or value == "":
+        return "-"
+    if isinstance(value, dict):
+        value = json.dumps(value, separators=(",", ":"))
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+def drop_noisy_fields(data):
+    if isinstance(data, dict):
+        return {key: drop_noisy_fields(value) for key, value in data.items() if key not in NOISY_FIELDS}
+    if isinstance(data, list):
+        return [drop_noisy_fields(value) for value in data]
+    return data
@@ -1,5 +1,209 @@
+import json
 import logging
+import os
 
 CLIENT_ERROR_MSG = "No Wind River/Kubernetes API capable of answering your question was found!\nPleasy try again with another prompt."
 
-LOG = logging.getLogger("chatbot")
\ No newline at end of file
+LOG = logging.getLogger("chatbot")
+
+# Seconds before a Keystone token expires in which it will be refreshed
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN", 300))
+
+# Outbound HTTP connection pools
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 30))
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", 3))
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", 0.5))
+
+# Cluster API response cache
+RESPONSE_CACHE_DEFAULT_TTL = float(os.environ.get("RESPONSE_CACHE_DEFAULT_TTL", 30))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Time to live, in seconds, by endpoint substring. The first match is used.
+RESPONSE_CACHE_TTLS = json.loads(os.environ.get("RESPONSE_CACHE_TTLS", json.dumps({
+    "alarms": 10,
+    "event_log": 10,
+    "/events": 10,
+    "/pods": 15,
+    "/version": 600,
+    "isystems": 600,
+    "ihosts": 60,
+    "/nodes": 60,
+})))
+
+# Kubernetes namespaces left out of the API responses
+EXCLUDED_NAMESPACES = [namespace.strip() for namespace in os.environ.get(
+    "EXCLUDED_NAMESPACES", "armada,cert-manager,flux-helm,kube-system").split(",") if namespace.strip()]
+
+# Columns kept from each Kubernetes kind and Wind River collection when an API
+# response is compacted into a table. Paths are dot separated, "[]" iterates a
+# list, "[?key=value]" filters it, "*" iterates the values of an object and
+# sum() adds the values found. Rules given in COMPACTION_RULES replace the
+# default rule of the same kind.
+COMPACTION_RULES = {
+    "Pod": {
+        "NAME": "metadata.name",
+        "NAMESPACE": "metadata.namespace",
+        "PHASE": "status.phase",
+        "READY": "status.containerStatuses[].ready",
+        "RESTARTS": "sum(status.containerStatuses[].restartCount)",
+        "NODE": "spec.nodeName",
+        "REASONS": "status.containerStatuses[].state.*.reason",
+    },
+    "Node": {
+        "NAME": "metadata.name",
+        "READY": "status.conditions[?type=Ready].status",
+        "CONDITIONS": "status.conditions[?status=True].type",
+        "VERSION": "status.nodeInfo.kubeletVersion",
+        "CPU": "status.capacity.cpu",
+        "MEMORY": "status.capacity.memory",
+    },
+    "Deployment": {
+        "NAME": "metadata.name",
+        "NAMESPACE": "metadata.namespace",
+        "REPLICAS": "spec.replicas",
+        "READY": "status.readyReplicas",
+        "AVAILABLE": "status.availableReplicas",
+    },
+    "Service": {
+        "NAME": "metadata.name",
+        "NAMESPACE": "metadata.namespace",
+        "TYPE": "spec.type",
+        "CLUSTER-IP": "spec.clusterIP",
+        "PORTS": "spec.ports[].port",
+    },
+    "Namespace": {
+        "NAME": "metadata.name",
+        "STATUS": "status.phase",
+    },
+    "Event": {
+        "NAMESPACE": "metadata.namespace",
+        "TYPE": "type",
+        "REASON": "reason",
+        "OBJECT": "involvedObject.name",
+        "MESSAGE": "message",
+        "COUNT": "count",
+        "LAST SEEN": "lastTimestamp",
+    },
+    "alarms": {
+        "UUID": "uuid",
+        "ALARM ID": "alarm_id",
+        "SEVERITY": "severity",
+        "ENTITY": "entity_instance_id",
+        "REASON": "reason_text",
+        "TIMESTAMP": "timestamp",
+    },
+    "ihosts": {
+        "HOSTNAME": "hostname",
+        "PERSONALITY": "personality",
+        "ADMINISTRATIVE": "administrative",
+        "OPERATIONAL": "operational",
+        "AVAILABILITY": "availability",
+    },
+    "subclouds": {
+        "NAME": "name",
+        "MANAGEMENT": "management-state",
+        "AVAILABILITY": "availability-status",
+        "DEPLOY": "deploy-status",
+        "SYNC": "sync_status",
+    },
+}
+COMPACTION_RULES.update(json.loads(os.environ.get("COMPACTION_RULES", "{}")))
+# Items kept from a list response, the rest is left out with a note
+MAX_LIST_ITEMS = int(os.environ.get("MAX_LIST_ITEMS", 2000))
+# Items requested per page of a Kubernetes list, 0 disables pagination
+K8S_PAGE_SIZE = int(os.environ.get("K8S_PAGE_SIZE", 500))
+# Fields dropped from responses without a compaction rule
+NOISY_FIELDS = ["managedFields", "annotations", "ownerReferences", "resourceVersion", "uid", "selfLink",
+                "generation", "generateName", "terminationMessagePath", "terminationMessagePolicy"]
+
+# Subclouds known by the System Controller
+SUBCLOUDS_FILE = os.environ.get("SUBCLOUDS_FILE", "src/subclouds.json")
+
+# Questions about several instances are sent to all of them concurrently,
+# each instance has FANOUT_TIMEOUT seconds to answer
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", 32))
+FANOUT_TIMEOUT = float(os.environ.get("FANOUT_TIMEOUT", 20))
+# Each instance answering is one document of at most FANOUT_MAX_ITEMS list
+# items, all of them share FANOUT_MAX_CHARS characters of context
+FANOUT_MAX_ITEMS = int(os.environ.get("FANOUT_MAX_ITEMS", 20))
+FANOUT_MAX_CHARS = int(os.environ.get("FANOUT_MAX_CHARS", 16000))
+
+# Endpoints fetched in the background from every instance, compacted and
+# embedded in a store shared by the sessions, so common questions are answered
+# without calling the clusters, e.g. [{"pool": "Wind River", "endpoint":
+# "18002/v1/alarms"}]. Endpoints with an instance_type are only fetched from
+# instances of that type. Disabled by default.
+PREFETCH_ENDPOINTS = json.loads(os.environ.get("PREFETCH_ENDPOINTS", "[]"))
+# Seconds between the prefetches of an instance, give or take PREFETCH_JITTER
+# of it, by up to PREFETCH_WORKERS instances at a time. The interval of an
+# instance that cannot be reached doubles up to PREFETCH_MAX_BACKOFF.
+PREFETCH_INTERVAL = float(os.environ.get("PREFETCH_INTERVAL", 60))
+PREFETCH_JITTER = float(os.environ.get("PREFETCH_JITTER", 0.2))
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 4))
+PREFETCH_MAX_BACKOFF = float(os.environ.get("PREFETCH_MAX_BACKOFF", 900))
+# Prefetched responses older than this are not used to answer
+PREFETCH_MAX_AGE = float(os.environ.get("PREFETCH_MAX_AGE", 300))
+# Only the process holding the lock file prefetches, the others read its
+# responses from the database every PREFETCH_SYNC_INTERVAL seconds and take
+# over the lock when it exits. Both files are shared by the workers of one
+# node and must be on a local disk.
+PREFETCH_LOCK_PATH = os.environ.get("PREFETCH_LOCK_PATH", "prefetch.lock")
+PREFETCH_DB_PATH = os.environ.get("PREFETCH_DB_PATH", "prefetch.db")
+PREFETCH_SYNC_INTERVAL = float(os.environ.get("PREFETCH_SYNC_INTERVAL", 5))
+
+# Instance, API pool and endpoint of a query are chosen in a single LLM call
+# answering JSON, an invalid answer is sent back once to be fixed
+ROUTER_MODEL = os.environ.get("ROUTER_MODEL", "gpt-3.5-turbo")
+ROUTE_ATTEMPTS = int(os.environ.get("ROUTE_ATTEMPTS", 2))
+# Routes reused for the same normalized query
+ROUTE_CACHE_SIZE = int(os.environ.get("ROUTE_CACHE_SIZE", 1000))
+
+# Decides whether an answer had the information or the API must be asked:
+# local, llm or hybrid (local, the LLM only when it is below the confidence)
+ANSWER_GATE = os.environ.get("ANSWER_GATE", "hybrid")
+ANSWER_GATE_CONFIDENCE = float(os.environ.get("ANSWER_GATE_CONFIDENCE", 0.75))
+ANSWER_GATE_MODEL = os.environ.get("ANSWER_GATE_MODEL", "gpt-3.5-turbo")
+
+# Chat history sent with every question: buffer (all of it), window (last
+# MEMORY_WINDOW turns), tokens (last turns within MEMORY_MAX_TOKENS) or summary
+# (tokens plus a summary of the older turns of up to MEMORY_SUMMARY_TOKENS)
+MEMORY_POLICY = os.environ.get("MEMORY_POLICY", "tokens")
+MEMORY_WINDOW = int(os.environ.get("MEMORY_WINDOW", 10))
+MEMORY_MAX_TOKENS = int(os.environ.get("MEMORY_MAX_TOKENS", 2000))
+MEMORY_SUMMARY_TOKENS = int(os.environ.get("MEMORY_SUMMARY_TOKENS", 256))
+
+# Startup: lazy loads the chatbot in the background while the server answers
+# health checks, eager before serving. Requests wait up to STARTUP_WAIT
+# seconds for it to load.
+STARTUP_MODE = os.environ.get("STARTUP_MODE", "lazy")
+STARTUP_WAIT = float(os.environ.get("STARTUP_WAIT", 60))
+# Seconds between OpenAI key validations while OpenAI is unreachable
+KEY_CHECK_INTERVAL = float(os.environ.get("KEY_CHECK_INTERVAL", 30))
+# Backend reachability reported by /readyz, checked in the background every interval
+BACKEND_CHECK_INTERVAL = float(os.environ.get("BACKEND_CHECK_INTERVAL", 10))
+BACKEND_CHECK_TIMEOUT = float(os.environ.get("BACKEND_CHECK_TIMEOUT", 2))
+
+# Async server limits
+MAX_INFLIGHT_REQUESTS = int(os.environ.get("MAX_INFLIGHT_REQUESTS", 64))
+INFLIGHT_QUEUE_TIMEOUT = float(os.environ.get("INFLIGHT_QUEUE_TIMEOUT", 30))
+
+# Embedding index of the Wind River APIs catalog
+API_INDEX_DIR = os.environ.get("API_INDEX_DIR", ".api_index")
+API_INDEX_TOP_K = int(os.environ.get("API_INDEX_TOP_K", 4))
+# Minimum similarity, and distance to the second best API, to skip the LLM
+API_INDEX_CONFIDENCE = float(os.environ.get("API_INDEX_CONFIDENCE", 0.88))
+API_INDEX_MARGIN = float(os.environ.get("API_INDEX_MARGIN", 0.03))
+
+# Embeddings cache shared by every session, 10000 vectors of 1536
+# dimensions use about 60 MiB. The file store is disabled when empty.
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "")
+
+# Sessions kept in memory
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 500))
+SESSION_IDLE_TTL = float(os.environ.get("SESSION_IDLE_TTL", 3600))
+
+# Storage of the session state shared by the workers of one node
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.environ.get("SESSION_DB_PATH", "sessions.db")
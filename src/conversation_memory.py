@@ -0,0 +1,100 @@
+from typing import Any, Dict, List
+
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain_core.language_models import BaseLanguageModel
+from langchain_core.messages import BaseMessage, SystemMessage, get_buffer_string
+
+from constants import LOG, MEMORY_MAX_TOKENS, MEMORY_POLICY, MEMORY_SUMMARY_TOKENS, MEMORY_WINDOW
+
+# buffer keeps the whole conversation, the others bound the history sent on every turn
+POLICIES = ["buffer", "window", "tokens", "summary"]
+
+
+class bounded_memory(BaseChatMemory):
+    # Chat history of a session, pruned after each answer by its policy:
+    # the last turns, the last turns within a token budget, or those turns
+    # plus a rolling summary of the older ones
+
+    llm: BaseLanguageModel
+    policy: str = MEMORY_POLICY
+    max_turns: int = MEMORY_WINDOW
+    max_tokens: int = MEMORY_MAX_TOKENS
+    summary_tokens: int = MEMORY_SUMMARY_TOKENS
+    summary: str = ""
+    memory_key: str = "chat_history"
+
+    @property
+    def memory_variables(self) -> List[str]:
+        return [self.memory_key]
+
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        return {self.memory_key: self.get_history()}
+
+
+    def get_history(self):
+        messages = self.chat_memory.messages
+        if self.summary:
+            messages = [SystemMessage(content=f"Summary of the earlier conversation: {self.summary}")] + messages
+        return messages
+
+
+    def count_tokens(self, messages=None):
+        messages = self.get_history() if messages is None else messages
+        return self.llm.get_num_tokens_from_messages(messages) if messages else 0
+
+
+    def prune(self):
+        # Called once the answer is final, so a discarded exchange is never summarized
+        pruned = self.get_pruned()
+        if pruned and self.policy == "summary":
+            self.summary = self.get_summary_llm().invoke(self.get_summary_prompt(pruned)).content.strip()
+
+
+    async def aprune(self):
+        pruned = self.get_pruned()
+        if pruned and self.policy == "summary":
+            self.summary = (await self.get_summary_llm().ainvoke(self.get_summary_prompt(pruned))).content.strip()
+
+
+    def get_pruned(self):
+        messages = self.chat_memory.messages
+        if self.policy == "window":
+            keep = max(0, len(messages) - 2 * self.max_turns)
+        elif self.policy in ("tokens", "summary"):
+            # Older turns are summarized in batches, down to half of the budget,
+            # so the summary is not rewritten on every turn
+            budget = self.max_tokens // 2 if self.policy == "summary" else self.max_tokens
+            keep = 0
+            if self.count_tokens(messages) > self.max_tokens:
+                while keep < len(messages) and self.count_tokens(messages[keep:]) > budget:
+                    keep += 2
+        else:
+            keep = 0
+
+        pruned = messages[:keep]
+        self.chat_memory.messages = messages[keep:]
+        if pruned:
+            LOG.info(f"{len(pruned) // 2} turns left out of the chat history by the {self.policy} policy")
+        return pruned
+
+
+    def get_summary_llm(self):
+        return self.llm.bind(max_tokens=self.summary_tokens)
+
+
+    def get_summary_prompt(self, messages: List[BaseMessage]):
+        return SUMMARY_PROMPT.format(summary=self.summary, new_lines=get_buffer_string(messages))
+
+
+    def clear(self):
+        super().clear()
+        self.summary = ""
+
+
+def create_memory(llm, policy=None, summary=""):
+    policy = policy or MEMORY_POLICY
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown memory policy {policy}, available policies: {', '.join(POLICIES)}")
+    return bounded_memory(llm=llm, policy=policy, summary=summary, return_messages=True, output_key="answer")
@@ -0,0 +1,160 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from constants import EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_SIZE, LOG
+
+
+class embedding_cache():
+
+    def __init__(self, max_entries=EMBEDDING_CACHE_SIZE, path=EMBEDDING_CACHE_PATH):
+        # Vectors indexed by (model, sha256 of the text), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+
+        # Optional SQLite file that keeps the vectors across restarts and workers
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+            self.connection.commit()
+            LOG.info(f"Embedding cache stored in {path}")
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.evictions = 0
+
+
+    def get_key(self, model, text):
+        return f"{model}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+
+    def lookup(self, keys):
+        # Returns the vectors found, by key
+        found = {}
+        with self.lock:
+            for key in keys:
+                vector = self.entries.get(key)
+                if vector is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = vector
+            self.hits += len(found)
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.connection is not None:
+            stored = self.load(missing)
+            with self.lock:
+                self.disk_hits += len(stored)
+                for key, vector in stored.items():
+                    self.add(key, vector)
+            found.update(stored)
+
+        with self.lock:
+            self.misses += len(keys) - len(found)
+        return found
+
+
+    def load(self, keys):
+        stored = {}
+        with self.lock:
+            # SQLite limits the number of parameters of a statement
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(batch))})", batch).fetchall()
+                for key, vector in rows:
+                    stored[key] = np.frombuffer(vector, dtype=np.float32)
+        return stored
+
+
+    def store(self, vectors):
+        with self.lock:
+            self.requests += 1
+            for key, vector in vectors.items():
+                self.add(key, vector)
+
+            if self.connection is not None:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in vectors.items()])
+                self.connection.commit()
+
+
+    def add(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "requests": self.requests,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+
+class cached_embeddings(Embeddings):
+    # Embeddings looked up in the shared cache, the texts missing are embedded
+    # in a single request
+
+    def __init__(self, embeddings, cache=None):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", "")
+        self.cache = cache or EMBEDDINGS
+
+
+    def embed_documents(self, texts):
+        keys, found, missing = self.lookup(texts)
+        if missing:
+            self.store(missing, self.embeddings.embed_documents(list(missing.values())), found)
+        return [found[key].tolist() for key in keys]
+
+
+    async def aembed_documents(self, texts):
+        keys, found, missing = self.lookup(texts)
+        if missing:
+            self.store(missing, await self.embeddings.aembed_documents(list(missing.values())), found)
+        return [found[key].tolist() for key in keys]
+
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+    def lookup(self, texts):
+        keys = [self.cache.get_key(self.model, text) for text in texts]
+        found = self.cache.lookup(list(dict.fromkeys(keys)))
+        # Texts repeated in the same call are embedded once
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        return keys, found, missing
+
+
+    def store(self, missing, vectors, found):
+        embedded = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(missing, vectors)}
+        self.cache.store(embedded)
+        found.update(embedded)
+
+
+# Embedding cache shared by every session
+EMBEDDINGS = embedding_cache()
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from constants import FANOUT_MAX_CHARS, FANOUT_TIMEOUT, FANOUT_WORKERS, LOG
+
+# Instance of the summary of a fan-out in the session context
+FANOUT_SOURCE = "fan-out"
+# Characters of context below which the response of an instance is reduced to
+# one line, and maximum length of that line
+MIN_INSTANCE_CHARS = 200
+SUMMARY_LINE_CHARS = 80
+
+OK_STATUS = "ok"
+ERROR_STATUS = "error"
+TIMEOUT_STATUS = "timeout"
+
+
+class fanout_pool():
+
+    def __init__(self, workers=FANOUT_WORKERS, timeout=FANOUT_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = None
+        self.lock = threading.Lock()
+        # Created on the first asynchronous fan-out, in the event loop of the server
+        self.semaphore = None
+
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="fanout")
+            return self.executor
+
+
+    def run(self, instances, fetch):
+        # Calls fetch(instance) for every instance in the worker pool, each call
+        # has timeout seconds from the moment it starts
+        started = {}
+
+        def call(instance):
+            started[instance["name"]] = time.monotonic()
+            return fetch(instance)
+
+        futures = {self.get_executor().submit(call, instance): instance for instance in instances}
+        results = {}
+        pending = set(futures)
+        while pending:
+            now = time.monotonic()
+            deadlines = [started[futures[future]["name"]] + self.timeout
+                         for future in pending if futures[future]["name"] in started]
+            done, pending = wait(pending, timeout=max(0, min(deadlines, default=now + self.timeout) - now),
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                instance = futures[future]
+                try:
+                    results[instance["name"]] = (instance, OK_STATUS, future.result())
+                except Exception as e:
+                    results[instance["name"]] = (instance, ERROR_STATUS, str(e))
+
+            now = time.monotonic()
+            for future in list(pending):
+                instance = futures[future]
+                if instance["name"] in started and started[instance["name"]] + self.timeout <= now:
+                    # The thread finishes on its own, bounded by the HTTP timeouts
+                    pending.discard(future)
+                    results[instance["name"]] = (instance, TIMEOUT_STATUS, None)
+
+        return [results[instance["name"]] for instance in instances]
+
+
+    async def arun(self, instances, afetch):
+        # Same as run, with afetch being a coroutine function
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+
+        async def call(instance):
+            async with self.semaphore:
+                try:
+                    return instance, OK_STATUS, await asyncio.wait_for(afetch(instance), self.timeout)
+                except asyncio.TimeoutError:
+                    return instance, TIMEOUT_STATUS, None
+                except Exception as e:
+                    return instance, ERROR_STATUS, str(e)
+
+        return await asyncio.gather(*[call(instance) for instance in instances])
+
+
+def merge_results(results, endpoint, max_chars=FANOUT_MAX_CHARS):
+    # Context of each instance answering, tagged by its name, after a summary
+    # listing the instances that failed, timed out or were truncated, and the
+    # one line summary of those that did not fit
+    answered = [(instance, response) for instance, status, response in results if status == OK_STATUS]
+    failed = [instance["name"] for instance, status, _ in results if status == ERROR_STATUS]
+    timed_out = [instance["name"] for instance, status, _ in results if status == TIMEOUT_STATUS]
+
+    summary = f"Responses of {len(results)} instances to {endpoint}, {len(answered)} answered"
+    if failed:
+        summary += f", {len(failed)} failed: {format_names(failed)}"
+    if timed_out:
+        summary += f", {len(timed_out)} timed out: {format_names(timed_out)}"
+    LOG.info(summary)
+    notes = [summary + "."]
+
+    # Every instance gets the same share of the context, down to a minimum, and
+    # the characters short responses leave go to the others. Past the minimum
+    # the last instances are reduced to one line each, never dropped.
+    texts = [f"[{instance['name']}] {response}" for instance, response in answered]
+    lines = [summarize(instance["name"], response) for instance, response in answered]
+    kept = len(texts)
+    while kept > 0 and (sum(min(len(text), MIN_INSTANCE_CHARS) for text in texts[:kept]) +
+                        sum(len(line) + 1 for line in lines[kept:])) > max_chars:
+        kept -= 1
+    summarized = lines[kept:]
+    shares = get_shares([len(text) for text in texts[:kept]], max_chars - sum(len(line) + 1 for line in summarized))
+    contexts = []
+    truncated = []
+    for position, ((instance, _), text, share) in enumerate(zip(answered, texts, shares), 1):
+        if len(text) > share:
+            text = truncate(text, share)
+            truncated.append(instance["name"])
+        contexts.append({"instance": instance["name"], "endpoint": endpoint, "response": text,
+                         "fanout": endpoint, "position": position})
+
+    if truncated:
+        notes.append(f"The responses of {len(truncated)} instances were truncated to fit the context: "
+                     f"{format_names(truncated)}. Ask about one of them for its whole response.")
+    if summarized:
+        notes.append(f"The responses of {len(summarized)} instances that answered were reduced to one line "
+                     f"to fit the context, ask about one of them for its whole response:\n" + "\n".join(summarized))
+    summary = {"instance": FANOUT_SOURCE, "endpoint": endpoint, "response": " ".join(notes),
+               "fanout": endpoint, "position": 0}
+    return [summary] + contexts
+
+
+def get_shares(lengths, budget):
+    # Characters of each text, the shortest ones are kept whole and the rest of
+    # the budget is split evenly between the longer ones
+    shares = [0] * len(lengths)
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for count, i in enumerate(order):
+        shares[i] = min(lengths[i], max(0, budget) // (len(order) - count))
+        budget -= shares[i]
+    return shares
+
+
+def summarize(name, response):
+    # First line of the response, e.g. "pods (20 items)", or its length
+    text = str(response).strip()
+    if not text:
+        return f"[{name}] empty"
+    # Without the "Wind River API response from <name> = " prefix, the tag
+    # already names the instance
+    line = text.split("\n", 1)[0].split(" = ", 1)[-1]
+    if len(line) > SUMMARY_LINE_CHARS:
+        line = f"{len(text)} characters"
+    return f"[{name}] {line}"
+
+
+def truncate(text, length):
+    # Cut on a line break when there is one, so no list item is cut in half.
+    # The note added fits in the length too.
+    length = max(0, length - len(f"\n[Truncated, {len(text)} more characters]"))
+    cut = text.rfind("\n", 0, length)
+    if cut <= 0:
+        cut = length
+    return text[:cut] + f"\n[Truncated, {len(text) - cut} more characters]"
+
+
+def format_names(names, limit=20):
+    if len(names) <= limit:
+        return ", ".join(names)
+    return ", ".join(names[:limit]) + f" and {len(names) - limit} more"
+
+
+# Worker pool shared by every fan-out query
+FANOUT = fanout_pool()
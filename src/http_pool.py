@@ -0,0 +1,160 @@
+import asyncio
+import ssl
+import threading
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from constants import (HTTP_BACKOFF, HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE,
+                       HTTP_READ_TIMEOUT, HTTP_RETRIES, LOG)
+from metrics import record_http
+
+
+class http_pool():
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        # Keep-alive sessions indexed by (host, CA bundle)
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+
+    def get(self, url, ca_cert=None, **kwargs):
+        # verify is passed on each request, REQUESTS_CA_BUNDLE would override it otherwise
+        session = self.get_session(url, ca_cert)
+        return self.send(session.get, url, verify=session.verify, **kwargs)
+
+
+    def post(self, url, ca_cert=None, **kwargs):
+        session = self.get_session(url, ca_cert)
+        return self.send(session.post, url, verify=session.verify, **kwargs)
+
+
+    def send(self, method, url, **kwargs):
+        # Status of every outbound request, after retries, for the metrics
+        try:
+            response = method(url, timeout=self.timeout, **kwargs)
+        except Exception:
+            record_http(url, "error")
+            raise
+        record_http(url, response.status_code)
+        return response
+
+
+    def get_session(self, url, ca_cert=None):
+        key = (urlparse(url).hostname, ca_cert)
+        session = self.sessions.get(key)
+        if session is not None:
+            return session
+
+        with self.lock:
+            if key not in self.sessions:
+                self.sessions[key] = self.create_session(ca_cert)
+                LOG.info(f"New HTTP connection pool for {key[0]}")
+            return self.sessions[key]
+
+
+    def create_session(self, ca_cert):
+        # Only idempotent GETs are retried, with exponential backoff
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_size,
+            pool_maxsize=self.pool_size,
+            max_retries=retry)
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        # Pin the instance CA bundle when one is configured
+        session.verify = ca_cert if ca_cert else False
+        return session
+
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+class async_http_pool():
+
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        # Keep-alive async clients indexed by (host, CA bundle)
+        self.clients = {}
+
+        self.pool_size = pool_size
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+
+    async def get(self, url, ca_cert=None, **kwargs):
+        client = self.get_client(url, ca_cert)
+
+        # Only idempotent GETs are retried, with exponential backoff
+        for attempt in range(self.retries + 1):
+            try:
+                response = await client.get(url, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    record_http(url, "error")
+                    raise
+            else:
+                if response.status_code not in (502, 503, 504) or attempt == self.retries:
+                    record_http(url, response.status_code)
+                    return response
+            await asyncio.sleep(self.backoff * (2 ** attempt))
+
+
+    async def post(self, url, ca_cert=None, **kwargs):
+        try:
+            response = await self.get_client(url, ca_cert).post(url, **kwargs)
+        except Exception:
+            record_http(url, "error")
+            raise
+        record_http(url, response.status_code)
+        return response
+
+
+    def get_client(self, url, ca_cert=None):
+        key = (urlparse(url).hostname, ca_cert)
+        if key not in self.clients:
+            self.clients[key] = self.create_client(ca_cert)
+            LOG.info(f"New async HTTP connection pool for {key[0]}")
+        return self.clients[key]
+
+
+    def create_client(self, ca_cert):
+        limits = httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size)
+
+        # Pin the instance CA bundle when one is configured
+        verify = ssl.create_default_context(cafile=ca_cert) if ca_cert else False
+        return httpx.AsyncClient(limits=limits, timeout=self.timeout, verify=verify)
+
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+
+# Connection pools shared by every session for the whole process
+POOLS = http_pool()
+ASYNC_POOLS = async_http_pool()
@@ -0,0 +1,140 @@
+import difflib
+import re
+
+from constants import LOG
+
+# Ways users refer to the System Controller besides its name
+CONTROLLER_ALIASES = ["system controller", "systemcontroller", "central cloud", "central controller"]
+
+# Words that indicate a subcloud is being asked about even without its name
+SUBCLOUD_WORDS = {"subcloud", "subclouds", "site", "sites"}
+# Words that, with a subcloud word, ask about every subcloud
+FANOUT_WORDS = {"subclouds", "sites", "all", "every", "each", "which", "any"}
+# Words that, in a question starting with "where", ask about every instance
+EVERYWHERE_WORDS = {"all", "every", "each", "any", "anywhere", "everywhere", "instances", "clusters"}
+
+EXACT_PATH = "exact"
+FUZZY_PATH = "fuzzy"
+DEFAULT_PATH = "default"
+AMBIGUOUS_PATH = "ambiguous"
+FANOUT_PATH = "fanout"
+
+
+def normalize(text):
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text.lower()).split())
+
+
+class instance_resolver():
+
+    def __init__(self, instances, fuzzy_cutoff=0.85, fuzzy_margin=0.04):
+        self.instances = instances
+        self.controller = next((i for i in instances if i["type"] == "central cloud"), instances[0])
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.fuzzy_margin = fuzzy_margin
+
+        # Normalized names and aliases pointing to their instance
+        self.index = {}
+        for instance in instances:
+            aliases = [instance["name"]] + instance.get("aliases", [])
+            if instance is self.controller:
+                aliases += CONTROLLER_ALIASES
+            for alias in aliases:
+                self.add_alias(alias, instance)
+
+        self.max_words = max(len(alias.split()) for alias in self.index)
+
+
+    def add_alias(self, alias, instance):
+        normalized = normalize(alias)
+        if not normalized:
+            return
+        # subcloud_1, subcloud-1 and subcloud1 are the same name
+        for key in (normalized, normalized.replace(" ", "")):
+            owner = self.index.setdefault(key, instance)
+            if owner is not instance:
+                LOG.warning(f"Alias {alias} is used by {owner['name']} and {instance['name']}")
+
+
+    def resolve(self, query):
+        # Returns the instance, the path used to find it and the candidates when ambiguous
+        words = normalize(query).split()
+        ngrams = self.get_ngrams(words)
+
+        matches = self.unique([self.index[ngram] for ngram in ngrams if ngram in self.index])
+        if len(matches) == 1:
+            return matches[0], EXACT_PATH, matches
+        if len(matches) > 1:
+            # Every instance named is queried
+            return None, FANOUT_PATH, matches
+
+        fuzzy_matches = self.get_fuzzy_matches(words)
+        if len(fuzzy_matches) == 1:
+            return fuzzy_matches[0][1], FUZZY_PATH, [fuzzy_matches[0][1]]
+        if len(fuzzy_matches) > 1:
+            # Typos are resolved locally only when one name is clearly closer
+            if fuzzy_matches[0][0] - fuzzy_matches[1][0] >= self.fuzzy_margin:
+                return fuzzy_matches[0][1], FUZZY_PATH, [fuzzy_matches[0][1]]
+            return None, AMBIGUOUS_PATH, [instance for _, instance in fuzzy_matches]
+
+        # e.g. "which subclouds have critical alarms?"
+        subclouds = [instance for instance in self.instances if instance is not self.controller]
+        if SUBCLOUD_WORDS.intersection(ngrams) and FANOUT_WORDS.intersection(ngrams) and subclouds:
+            return None, FANOUT_PATH, subclouds
+        # e.g. "where, in any instance, is pod X failing?", without it the
+        # question is about the System Controller
+        if ngrams and ngrams[0] == "where" and EVERYWHERE_WORDS.intersection(ngrams) and subclouds:
+            return None, FANOUT_PATH, self.instances
+
+        # A subcloud is mentioned but could not be identified by its name
+        if SUBCLOUD_WORDS.intersection(ngrams) and len(self.instances) > 1:
+            return None, AMBIGUOUS_PATH, self.instances
+
+        return self.controller, DEFAULT_PATH, [self.controller]
+
+
+    def get_fuzzy_matches(self, words):
+        # Best similarity score of each instance, highest first. Word groups
+        # with a subcloud word are left out: "a subcloud" is close to the name
+        # of every subcloud, and is resolved by the subcloud rules instead.
+        ngrams = []
+        for ngram_words in self.get_word_groups(words):
+            if not SUBCLOUD_WORDS.intersection(ngram_words):
+                ngrams += self.join_words(ngram_words)
+
+        scores = {}
+        for ngram in ngrams:
+            for alias in difflib.get_close_matches(ngram, self.index.keys(), n=3, cutoff=self.fuzzy_cutoff):
+                score = difflib.SequenceMatcher(None, ngram, alias).ratio()
+                instance = self.index[alias]
+                best = scores.get(id(instance), (0, instance))
+                scores[id(instance)] = max(best, (score, instance), key=lambda match: match[0])
+        return sorted(scores.values(), key=lambda match: match[0], reverse=True)
+
+
+    def get_ngrams(self, words):
+        ngrams = []
+        for ngram_words in self.get_word_groups(words):
+            ngrams += self.join_words(ngram_words)
+        return ngrams
+
+
+    def get_word_groups(self, words):
+        groups = []
+        for size in range(1, self.max_words + 1):
+            for start in range(len(words) - size + 1):
+                groups.append(words[start:start + size])
+        return groups
+
+
+    def join_words(self, words):
+        if len(words) > 1:
+            return [" ".join(words), "".join(words)]
+        return [" ".join(words)]
+
+
+    def unique(self, instances):
+        found = []
+        for instance in instances:
+            if not any(instance is other for other in found):
+                found.append(instance)
+        return found
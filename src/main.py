@@ -1,40 +1,123 @@
+import atexit
+
 from flask import Flask, Response, request
 from flask_restful import Api, Resource
-import app as chat
+from http_pool import POOLS
+from metrics import CONTENT_TYPE, REGISTRY, format_timings, span, start_timings
+from startup import LOADER
+from token_cache import TOKENS
 
 
 app = Flask(__name__)
 api = Api(app)
 
 
+def starting_response():
+    # Requests received while the chatbot loads wait for it up to STARTUP_WAIT
+    return Response("The chatbot is starting, try again later", status=503, headers={'Retry-After': '5'})
+
+
 class Chat(Resource):
     def post(self):
+        chat = LOADER.get()
+        if chat is None:
+            return starting_response()
+        # Loaded with the chatbot, it imports LangChain
+        from streaming import get_content_type, get_stream_mode, stream_answer
+
         question = request.json['message']
         session_id = request.json['session_id']
         session = chat.get_session(session_id)
         if session is None:
             return Response("Session not found", status=404)
 
-        answer = chat.ask(question, session)
+        # Clients may ask for the answer to be streamed while it is generated
+        mode = get_stream_mode(request.headers)
+        if mode is not None:
+            response = Response(stream_answer(chat.ask, question, session, mode), content_type=get_content_type(mode))
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+            return response
+
+        # Stages of the answer are returned in a Server-Timing header when asked for
+        timings = start_timings(request.headers)
+        with span("chat"):
+            answer = chat.ask(question, session)
         response = Response(answer,content_type="text/plain; charset=utf-8" )
+        if timings is not None:
+            response.headers['Server-Timing'] = format_timings(timings)
         return response
 
 
 class Session(Resource):
     def get(self):
+        chat = LOADER.get()
+        if chat is None:
+            return starting_response()
         session_temp = request.headers['temperature']
         session_model = request.headers['model']
-        session = chat.new_session(session_model, session_temp)
+        # Optional memory policy of the chat history: buffer, window, tokens or summary
+        session_memory = request.headers.get('memory')
+        try:
+            session = chat.new_session(session_model, session_temp, session_memory)
+        except ValueError as e:
+            return Response(str(e), status=400)
 
         response = Response(session['id'],content_type="text/plain; charset=utf-8" )
         return response
 
 
+class SessionsStats(Resource):
+    def get(self):
+        chat = LOADER.get()
+        if chat is None:
+            return starting_response()
+        return chat.get_sessions_stats()
+
+
+class CachesStats(Resource):
+    def get(self):
+        chat = LOADER.get()
+        if chat is None:
+            return starting_response()
+        return chat.get_cache_stats()
+
+
+class Metrics(Resource):
+    def get(self):
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
+class Health(Resource):
+    def get(self):
+        # Liveness, the process only needs a restart when the chatbot failed to load
+        if not LOADER.is_alive():
+            return Response(f"Chatbot failed to load: {LOADER.error}", status=500)
+        return Response("ok", content_type="text/plain; charset=utf-8")
+
+
+class Ready(Resource):
+    def get(self):
+        status = LOADER.status()
+        return status, 200 if status["ready"] else 503
+
+
 api.add_resource(Chat, '/chat')
 api.add_resource(Session, '/session')
+api.add_resource(SessionsStats, '/sessions/stats')
+api.add_resource(CachesStats, '/caches/stats')
+api.add_resource(Metrics, '/metrics')
+api.add_resource(Health, '/healthz')
+api.add_resource(Ready, '/readyz')
+
+
+def create_app():
+    # Entry point for WSGI servers, e.g. gunicorn -w 4 'main:create_app()'
+    LOADER.start()
+    atexit.register(TOKENS.close)
+    atexit.register(POOLS.close)
+    return app
 
 
 if __name__ == "__main__":
-    chat.set_openai_key()
-    chat.initiate_sessions()
-    app.run(host="0.0.0.0", port=2000)
+    create_app().run(host="0.0.0.0", port=2000)
@@ -0,0 +1,157 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+# Latency buckets, in seconds, of the stage histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Stages timed while serving the request of the current context, None when
+# the request did not ask for its timings
+TIMINGS = contextvars.ContextVar("timings", default=None)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class counter():
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+    def render(self):
+        with self.lock:
+            samples = dict(self.values)
+        return format_metric(self.name, "counter", self.help, self.labels, samples)
+
+
+class histogram():
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # Per label values: observations of each bucket, the last one is +Inf, and their sum
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            counts, total = self.values.get(label_values, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[label_values] = (counts, total + value)
+
+
+    def render(self):
+        with self.lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self.values.items()}
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(values.items()):
+            labels = list(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(labels + [('le', str(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class registry():
+
+    def __init__(self):
+        self.metrics = []
+        # Functions returning the exposition lines of values kept elsewhere, read on every scrape
+        self.collectors = []
+
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def add_collector(self, collector):
+        if collector not in self.collectors:
+            self.collectors.append(collector)
+
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for collector in self.collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = registry()
+STAGE_SECONDS = REGISTRY.add(histogram(
+    "chatbot_stage_seconds", "Latency of each stage of answering a question", ["stage"]))
+HTTP_REQUESTS = REGISTRY.add(counter(
+    "chatbot_http_requests_total", "Outbound HTTP requests by target and status", ["target", "status"]))
+LLM_TOKENS = REGISTRY.add(counter(
+    "chatbot_llm_tokens_total", "Tokens sent to and generated by OpenAI", ["model", "type"]))
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage)
+        timings = TIMINGS.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def start_timings(headers):
+    # The breakdown is only kept when the client asks for it with a timing header
+    timings = [] if headers.get("timing") else None
+    TIMINGS.set(timings)
+    return timings
+
+
+def format_timings(timings):
+    # Server-Timing header, durations in milliseconds in the order the stages ended
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings)
+
+
+def record_http(url, status):
+    HTTP_REQUESTS.inc(urlsplit(url).netloc, str(status))
+
+
+def record_tokens(model, prompt=0, completion=0):
+    if prompt:
+        LLM_TOKENS.inc(model, "prompt", amount=prompt)
+    if completion:
+        LLM_TOKENS.inc(model, "completion", amount=completion)
+
+
+def format_metric(name, kind, help, label_names, samples):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for label_values, value in sorted(samples.items()):
+        lines.append(f"{name}{format_labels(list(zip(label_names, label_values)))} {value}")
+    return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
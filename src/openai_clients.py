@@ -0,0 +1,60 @@
+import os
+import threading
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from metrics import record_http, record_tokens
+
+# OpenAI clients shared by every session and request object, by API key, so
+# their connections and TLS contexts are created once and never closed while
+# other requests are in flight
+clients = {}
+async_clients = {}
+lock = threading.Lock()
+
+
+def get_client(api_key):
+    with lock:
+        if api_key not in clients:
+            http_client = DefaultHttpxClient(event_hooks={"response": [record_response]})
+            clients[api_key] = OpenAI(api_key=api_key, base_url=os.environ.get("OPENAI_API_BASE"),
+                                      http_client=http_client)
+        return clients[api_key]
+
+
+def get_async_client(api_key):
+    with lock:
+        if api_key not in async_clients:
+            http_client = DefaultAsyncHttpxClient(event_hooks={"response": [arecord_response]})
+            async_clients[api_key] = AsyncOpenAI(api_key=api_key, base_url=os.environ.get("OPENAI_API_BASE"),
+                                                 http_client=http_client)
+        return async_clients[api_key]
+
+
+def record_response(response):
+    # Streamed responses do not report their usage, it is counted by the
+    # callbacks of the streaming LLM
+    record_http(str(response.request.url), response.status_code)
+    if is_json(response):
+        response.read()
+        record_usage(response)
+
+
+async def arecord_response(response):
+    record_http(str(response.request.url), response.status_code)
+    if is_json(response):
+        await response.aread()
+        record_usage(response)
+
+
+def is_json(response):
+    return response.status_code == 200 and response.headers.get("content-type", "").startswith("application/json")
+
+
+def record_usage(response):
+    try:
+        body = response.json()
+        usage = body.get("usage") or {}
+        record_tokens(body.get("model", ""), usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    except ValueError:
+        pass
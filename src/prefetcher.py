@@ -0,0 +1,272 @@
+import fcntl
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from constants import (LOG, PREFETCH_DB_PATH, PREFETCH_ENDPOINTS, PREFETCH_INTERVAL, PREFETCH_JITTER,
+                       PREFETCH_LOCK_PATH, PREFETCH_MAX_AGE, PREFETCH_MAX_BACKOFF, PREFETCH_SYNC_INTERVAL,
+                       PREFETCH_WORKERS)
+from metrics import span
+
+
+class prefetcher():
+    # Fetches the endpoints of every instance in the background, each instance
+    # on its own jittered schedule so they are not all requested at once
+
+    def __init__(self, endpoints=PREFETCH_ENDPOINTS, interval=PREFETCH_INTERVAL, jitter=PREFETCH_JITTER,
+                 workers=PREFETCH_WORKERS, max_backoff=PREFETCH_MAX_BACKOFF):
+        self.endpoints = endpoints
+        self.interval = interval
+        self.jitter = jitter
+        self.workers = workers
+        self.max_backoff = max_backoff
+
+        # Schedule of each instance, by name
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.executor = None
+
+        self.fetches = 0
+        self.errors = 0
+
+
+    def is_enabled(self):
+        return bool(self.endpoints) and self.interval > 0
+
+
+    def start(self, instances, fetch, publish):
+        # fetch(instance, pool, endpoint) returns the response and its source,
+        # publish(response, source) stores them
+        if not self.is_enabled():
+            return
+        self.fetch = fetch
+        self.publish = publish
+
+        with self.condition:
+            now = time.monotonic()
+            # The first round starts at once, bounded by the workers
+            self.jobs = {instance["name"]: {"instance": instance, "next_at": now,
+                                            "failures": 0, "running": False, "refreshed_at": None}
+                         for instance in instances}
+            if self.thread is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prefetch")
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        LOG.info(f"Prefetching {len(self.endpoints)} endpoints from {len(instances)} instances "
+                 f"every {self.interval:.0f}s")
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                waiting = [job for job in self.jobs.values() if not job["running"]]
+                due = [job for job in waiting if job["next_at"] <= now]
+                if not due:
+                    self.condition.wait(min((job["next_at"] for job in waiting), default=now + self.interval) - now)
+                    continue
+                for job in due:
+                    job["running"] = True
+
+            # Instances wait in the executor queue when every worker is busy
+            for job in due:
+                self.executor.submit(self.refresh, job)
+
+
+    def refresh(self, job):
+        instance = job["instance"]
+        endpoints = self.get_endpoints(instance)
+        failed = 0
+        for entry in endpoints:
+            try:
+                with span("prefetch"):
+                    self.publish(*self.fetch(instance, entry["pool"], entry["endpoint"]))
+            except Exception as e:
+                LOG.warning(f"Could not prefetch {entry['endpoint']} from {instance['name']}: {e}")
+                failed += 1
+
+        with self.condition:
+            self.fetches += len(endpoints)
+            self.errors += failed
+            job["running"] = False
+            job["refreshed_at"] = time.monotonic()
+            # An instance none of whose endpoints answered is probably unreachable
+            if endpoints and failed == len(endpoints):
+                job["failures"] += 1
+                delay = min(self.interval * 2 ** job["failures"], self.max_backoff)
+                LOG.warning(f"Prefetch of {instance['name']} failed {job['failures']} times, "
+                            f"next attempt in {delay:.0f}s")
+            else:
+                job["failures"] = 0
+                delay = self.interval
+            job["next_at"] = job["refreshed_at"] + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self.condition.notify()
+
+
+    def get_endpoints(self, instance):
+        return [entry for entry in self.endpoints
+                if entry.get("instance_type") in (None, instance["type"])]
+
+
+    def stats(self):
+        with self.condition:
+            return {
+                "instances": len(self.jobs),
+                "refreshed_instances": sum(job["refreshed_at"] is not None for job in self.jobs.values()),
+                "backing_off_instances": sum(job["failures"] > 0 for job in self.jobs.values()),
+                "fetches": self.fetches,
+                "errors": self.errors,
+            }
+
+
+class prefetch_leader():
+    # Only one process of the node prefetches: the one holding an exclusive
+    # lock on the lock file. It saves its responses in a SQLite database the
+    # other processes copy into their own store, until one of them gets the
+    # lock when the leader exits. Both files must be on a local disk, file
+    # locks are not reliable on network filesystems.
+
+    def __init__(self, lock_path=PREFETCH_LOCK_PATH, db_path=PREFETCH_DB_PATH, interval=PREFETCH_SYNC_INTERVAL):
+        self.lock_path = lock_path
+        self.db_path = db_path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.lock_file = None
+        self.connection = None
+
+        # Sequence of the last response copied, a saved response gets the next one
+        self.synced_sequence = 0
+        self.synced = 0
+
+
+    def is_leader(self):
+        return self.lock_file is not None
+
+
+    def start(self, lead, publish):
+        # lead() starts prefetching once this process holds the lock,
+        # publish(response, source) stores a response saved by the leader
+        self.lead = lead
+        self.publish = publish
+
+        self.connection = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        # Rollback journal, databases created in WAL mode are converted back
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS prefetched (sequence INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "instance TEXT NOT NULL, endpoint TEXT NOT NULL, response TEXT NOT NULL, fetched_at REAL NOT NULL, "
+            "UNIQUE (instance, endpoint))")
+        self.connection.commit()
+
+        if not self.elect():
+            LOG.info(f"Another process holds {self.lock_path}, its prefetched responses are read every "
+                     f"{self.interval:.0f}s")
+            threading.Thread(target=self.follow, daemon=True).start()
+
+
+    def elect(self):
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Released by the operating system when the process exits
+        self.lock_file = lock_file
+        LOG.info(f"Prefetching in this process, it holds {self.lock_path}")
+        # Responses of the previous leader are used until they are too old
+        self.sync()
+        self.lead()
+        return True
+
+
+    def follow(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sync()
+            except Exception as e:
+                LOG.warning(f"Could not read the prefetched responses: {e}")
+            if self.elect():
+                return
+
+
+    def save(self, response, source):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO prefetched (instance, endpoint, response, fetched_at) VALUES (?, ?, ?, ?)",
+                (source["instance"], source["endpoint"], response, source["fetched_at"]))
+            self.connection.commit()
+
+
+    def sync(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT sequence, instance, endpoint, response, fetched_at FROM prefetched WHERE sequence > ? "
+                "ORDER BY sequence", (self.synced_sequence, )).fetchall()
+        for sequence, instance, endpoint, response, fetched_at in rows:
+            self.publish(response, {"instance": instance, "endpoint": endpoint, "fetched_at": fetched_at})
+            self.synced_sequence = sequence
+            self.synced += 1
+
+
+    def stats(self):
+        return {"leader": self.is_leader(), "synced": self.synced}
+
+
+class prefetch_store():
+    # Vectorstore of the prefetched responses, shared by every session. Chroma
+    # is not safe to write while it is read, so both hold the lock.
+
+    def __init__(self, vectorstore, max_age=PREFETCH_MAX_AGE):
+        self.vectorstore = vectorstore
+        self.max_age = max_age
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def publish(self, upsert, docs, metadata):
+        with self.lock:
+            return upsert(self.vectorstore, docs, metadata)
+
+
+    def search(self, query, instances, k=1):
+        # Documents of the given instances fetched at most max_age seconds ago,
+        # with their relevance scores
+        conditions = [{"fetched_at": {"$gte": time.time() - self.max_age}}]
+        if len(instances) == 1:
+            conditions.append({"instance": instances[0]["name"]})
+        else:
+            conditions.append({"$or": [{"instance": instance["name"]} for instance in instances]})
+        with self.lock:
+            return self.vectorstore.similarity_search_with_relevance_scores(query, k=k, filter={"$and": conditions})
+
+
+    def record(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "chunks": self.vectorstore._collection.count(),
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+# Prefetcher of this process, started with the sessions when it is the leader
+PREFETCHER = prefetcher()
+PREFETCH_LEADER = prefetch_leader()
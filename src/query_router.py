@@ -0,0 +1,253 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from constants import LOG, ROUTE_ATTEMPTS, ROUTE_CACHE_SIZE, ROUTER_MODEL
+from instance_resolver import normalize
+from openai_clients import get_async_client, get_client
+
+KUBERNETES_POOL = "Kubernetes"
+WIND_RIVER_POOL = "Wind River"
+POOLS = [KUBERNETES_POOL, WIND_RIVER_POOL]
+
+# Words of questions about Kubernetes resources, never routed by the index of
+# the Wind River APIs alone
+KUBERNETES_WORDS = {"kubernetes", "k8s", "pod", "pods", "container", "containers", "deployment", "deployments",
+                    "service", "services", "namespace", "namespaces", "replicaset", "replicasets", "daemonset",
+                    "daemonsets", "statefulset", "statefulsets", "configmap", "configmaps", "secret", "secrets",
+                    "job", "jobs", "cronjob", "cronjobs", "ingress", "ingresses", "pvc", "pvcs", "helm"}
+
+# Expected llm response format
+ROUTE_FORMAT = '{"instance": "<name>", "pool": "Kubernetes" or "Wind River", "endpoint": "<endpoint>"}'
+
+
+class query_router():
+    # Chooses the instance, the API pool and the endpoint of a query in a
+    # single LLM call, routes are reused for the same normalized query
+
+    def __init__(self, api_key, index=None, catalog_path="wr_apis.json", model=ROUTER_MODEL,
+                 attempts=ROUTE_ATTEMPTS, max_entries=ROUTE_CACHE_SIZE):
+        self.api_key = api_key
+        self.model = model
+        self.attempts = attempts
+
+        # Embedding index used to send only the relevant Wind River APIs to the LLM
+        self.index = index
+        with open(catalog_path, "r") as f:
+            self.apis = json.load(f)["APIs"]
+        # Wind River endpoints accepted, <parameters> match any path segment
+        self.patterns = [re.compile(re.sub(r"<[^>]+>", r"[^/?]+", re.escape(api["url"])) + r"(\?.*)?$")
+                         for api in self.apis]
+
+        # Routes by (normalized query, candidate names), least recently used first
+        self.routes = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+
+    def route(self, query, candidates):
+        # Returns {"instance", "pool", "endpoint"}, None when no valid route was given
+        key = self.get_key(query, candidates)
+        route = self.lookup(key, candidates)
+        if route is not None:
+            return route
+
+        ranking = self.get_ranking(query, candidates)
+        route = self.select(query, ranking, candidates)
+        if route is None:
+            route = self.complete(self.get_messages(query, candidates, ranking), candidates)
+        self.store(key, route)
+        return route
+
+
+    async def aroute(self, query, candidates):
+        key = self.get_key(query, candidates)
+        route = self.lookup(key, candidates)
+        if route is not None:
+            return route
+
+        ranking = await self.aget_ranking(query, candidates)
+        route = self.select(query, ranking, candidates)
+        if route is None:
+            route = await self.acomplete(self.get_messages(query, candidates, ranking), candidates)
+        self.store(key, route)
+        return route
+
+
+    def get_key(self, query, candidates):
+        return normalize(query), tuple(candidate["name"] for candidate in candidates)
+
+
+    def lookup(self, key, candidates):
+        with self.lock:
+            cached = self.routes.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self.routes.move_to_end(key)
+            self.hits += 1
+
+        # Only names are cached, the instances may have been reloaded
+        instance = next(candidate for candidate in candidates if candidate["name"] == cached["instance"])
+        return {**cached, "instance": instance}
+
+
+    def store(self, key, route):
+        # Failed routes are asked again next time
+        if route is None:
+            return
+        with self.lock:
+            self.routes[key] = {**route, "instance": route["instance"]["name"]}
+            self.routes.move_to_end(key)
+            while len(self.routes) > self.max_entries:
+                self.routes.popitem(last=False)
+
+
+    def get_ranking(self, query, candidates):
+        try:
+            return self.index.get_candidates(query, get_instance_type(candidates)) if self.index else None
+        except Exception as e:
+            LOG.warning(f"Wind River API index unavailable, using the whole catalog: {e}")
+            return None
+
+
+    async def aget_ranking(self, query, candidates):
+        try:
+            return await self.index.aget_candidates(query, get_instance_type(candidates)) if self.index else None
+        except Exception as e:
+            LOG.warning(f"Wind River API index unavailable, using the whole catalog: {e}")
+            return None
+
+
+    def select(self, query, ranking, candidates):
+        # A Wind River API close enough to the query of a known instance is
+        # used without asking the LLM, unless the query is about Kubernetes
+        if not ranking or len(candidates) != 1 or KUBERNETES_WORDS.intersection(normalize(query).split()):
+            return None
+        api = self.index.select(ranking)
+        if api is None:
+            return None
+        LOG.info(f"API {api['url']} chosen by the embedding index")
+        return {"instance": candidates[0], "pool": WIND_RIVER_POOL, "endpoint": api["url"]}
+
+
+    def complete(self, messages, candidates):
+        # Invalid answers are sent back to the LLM with the error to be fixed
+        for _ in range(self.attempts):
+            completion = get_client(self.api_key).chat.completions.create(
+                model=self.model, temperature=0, response_format={"type": "json_object"}, messages=messages)
+            content = completion.choices[0].message.content
+            try:
+                return self.parse(content, candidates)
+            except ValueError as e:
+                LOG.warning(f"Invalid route {content!r}: {e}")
+                messages = messages + get_repair_messages(content, e)
+        return None
+
+
+    async def acomplete(self, messages, candidates):
+        for _ in range(self.attempts):
+            completion = await get_async_client(self.api_key).chat.completions.create(
+                model=self.model, temperature=0, response_format={"type": "json_object"}, messages=messages)
+            content = completion.choices[0].message.content
+            try:
+                return self.parse(content, candidates)
+            except ValueError as e:
+                LOG.warning(f"Invalid route {content!r}: {e}")
+                messages = messages + get_repair_messages(content, e)
+        return None
+
+
+    def get_messages(self, query, candidates, ranking):
+        # Only names and types are needed to choose, credentials are never sent
+        instances = [{"name": candidate["name"], "type": candidate["type"]} for candidate in candidates]
+        # Only the closest APIs are sent, the whole catalog when there is no index
+        apis = [api for _, api in ranking] if ranking else self.apis
+
+        system_prompt = ("You are connected to a StarlingX Distributed Cloud and, based on the user query, you will choose "
+                         "the instance being asked about and the API endpoint that best retrieves the information to "
+                         "answer it. Kubernetes APIs give information about the workloads of a cluster, such as pods, "
+                         "deployments, services and namespaces. Wind River APIs give information about the platform, "
+                         "such as alarms, hosts and subclouds.\n\n"
+                         f"Answer only with a JSON object in the format: {ROUTE_FORMAT}")
+        user_prompt = ("The instance is one of the available instances. If the user did not specify which instance he "
+                       "wants the information, choose the instance that contains central cloud as type.\n"
+                       "For Kubernetes the endpoint is a valid API endpoint, only the part that comes after the IP:PORT, "
+                       "e.g. /api/v1/pods.\n"
+                       "For Wind River the endpoint is the url of one of the available Wind River APIs, with its "
+                       "<parameters> filled in. Check the action of the APIs to choose the ideal url for the user query.")
+
+        return [{"role": "system", "content": system_prompt},
+                {"role": "user", "content": f"Available instances: {json.dumps(instances)}\n"
+                                            f"Available Wind River APIs: {json.dumps(apis)}\n"
+                                            f"User query: {query}\n\n{user_prompt}"}]
+
+
+    def parse(self, content, candidates):
+        try:
+            data = json.loads(content)
+        except (TypeError, ValueError):
+            raise ValueError("the answer is not a JSON object")
+        if not isinstance(data, dict):
+            raise ValueError("the answer is not a JSON object")
+
+        missing = [field for field in ("instance", "pool", "endpoint")
+                   if not isinstance(data.get(field), str) or not data[field].strip()]
+        if missing:
+            raise ValueError(f"missing or empty fields: {', '.join(missing)}")
+
+        pool = next((pool for pool in POOLS if pool.lower() == data["pool"].strip().lower()), None)
+        if pool is None:
+            raise ValueError(f"unknown pool {data['pool']}, it must be Kubernetes or Wind River")
+
+        return {"instance": self.find_instance(data["instance"], candidates),
+                "pool": pool,
+                "endpoint": self.validate_endpoint(pool, data["endpoint"].strip())}
+
+
+    def find_instance(self, name, candidates):
+        # The instance found by the resolver is kept whatever the LLM says
+        if len(candidates) == 1:
+            return candidates[0]
+        for candidate in candidates:
+            if normalize(candidate["name"]) == normalize(name):
+                return candidate
+        raise ValueError(f"unknown instance {name}, it must be one of: {', '.join(c['name'] for c in candidates)}")
+
+
+    def validate_endpoint(self, pool, endpoint):
+        if pool == KUBERNETES_POOL:
+            if "://" in endpoint or " " in endpoint:
+                raise ValueError(f"{endpoint} is not a Kubernetes API endpoint, give only the part after the IP:PORT")
+            return endpoint if endpoint.startswith("/") else f"/{endpoint}"
+
+        endpoint = endpoint.lstrip("/")
+        if not any(pattern.match(endpoint) for pattern in self.patterns):
+            raise ValueError(f"{endpoint} is not the url of one of the available Wind River APIs")
+        return endpoint
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.routes),
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def get_instance_type(candidates):
+    # APIs of the central cloud only are left out when only subclouds can be chosen
+    types = {candidate["type"] for candidate in candidates}
+    return types.pop() if len(types) == 1 else None
+
+
+def get_repair_messages(content, error):
+    return [{"role": "assistant", "content": content or ""},
+            {"role": "user", "content": f"That answer is not valid: {error}. "
+                                        f"Answer again only with a JSON object in the format: {ROUTE_FORMAT}"}]
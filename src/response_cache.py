@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+
+from constants import (LOG, RESPONSE_CACHE_DEFAULT_TTL, RESPONSE_CACHE_MAX_BYTES,
+                       RESPONSE_CACHE_TTLS)
+
+
+class response_cache():
+
+    def __init__(self, ttls=RESPONSE_CACHE_TTLS, default_ttl=RESPONSE_CACHE_DEFAULT_TTL,
+                 max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        # Responses indexed by (instance, endpoint), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+
+    def get_ttl(self, endpoint):
+        for pattern, ttl in self.ttls.items():
+            if pattern in endpoint:
+                return ttl
+        return self.default_ttl
+
+
+    def get(self, instance, endpoint, fetch):
+        # fetch receives the conditional headers and returns the HTTP response
+        entry, fresh = self.lookup(instance, endpoint)
+        if fresh:
+            return entry["response"]
+
+        response = fetch(self.get_validators(entry))
+        return self.update(instance, endpoint, entry, response)
+
+
+    async def aget(self, instance, endpoint, fetch):
+        # Same as get, with fetch being a coroutine function
+        entry, fresh = self.lookup(instance, endpoint)
+        if fresh:
+            return entry["response"]
+
+        response = await fetch(self.get_validators(entry))
+        return self.update(instance, endpoint, entry, response)
+
+
+    def lookup(self, instance, endpoint):
+        key = (instance, endpoint)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None, False
+
+            self.entries.move_to_end(key)
+            if entry["expires_at"] > time.monotonic():
+                self.hits += 1
+                LOG.info(f"Response cache hit for {endpoint} on {instance}")
+                return entry, True
+        return entry, False
+
+
+    def update(self, instance, endpoint, entry, response):
+        # Backend confirmed that the stored response is still valid
+        if entry is not None and response.status_code == 304:
+            with self.lock:
+                self.revalidations += 1
+                entry["expires_at"] = time.monotonic() + self.get_ttl(endpoint)
+            LOG.info(f"Response cache revalidated {endpoint} on {instance}")
+            return entry["response"]
+
+        with self.lock:
+            self.misses += 1
+        if response.status_code == 200:
+            self.store((instance, endpoint), response)
+        return response
+
+
+    def get_validators(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+
+        etag = entry["response"].headers.get("ETag")
+        last_modified = entry["response"].headers.get("Last-Modified")
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+
+    def store(self, key, response):
+        ttl = self.get_ttl(key[1])
+        size = len(response.content)
+        if ttl <= 0 or size > self.max_bytes:
+            return
+
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = {
+                "response": response,
+                "size": size,
+                "expires_at": time.monotonic() + ttl
+            }
+            self.size += size
+
+            # Evict least recently used responses until the cache fits its size
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self.discard(oldest)
+                self.evictions += 1
+
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry["size"]
+
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.revalidations
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hit_rate": (self.hits + self.revalidations) / lookups if lookups else 0.0
+            }
+
+
+# Response cache shared by every session
+RESPONSES = response_cache()
@@ -0,0 +1,137 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from constants import LOG, MAX_SESSIONS, SESSION_BACKEND, SESSION_DB_PATH, SESSION_IDLE_TTL
+
+
+# Every state saved has the next version of the session. A state is only saved
+# over the version it was built from, otherwise put returns None: the session
+# was answered meanwhile by another worker, whose state is newer.
+
+
+class memory_backend():
+    # Session state kept in this process only, sessions can not move between
+    # workers. Bounded like the session store, least recently used first.
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL):
+        self.states = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.states.get(session_id)
+            if entry is None or entry[1] < time.time() - self.idle_ttl:
+                return None
+            self.states.move_to_end(session_id)
+            return dict(json.loads(entry[0]), version=entry[2])
+
+
+    def get_version(self, session_id):
+        with self.lock:
+            entry = self.states.get(session_id)
+            if entry is None or entry[1] < time.time() - self.idle_ttl:
+                return None
+            return entry[2]
+
+
+    def put(self, session_id, state, version=0):
+        with self.lock:
+            self.expire()
+            entry = self.states.get(session_id)
+            if entry is not None and entry[2] != version:
+                return None
+            self.states[session_id] = (json.dumps(state), time.time(), version + 1)
+            self.states.move_to_end(session_id)
+            while len(self.states) > self.max_sessions:
+                self.states.popitem(last=False)
+            return version + 1
+
+
+    def delete(self, session_id):
+        with self.lock:
+            self.states.pop(session_id, None)
+
+
+    def expire(self):
+        deadline = time.time() - self.idle_ttl
+        for session_id in [key for key, (_, updated_at, _) in self.states.items() if updated_at < deadline]:
+            del self.states[session_id]
+
+
+class sqlite_backend():
+    # Session state in a SQLite file shared by the workers of one node. SQLite
+    # locking is not reliable on network filesystems, so the file must be on a
+    # local disk and is not shared between nodes or pods.
+
+    def __init__(self, path=SESSION_DB_PATH, idle_ttl=SESSION_IDLE_TTL):
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # Rollback journal, databases created in WAL mode are converted back
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 0)")
+        # Databases created before the sessions had versions
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(sessions)")]
+        if "version" not in columns:
+            self.connection.execute("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.connection.commit()
+
+
+    def get(self, session_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT state, version FROM sessions WHERE id = ? AND updated_at >= ?",
+                (session_id, time.time() - self.idle_ttl)).fetchone()
+        return dict(json.loads(row[0]), version=row[1]) if row else None
+
+
+    def get_version(self, session_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT version FROM sessions WHERE id = ? AND updated_at >= ?",
+                (session_id, time.time() - self.idle_ttl)).fetchone()
+        return row[0] if row else None
+
+
+    def put(self, session_id, state, version=0):
+        with self.lock:
+            self.connection.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.idle_ttl,))
+            # Compare and set, the row is only replaced when no other worker saved it
+            cursor = self.connection.execute(
+                "UPDATE sessions SET state = ?, updated_at = ?, version = ? WHERE id = ? AND version = ?",
+                (json.dumps(state), time.time(), version + 1, session_id, version))
+            if cursor.rowcount == 0:
+                cursor = self.connection.execute(
+                    "INSERT OR IGNORE INTO sessions (id, state, updated_at, version) VALUES (?, ?, ?, ?)",
+                    (session_id, json.dumps(state), time.time(), version + 1))
+            self.connection.commit()
+        return version + 1 if cursor.rowcount else None
+
+
+    def delete(self, session_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            self.connection.commit()
+
+
+BACKENDS = {
+    "memory": memory_backend,
+    "sqlite": sqlite_backend,
+}
+
+
+def create_session_backend(name=SESSION_BACKEND):
+    if name not in BACKENDS:
+        raise Exception(f"Unknown session backend {name}, available backends: {', '.join(BACKENDS)}")
+    LOG.info(f"Session state stored in the {name} backend")
+    return BACKENDS[name]()
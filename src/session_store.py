@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import OrderedDict
+
+from constants import LOG, MAX_SESSIONS, SESSION_IDLE_TTL
+
+# Rough size of each document stored in a session vectorstore: text chunk of
+# up to 500 characters plus its embedding
+DOCUMENT_SIZE = 500 + 1536 * 4
+# Chroma preallocates the HNSW index of each collection for 1000 embeddings
+VECTORSTORE_OVERHEAD = 1000 * 1536 * 4
+
+
+class session_store():
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_ttl=SESSION_IDLE_TTL):
+        # Sessions indexed by ID, least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+
+        self.evictions = 0
+        self.expirations = 0
+
+
+    def get(self, session_id, pin=False):
+        evicted = []
+        with self.lock:
+            evicted += self.expire()
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                session["last_used"] = time.monotonic()
+                if pin:
+                    session["requests"] += 1
+
+        for old_session in evicted:
+            release_session(old_session)
+        return session
+
+
+    def add(self, session, pin=False):
+        evicted = []
+        with self.lock:
+            evicted += self.expire()
+            # Least recently used sessions leave room for the new one
+            while len(self.sessions) >= self.max_sessions:
+                oldest = next((s for s in self.sessions.values() if not s["requests"]), None)
+                if oldest is None:
+                    # Every session is answering a question
+                    break
+                del self.sessions[oldest["id"]]
+                evicted.append(oldest)
+                self.evictions += 1
+
+            # A session rebuilt from a newer state replaces its outdated copy,
+            # which is released once its questions are answered
+            previous = self.sessions.pop(session["id"], None)
+            if previous is not None:
+                if previous["requests"]:
+                    previous["replaced"] = True
+                else:
+                    evicted.append(previous)
+
+            session["last_used"] = time.monotonic()
+            session["requests"] = 1 if pin else 0
+            self.sessions[session["id"]] = session
+
+        for old_session in evicted:
+            release_session(old_session)
+        return session
+
+
+    def unpin(self, session):
+        # A session answering a question is neither evicted nor expired,
+        # its vectorstore is still being read
+        with self.lock:
+            session["requests"] = max(0, session.get("requests", 0) - 1)
+            replaced = not session["requests"] and session.pop("replaced", False)
+        if replaced:
+            release_session(session)
+
+
+    def expire(self):
+        # Idle sessions are at the beginning of the LRU order
+        expired = []
+        deadline = time.monotonic() - self.idle_ttl
+        for session in list(self.sessions.values()):
+            if session["last_used"] > deadline:
+                break
+            if session["requests"]:
+                continue
+            del self.sessions[session["id"]]
+            expired.append(session)
+            self.expirations += 1
+        return expired
+
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+    def stats(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            stats = {
+                "sessions": len(sessions),
+                "answering": sum(session["requests"] > 0 for session in sessions),
+                "max_sessions": self.max_sessions,
+                "idle_ttl": self.idle_ttl,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+        sizes = [estimate_session_size(session) for session in sessions]
+        stats["estimated_bytes"] = sum(sizes)
+        stats["largest_session_bytes"] = max(sizes, default=0)
+        # Tokens of the chat history sent with the next question of each session
+        history = [session.get("history_tokens", 0) for session in sessions]
+        stats["history_tokens"] = sum(history)
+        stats["largest_history_tokens"] = max(history, default=0)
+        return stats
+
+
+def release_session(session):
+    # Chroma keeps the collection alive until it is explicitly deleted
+    LOG.info(f"Session {session['id']} released")
+    release_vectorstore(session.get("vectorstore"))
+    session["generator"].memory.clear()
+
+
+def release_vectorstore(vectorstore):
+    if vectorstore is None:
+        return
+    try:
+        collection_id = vectorstore._collection.id
+        vectorstore.delete_collection()
+
+        # chromadb 0.3 caches the HNSW index of each collection by UUID in a class
+        # wide dict but evicts it by string on deletion, so it is dropped here
+        index_cache = getattr(vectorstore._client._db, "index_cache", {})
+        index_cache.pop(collection_id, None)
+        index_cache.pop(str(collection_id), None)
+    except Exception as e:
+        LOG.warning(f"Could not delete session vectorstore: {e}")
+
+
+def estimate_session_size(session):
+    size = 0
+    memory = session["generator"].memory
+    for message in memory.chat_memory.messages:
+        size += len(message.content)
+
+    vectorstore = session.get("vectorstore")
+    if vectorstore is not None:
+        try:
+            size += VECTORSTORE_OVERHEAD + vectorstore._collection.count() * DOCUMENT_SIZE
+        except Exception:
+            pass
+    return size
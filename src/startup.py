@@ -0,0 +1,164 @@
+import importlib
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from constants import (BACKEND_CHECK_INTERVAL, BACKEND_CHECK_TIMEOUT, KEY_CHECK_INTERVAL, LOG,
+                       STARTUP_MODE, STARTUP_WAIT)
+
+LOADING = "loading"
+LOADED = "loaded"
+FAILED = "failed"
+
+# OpenAI key states, only a rejected key makes the server not ready
+KEY_PENDING = "pending"
+KEY_VALID = "valid"
+KEY_INVALID = "invalid"
+KEY_UNVERIFIED = "unverified"
+
+
+class app_loader():
+    # Imports the chatbot, which pulls LangChain, Chroma and OpenAI, and
+    # initiates its sessions. In lazy mode it runs in the background, so the
+    # server answers health checks at once and requests wait for it, in eager
+    # mode before the server starts. The OpenAI key is always validated in the
+    # background.
+
+    def __init__(self, mode=STARTUP_MODE, wait=STARTUP_WAIT):
+        self.mode = mode
+        self.wait = wait
+        self.chat = None
+        self.state = LOADING
+        self.error = None
+        self.key = KEY_PENDING
+        self.loaded = threading.Event()
+        self.started_at = time.monotonic()
+        self.load_seconds = None
+        self.backends = backend_checker()
+
+
+    def start(self):
+        self.backends.start()
+        if self.mode == "eager":
+            self.load()
+        else:
+            threading.Thread(target=self.load, daemon=True).start()
+
+
+    def load(self):
+        try:
+            chat = importlib.import_module("app")
+            chat.set_openai_key(validate=False)
+            chat.initiate_sessions()
+            self.chat = chat
+            self.state = LOADED
+            self.load_seconds = time.monotonic() - self.started_at
+            LOG.info(f"Chatbot loaded in {self.load_seconds:.2f}s")
+        except Exception as e:
+            LOG.error(f"Chatbot could not be loaded: {e}")
+            self.error = str(e)
+            self.state = FAILED
+        finally:
+            self.loaded.set()
+
+        if self.chat is not None:
+            threading.Thread(target=self.validate_key, daemon=True).start()
+
+
+    def get(self):
+        # The chatbot module, None when it is still loading after the wait or failed
+        if self.chat is None:
+            self.loaded.wait(self.wait)
+        return self.chat
+
+
+    def validate_key(self):
+        # Only a rejected key is final, an unreachable OpenAI is checked again later
+        while True:
+            try:
+                self.key = KEY_VALID if self.chat.is_api_key_valid(self.chat.OPENAI_API_KEY) else KEY_INVALID
+            except Exception as e:
+                LOG.warning(f"OpenAI key could not be validated: {e}")
+                self.key = KEY_UNVERIFIED
+            if self.key != KEY_UNVERIFIED:
+                LOG.info(f"OpenAI key {self.key}")
+                return
+            time.sleep(KEY_CHECK_INTERVAL)
+
+
+    def is_alive(self):
+        return self.state != FAILED
+
+
+    def is_ready(self):
+        return self.state == LOADED and self.key != KEY_INVALID
+
+
+    def status(self):
+        return {
+            "ready": self.is_ready(),
+            "app": self.state,
+            "error": self.error,
+            "load_seconds": self.load_seconds,
+            "openai_key": self.key,
+            # Reported only, a backend outage would make every replica not ready at once
+            "backends": self.backends.get(),
+        }
+
+
+class backend_checker():
+    # TCP reachability of OpenAI and the System Controller, checked every
+    # BACKEND_CHECK_INTERVAL seconds in the background, so probes only read the
+    # last results and never wait for a connection
+
+    def __init__(self, interval=BACKEND_CHECK_INTERVAL, timeout=BACKEND_CHECK_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout
+        self.results = {}
+        self.thread = None
+
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="backend-checker", daemon=True)
+            self.thread.start()
+
+
+    def run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+
+    def check(self):
+        self.results = {name: self.is_reachable(url) for name, url in get_backends().items()}
+
+
+    def get(self):
+        # Empty until the first check finishes
+        return dict(self.results)
+
+
+    def is_reachable(self, url):
+        if not url:
+            return False
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        try:
+            with socket.create_connection((parts.hostname, port), timeout=self.timeout):
+                return True
+        except OSError:
+            return False
+
+
+def get_backends():
+    return {
+        "openai": os.environ.get("OPENAI_API_BASE") or os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1",
+        "system_controller": os.environ.get("OAM_IP"),
+    }
+
+
+# Chatbot of this process, shared by the server endpoints
+LOADER = app_loader()
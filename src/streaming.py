@@ -0,0 +1,147 @@
+import asyncio
+import contextvars
+import json
+import queue
+import threading
+
+from langchain_core.callbacks import BaseCallbackHandler
+from constants import LOG
+from metrics import record_tokens
+
+# Destination of the events of the question being answered in the current context
+EVENT_SINK = contextvars.ContextVar("event_sink", default=None)
+
+SSE_MODE = "sse"
+CHUNKED_MODE = "chunked"
+
+
+def emit_stage(message):
+    # Inform a streaming client about the step being executed, no-op otherwise
+    sink = EVENT_SINK.get()
+    if sink is not None:
+        sink({"type": "stage", "data": message})
+
+
+def emit_discard(message):
+    # The tokens already streamed are not the answer, the client drops them
+    # and the answer generated after this event replaces them
+    sink = EVENT_SINK.get()
+    if sink is not None:
+        sink({"type": "discard", "data": message})
+
+
+def get_stream_mode(headers):
+    mode = headers.get("stream", "").lower()
+    if mode in (SSE_MODE, CHUNKED_MODE):
+        return mode
+    if "text/event-stream" in headers.get("Accept", ""):
+        return SSE_MODE
+    return None
+
+
+def get_content_type(mode):
+    if mode == SSE_MODE:
+        return "text/event-stream; charset=utf-8"
+    return "text/plain; charset=utf-8"
+
+
+class token_handler(BaseCallbackHandler):
+    # Forward the tokens generated by a streaming LLM as they are generated
+    run_inline = True
+
+    def __init__(self, sink):
+        self.sink = sink
+
+
+    def on_llm_new_token(self, token, **kwargs):
+        if token:
+            self.sink({"type": "token", "data": token})
+
+
+class usage_handler(BaseCallbackHandler):
+    # Token usage of a streaming LLM, which OpenAI does not report: the prompt
+    # is counted with the tokenizer of the model and every chunk is one token
+    run_inline = True
+
+    def __init__(self, llm):
+        self.llm = llm
+
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        for prompt in messages:
+            record_tokens(self.llm.model_name, prompt=self.llm.get_num_tokens_from_messages(prompt))
+
+
+    def on_llm_new_token(self, token, **kwargs):
+        record_tokens(self.llm.model_name, completion=1)
+
+
+def stream_answer(ask, query, session, mode):
+    events = queue.Queue()
+
+    def worker():
+        EVENT_SINK.set(events.put)
+        try:
+            answer = ask(query, session, callbacks=[token_handler(events.put)])
+            events.put({"type": "answer", "data": answer})
+        except Exception as e:
+            LOG.error(f"Error while streaming answer: {e}")
+            events.put({"type": "error", "data": str(e)})
+        finally:
+            events.put(None)
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        chunk = format_event(event, mode)
+        if chunk:
+            yield chunk
+
+
+async def astream_answer(aask, query, session, mode):
+    events = asyncio.Queue()
+    loop = asyncio.get_running_loop()
+
+    def sink(event):
+        # Callbacks may run outside the event loop thread
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    async def worker():
+        EVENT_SINK.set(sink)
+        try:
+            answer = await aask(query, session, callbacks=[token_handler(sink)])
+            sink({"type": "answer", "data": answer})
+        except Exception as e:
+            LOG.error(f"Error while streaming answer: {e}")
+            sink({"type": "error", "data": str(e)})
+        finally:
+            sink(None)
+
+    task = asyncio.ensure_future(worker())
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                break
+            chunk = format_event(event, mode)
+            if chunk:
+                yield chunk
+    finally:
+        # Client went away before the answer was complete
+        if not task.done():
+            task.cancel()
+
+
+def format_event(event, mode):
+    if mode == SSE_MODE:
+        return f"event: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+    # Plain text clients only receive the tokens and the stage descriptions
+    if event["type"] == "token":
+        return event["data"]
+    if event["type"] in ("stage", "discard", "error"):
+        return f"\n[{event['data']}]\n"
+    return None
@@ -0,0 +1,276 @@
+import asyncio
+import datetime
+import threading
+
+from constants import LOG, TOKEN_REFRESH_MARGIN
+from http_pool import ASYNC_POOLS, POOLS
+
+
+def request_token(auth_url, user, password, ca_cert=None):
+    # Log in on Keystone and return the token with its expiration datetime
+    url, headers, data = get_token_request(auth_url, user, password)
+    try:
+        response = POOLS.post(url, ca_cert=ca_cert, headers=headers, json=data)
+    except Exception as e:
+        raise Exception(f"An error ocurred while trying to retrieve the authentication for the Wind River APIs. Error:{e}")
+
+    return parse_token_response(response)
+
+
+async def arequest_token(auth_url, user, password, ca_cert=None):
+    url, headers, data = get_token_request(auth_url, user, password)
+    try:
+        response = await ASYNC_POOLS.post(url, ca_cert=ca_cert, headers=headers, json=data)
+    except Exception as e:
+        raise Exception(f"An error ocurred while trying to retrieve the authentication for the Wind River APIs. Error:{e}")
+
+    return parse_token_response(response)
+
+
+def get_token_request(auth_url, user, password):
+    url = f"{auth_url}/v3/auth/tokens"
+    headers = {
+        "Content-Type": "application/json"
+    }
+    data = {
+        "auth": {
+            "identity": {
+                "methods": ["password"],
+                "password": {
+                    "user": {
+                        "name": user,
+                        "domain": {"id": "default"},
+                        "password": password
+                    }
+                }
+            },
+            "scope": {
+                "project": {
+                    "name": "admin",
+                    "domain": {"id": "default"}
+                }
+            }
+        }
+    }
+    return url, headers, data
+
+
+def parse_token_response(response):
+    if response.status_code != 201:
+        raise Exception(f"Error trying to retrieve authentication token:\n {response.status_code}, {response.text}")
+
+    x_auth_token = response.headers["x-subject-token"]
+    return x_auth_token, parse_expiration(response)
+
+
+def parse_expiration(response):
+    # Keystone informs the expiration as 2024-03-14T15:34:32.000000Z
+    try:
+        expires_at = response.json()["token"]["expires_at"]
+        return datetime.datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
+    except Exception:
+        # Without expiration information the token is kept for one hour
+        LOG.warning("Keystone token without expiration information")
+        return now() + datetime.timedelta(hours=1)
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class token_cache():
+
+    def __init__(self, refresh_margin=TOKEN_REFRESH_MARGIN):
+        # Tokens indexed by (auth_url, user)
+        self.entries = {}
+        self.refresh_margin = datetime.timedelta(seconds=refresh_margin)
+
+        # Guarantee that only one login per instance is made at a time
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+
+    def get_token(self, auth_url, user, password, ca_cert=None):
+        key = (auth_url, user)
+        entry = self.entries.get(key)
+        if entry is not None and self.is_valid(entry):
+            return self.use(key, entry, password, ca_cert)
+
+        with self.get_key_lock(key):
+            # Another thread may have refreshed the token while waiting
+            entry = self.entries.get(key)
+            if entry is not None and self.is_valid(entry):
+                return self.use(key, entry, password, ca_cert)
+
+            return self.refresh(key, password, ca_cert, used=True)
+
+
+    async def aget_token(self, auth_url, user, password, ca_cert=None):
+        # Logins are made by the async HTTP pool, without blocking a thread
+        key = (auth_url, user)
+        entry = self.entries.get(key)
+        if entry is not None and self.is_valid(entry):
+            return self.use(key, entry, password, ca_cert)
+
+        lock = await self.aacquire_key_lock(key)
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and self.is_valid(entry):
+                return self.use(key, entry, password, ca_cert)
+
+            token, expires_at = await arequest_token(auth_url, user, password, ca_cert)
+            return self.store(key, password, ca_cert, token, expires_at, used=True)
+        finally:
+            lock.release()
+
+
+    def use(self, key, entry, password, ca_cert):
+        # Only tokens used since their last refresh are refreshed again
+        entry["used"] = True
+        if entry["idle"]:
+            # A token left to expire is used again, so it is refreshed in
+            # background while it is still valid
+            entry["idle"] = False
+            if entry["timer"] is not None:
+                entry["timer"].cancel()
+            entry["timer"] = self.start_timer(0, self.background_refresh, key, password, ca_cert)
+        return entry["token"]
+
+
+    def invalidate(self, auth_url, user, token):
+        # Taken with the lock of the login, so a refresh in progress cannot
+        # store the revoked token back
+        with self.get_key_lock((auth_url, user)):
+            self.discard((auth_url, user), token)
+
+
+    async def ainvalidate(self, auth_url, user, token):
+        lock = await self.aacquire_key_lock((auth_url, user))
+        try:
+            self.discard((auth_url, user), token)
+        finally:
+            lock.release()
+
+
+    def discard(self, key, token):
+        # Requests that got a 401 with a token already replaced by another
+        # request keep the new one instead of logging in again
+        entry = self.entries.get(key)
+        if entry is None or entry["token"] != token:
+            return
+        self.entries.pop(key)
+        if entry["timer"] is not None:
+            entry["timer"].cancel()
+        LOG.info(f"Keystone token for {key[1]} at {key[0]} invalidated")
+
+
+    def close(self):
+        # Stops the background refreshes, called when the server shuts down
+        for entry in list(self.entries.values()):
+            if entry["timer"] is not None:
+                entry["timer"].cancel()
+
+
+    def expire(self, key, token):
+        with self.get_key_lock(key):
+            entry = self.entries.get(key)
+            if entry is None or entry["token"] != token or not entry["idle"]:
+                return
+            self.entries.pop(key)
+            LOG.info(f"Keystone token for {key[1]} at {key[0]} expired")
+
+
+    def is_valid(self, entry):
+        # Tokens left to expire are used until their real expiration
+        if entry["idle"]:
+            return entry["expires_at"] > now()
+        return entry["refresh_at"] > now()
+
+
+    def get_key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+
+    async def aacquire_key_lock(self, key):
+        # The async requests take the same lock as the threads, waiting for it
+        # in the executor so the event loop is not blocked
+        lock = self.get_key_lock(key)
+        if lock.acquire(blocking=False):
+            return lock
+
+        future = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The lock is released once taken if the request was cancelled
+            future.add_done_callback(lambda f: lock.release())
+            raise
+        return lock
+
+
+    def refresh(self, key, password, ca_cert=None, used=False):
+        auth_url, user = key
+        token, expires_at = request_token(auth_url, user, password, ca_cert)
+        return self.store(key, password, ca_cert, token, expires_at, used)
+
+
+    def store(self, key, password, ca_cert, token, expires_at, used=False):
+        auth_url, user = key
+        old_entry = self.entries.get(key)
+        if old_entry is not None and old_entry["timer"] is not None:
+            old_entry["timer"].cancel()
+
+        # Short lived tokens are refreshed halfway through their lifetime
+        margin = min(self.refresh_margin, (expires_at - now()) / 2)
+        refresh_at = expires_at - margin
+
+        self.entries[key] = {
+            "token": token,
+            "expires_at": expires_at,
+            "refresh_at": refresh_at,
+            "used": used,
+            "idle": False,
+            "timer": self.schedule_refresh(key, password, ca_cert, refresh_at)
+        }
+        LOG.info(f"New Keystone token for {user} at {auth_url}, expires at {expires_at}")
+        return token
+
+
+    def schedule_refresh(self, key, password, ca_cert, refresh_at):
+        # Refresh the token in background a bit before it expires
+        delay = (refresh_at - now()).total_seconds()
+        if delay <= 0:
+            return None
+        return self.start_timer(delay, self.background_refresh, key, password, ca_cert)
+
+
+    def start_timer(self, delay, function, *args):
+        timer = threading.Timer(delay, function, args=args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+
+    def background_refresh(self, key, password, ca_cert):
+        with self.get_key_lock(key):
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            # Tokens of instances no longer asked about are left to expire,
+            # and are still used until then
+            if not entry["used"]:
+                LOG.info(f"Keystone token for {key[1]} at {key[0]} not used since its refresh, left to expire at {entry['expires_at']}")
+                entry["idle"] = True
+                delay = max(0, (entry["expires_at"] - now()).total_seconds())
+                entry["timer"] = self.start_timer(delay, self.expire, key, entry["token"])
+                return
+            try:
+                self.refresh(key, password, ca_cert)
+            except Exception as e:
+                LOG.warning(f"Background refresh of Keystone token failed: {e}")
+                self.entries.pop(key, None)
+
+
+# Token cache shared by every session
+TOKENS = token_cache()